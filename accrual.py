@@ -0,0 +1,184 @@
+"""This module contains the end-of-day job that pays interest on savings and charges fees on current accounts.
+
+    python main.py accrue --date 2022-06-30
+
+Every customer's balance is loaded into a numpy array and the change to each account is worked out
+in one vectorized pass. Savings earn BANK_PORTAL_INTEREST_RATE percent a year, paid daily and rounded
+down to whole naira. Current accounts are charged BANK_PORTAL_MAINTENANCE_FEE, but never more than
+they hold. The changes are committed in one storage write and their interest and fee rows in one
+ledger append, dated the business date.
+
+A date earlier than the ledger's latest row is refused: its changes would be worked out from the
+balances of later days and written after their rows, so replaying the ledger would not give them.
+
+Each business date is run once. The dates are kept in an SQLite file next to the ledger, so running
+the job again for a date does nothing. A date is claimed before anything is written and marked done
+after. If the job stops in between, the date is left started and is refused until an official has
+checked the accounts with python main.py balances reconcile and runs it again with --retry.
+"""
+
+import argparse
+import datetime as dt
+import os
+import sqlite3
+import threading
+
+import settings
+from ledger import get_ledger, new_row
+from storage import ConflictError, get_storage
+
+
+class AccrualError(Exception):
+    """Raised when a business date cannot be run."""
+
+
+class Accruals:
+    """The business dates the job has run for, kept in an SQLite file next to the ledger."""
+
+    def __init__(self, ledger_path):
+        self.path = f"{os.path.splitext(ledger_path.rstrip('/'))[0]}.accruals.sqlite3"
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS accruals "
+                "(date TEXT PRIMARY KEY, state TEXT, accounts INTEGER, interest INTEGER, fees INTEGER)"
+            )
+
+    def get(self, date):
+        """Returns the state, accounts changed, interest paid and fees charged of a date, or None."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT state, accounts, interest, fees FROM accruals WHERE date = ?", (str(date),)
+            ).fetchone()
+
+    def start(self, date, retry=False):
+        """Claims a date. Returns False if it is done already. Raises AccrualError if it was started."""
+        with self.lock, self.connection:
+            if retry:
+                self.connection.execute("DELETE FROM accruals WHERE date = ? AND state = 'started'", (str(date),))
+            try:
+                self.connection.execute("INSERT INTO accruals VALUES (?, 'started', 0, 0, 0)", (str(date),))
+            except sqlite3.IntegrityError:
+                state = self.connection.execute("SELECT state FROM accruals WHERE date = ?", (str(date),)).fetchone()[0]
+                if state == "done":
+                    return False
+                raise AccrualError(
+                    f"Sorry, accrual for {date} was started and did not finish. Check the accounts with "
+                    f"balances reconcile, then run it again with --retry."
+                )
+        return True
+
+    def finish(self, date, accounts, interest, fees):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE accruals SET state = 'done', accounts = ?, interest = ?, fees = ? WHERE date = ?",
+                (accounts, interest, fees, str(date)),
+            )
+
+    def cancel(self, date):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM accruals WHERE date = ?", (str(date),))
+
+    def close(self):
+        self.connection.close()
+
+
+_accruals = {}
+
+
+def get_accruals(ledger_path=None):
+    ledger_path = ledger_path or settings.RECORDS
+    if ledger_path not in _accruals:
+        _accruals[ledger_path] = Accruals(ledger_path)
+    return _accruals[ledger_path]
+
+
+def changes(balances, savings, rate, fee):
+    """Returns the change to each balance: daily interest on savings and the fee on the rest.
+
+    balances is an int array and savings a bool array of which accounts are savings accounts.
+    """
+    import numpy
+
+    interest = numpy.floor(numpy.maximum(balances, 0) * (rate / 100 / 365)).astype("i8")
+    fees = numpy.minimum(fee, numpy.maximum(balances, 0))
+    return numpy.where(savings, interest, -fees)
+
+
+def accrue(details, date):
+    """Returns the balance changes and ledger rows of one business date for the members in details."""
+    import numpy
+
+    customers = [detail for detail in details.values() if detail.get("role") == "customer"]
+    balances = numpy.fromiter((detail["balance"] for detail in customers), "i8", len(customers))
+    savings = numpy.fromiter((detail.get("account type") == "savings" for detail in customers), bool, len(customers))
+    amounts = changes(balances, savings, settings.INTEREST_RATE, settings.MAINTENANCE_FEE)
+    changed = numpy.flatnonzero(amounts)
+    emails = [customers[number]["email"] for number in changed.tolist()]
+    amounts = amounts[changed].tolist()
+    # every row is the same but for its user and amount, so they are copied from one of each type
+    now = dt.datetime.combine(date, dt.time(23, 59))
+    rows = {True: new_row(None, "interest", 0, now=now), False: new_row(None, "fee", 0, now=now)}
+    entries = [dict(rows[amount > 0], user=email, amount=abs(amount)) for email, amount in zip(emails, amounts)]
+    return dict(zip(emails, amounts)), entries
+
+
+def run(date=None, ledger_path=None, retry=False):
+    """Pays interest and charges fees for a business date, today by default.
+
+    Returns the accounts changed, interest paid and fees charged, and whether they were posted now
+    rather than on an earlier run.
+    """
+    date = dt.date.fromisoformat(str(date)) if date is not None else dt.date.today()
+    accruals = get_accruals(ledger_path)
+    done = accruals.get(date)
+    if done is not None and done[0] == "done":
+        return done[1:], False
+    latest = get_ledger(ledger_path).last_date()
+    if latest is not None and str(date) < latest:
+        raise AccrualError(f"Sorry, the ledger already has rows for {latest}, so accrual can't be run for {date}.")
+    if not accruals.start(date, retry):
+        return accruals.get(date)[1:], False
+    storage = get_storage()
+    try:
+        # a teller may change an account while the changes are worked out, so work them out again
+        for _ in range(settings.COMMIT_RETRIES):
+            details = storage.all()
+            deltas, entries = accrue(details, date)
+            versions = {email: details[email].get("version", 0) for email in deltas}
+            try:
+                if deltas:
+                    storage.commit(deltas, versions)
+            except ConflictError:
+                continue
+            break
+        else:
+            raise ConflictError("Sorry, the bank is too busy to run accrual. Please try again.")
+    except BaseException:
+        # nothing was written, so the date can be run again
+        accruals.cancel(date)
+        raise
+    get_ledger(ledger_path).append_many(entries)
+    interest = sum(amount for amount in deltas.values() if amount > 0)
+    fees = -sum(amount for amount in deltas.values() if amount < 0)
+    accruals.finish(date, len(deltas), interest, fees)
+    return (len(deltas), interest, fees), True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="main.py accrue", description="Pay interest and charge fees for a day.")
+    parser.add_argument("--date", type=dt.date.fromisoformat, help="the business date, YYYY-MM-DD, today by default")
+    parser.add_argument("--retry", action="store_true", help="run a date again that was started and did not finish")
+    arguments = parser.parse_args(argv)
+
+    try:
+        (accounts, interest, fees), posted = run(arguments.date, retry=arguments.retry)
+    except (AccrualError, ConflictError) as error:
+        print(error)
+        return 1
+    if not posted:
+        print(f"Accrual for {arguments.date or dt.date.today()} was already run.")
+    print(f"Paid N{interest:,} interest and charged N{fees:,} in fees on {accounts:,} accounts.")
+    return 0
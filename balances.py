@@ -0,0 +1,153 @@
+"""This module contains the balances worked out from the ledger: checkpoints, past balances and reconciliation.
+
+    python main.py balances checkpoint
+    python main.py balances on member1@bank.test 2022-06-30
+    python main.py balances reconcile
+
+A checkpoint is the balance of an account at the end of a day. They are kept in SQLite next to the
+ledger and rebuilt in one pass over it, every BANK_PORTAL_CHECKPOINT_INTERVAL rows of an account. The
+balance on a date is the latest checkpoint before it plus the account's rows since, both found
+through an index, so it costs O(log n + the rows since the checkpoint).
+"""
+
+import argparse
+import os
+import sqlite3
+import threading
+
+import settings
+from ledger import get_ledger
+from snapshot import get_snapshot
+
+# How each type of ledger row changes the balance of its user.
+SIGNS = {"deposit": 1, "received": 1, "adjustment": 1, "interest": 1, "withdrawal": -1, "transfer": -1, "fee": -1}
+
+
+def change(row):
+    return SIGNS.get(row["transaction"], 0) * row["amount"]
+
+
+class Checkpoints:
+    """The balance checkpoints of a ledger, kept in an SQLite file next to it."""
+
+    def __init__(self, ledger_path):
+        self.path = f"{os.path.splitext(ledger_path.rstrip('/'))[0]}.balances.sqlite3"
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints (user TEXT, date TEXT, balance INTEGER, PRIMARY KEY (user, date))"
+            )
+
+    def rebuild(self, rows, interval):
+        """Replaces the checkpoints with those of rows, which must be in the order they were written.
+
+        An account gets a checkpoint at the end of the first day on which it has interval rows since its
+        last one. The last day in the ledger may not be over, so it gets none.
+        """
+        balances = {}
+        since = {}
+        checkpoints = []
+        day = None
+        for row in rows:
+            if row["date"] != day:
+                if day is not None:
+                    for user in [user for user, count in since.items() if count >= interval]:
+                        checkpoints.append((user, day, balances[user]))
+                        del since[user]
+                day = row["date"]
+            user = row["user"]
+            balances[user] = balances.get(user, 0) + change(row)
+            since[user] = since.get(user, 0) + 1
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM checkpoints")
+            self.connection.executemany("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)", checkpoints)
+        return len(checkpoints)
+
+    def before(self, user, date):
+        """Returns the date and balance of the latest checkpoint of an account on or before date, or None."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT date, balance FROM checkpoints WHERE user = ? AND date <= ? ORDER BY date DESC LIMIT 1",
+                (user, str(date)),
+            ).fetchone()
+
+    def close(self):
+        self.connection.close()
+
+
+_checkpoints = {}
+
+
+def get_checkpoints(ledger_path=None):
+    ledger_path = ledger_path or settings.RECORDS
+    if ledger_path not in _checkpoints:
+        _checkpoints[ledger_path] = Checkpoints(ledger_path)
+    return _checkpoints[ledger_path]
+
+
+def checkpoint(ledger_path=None):
+    """Rebuilds the checkpoints of the ledger. Returns how many there are."""
+    return get_checkpoints(ledger_path).rebuild(get_ledger(ledger_path).rows(), settings.CHECKPOINT_INTERVAL)
+
+
+def balance_on(user, date, ledger_path=None):
+    """Returns the balance of an account at the end of a date, such as 2022-06-30."""
+    date = str(date)
+    found = get_checkpoints(ledger_path).before(user, date)
+    if found is None:
+        rows = get_ledger(ledger_path).rows_for(user, end=date)
+        return sum(map(change, rows))
+    day, balance = found
+    rows = get_ledger(ledger_path).rows_for(user, start=day, end=date)
+    # rows_for starts at the beginning of the checkpoint's day, which the checkpoint already includes
+    return balance + sum(change(row) for row in rows if row["date"] > day)
+
+
+def reconcile(ledger_path=None):
+    """Replays the ledger in one pass and compares every customer's balance with it.
+
+    Both are read from a new snapshot, so the ledger and the balances are compared as at one moment
+    and the replay holds no locks. Returns a list of (email, stored balance, ledger balance) for the
+    accounts that differ. An account with rows in the ledger but not in the database has None as its
+    stored balance.
+    """
+    view = get_snapshot(ledger_path=ledger_path).refresh()
+    balances = {}
+    for row in view.rows():
+        balances[row["user"]] = balances.get(row["user"], 0) + change(row)
+    mismatches = []
+    for email, detail in view.all().items():
+        if detail.get("role") != "customer":
+            continue
+        replayed = balances.pop(email, 0)
+        if detail["balance"] != replayed:
+            mismatches.append((email, detail["balance"], replayed))
+    mismatches += [(email, None, replayed) for email, replayed in balances.items() if replayed]
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="main.py balances", description="Work out balances from the ledger.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("checkpoint", help="rebuild the balance checkpoints")
+    command = commands.add_parser("on", help="show the balance of an account at the end of a date")
+    command.add_argument("email")
+    command.add_argument("date", help="YYYY-MM-DD")
+    commands.add_parser("reconcile", help="compare every customer's balance with the ledger")
+    arguments = parser.parse_args(argv)
+
+    match arguments.command:
+        case "checkpoint":
+            print(f"Saved {checkpoint():,} checkpoints.")
+        case "on":
+            print(f"N{balance_on(arguments.email.lower(), arguments.date)}")
+        case "reconcile":
+            mismatches = reconcile()
+            for email, stored, replayed in mismatches:
+                stored = "not in the database" if stored is None else f"N{stored}"
+                print(f"{email}: {stored}, ledger N{replayed}")
+            print(f"{len(mismatches)} accounts do not match the ledger.")
+            return 1 if mismatches else 0
+    return 0
@@ -0,0 +1,115 @@
+"""This module contains the batch engine that posts files of deposits, withdrawals and transfers.
+
+A batch file is a CSV with the columns operation, email, amount and account_number, or a JSONL file
+with one object per line using the same keys. operation is deposit, withdraw or transfer, and
+account_number is the account a transfer is sent to.
+"""
+
+import argparse
+import csv
+import datetime as dt
+import json
+
+import settings
+from ledger import get_ledger, new_row, transfer_rows
+from member_factory import INVALID_AMOUNT, BankError, check_operation
+from storage import ConflictError, get_storage
+
+
+def read_rows(path):
+    """Yields the rows of a CSV or JSONL batch file."""
+    with open(path, newline="") as file:
+        if path.endswith(".jsonl"):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(file)
+
+
+def post(rows, details):
+    """Checks every row with check_operation, as the portal does, in order, against running balances.
+
+    Returns the balance changes, the ledger rows and a list of (row number, reason) for rejected rows.
+    """
+    balances = {email: detail["balance"] for email, detail in details.items() if detail["role"] == "customer"}
+    accounts = {
+        detail["account number"]: email for email, detail in details.items() if detail["role"] == "customer"
+    }
+    deltas = {}
+    entries = []
+    rejected = []
+    now = dt.datetime.now()
+
+    for number, row in enumerate(rows, start=1):
+        operation = str(row.get("operation", "")).lower()
+        email = str(row.get("email", "")).lower()
+        try:
+            amount = int(row.get("amount"))
+        except (TypeError, ValueError):
+            rejected.append((number, INVALID_AMOUNT))
+            continue
+        if email not in balances:
+            rejected.append((number, "Sorry, account not found.😓"))
+            continue
+        recipient = None
+        if operation == "transfer":
+            try:
+                recipient = accounts.get(int(row.get("account_number")))
+            except (TypeError, ValueError):
+                pass
+        try:
+            check_operation(operation, amount, balances[email], recipient)
+        except BankError as error:
+            rejected.append((number, str(error)))
+            continue
+
+        if operation == "deposit":
+            balances[email] += amount
+            deltas[email] = deltas.get(email, 0) + amount
+            entries.append(new_row(email, "deposit", amount, now=now))
+        elif operation == "withdraw":
+            balances[email] -= amount
+            deltas[email] = deltas.get(email, 0) - amount
+            entries.append(new_row(email, "withdrawal", amount, now=now))
+        else:
+            balances[email] -= amount
+            balances[recipient] += amount
+            deltas[email] = deltas.get(email, 0) - amount
+            deltas[recipient] = deltas.get(recipient, 0) + amount
+            entries.extend(
+                transfer_rows(email, details[email]["name"], recipient, details[recipient]["name"], amount, now)
+            )
+
+    return deltas, entries, rejected
+
+
+def run(path):
+    """Posts a batch file in one storage write and one ledger append. Returns the ledger rows and rejections."""
+    storage = get_storage()
+    rows = list(read_rows(path))
+    # another process may change an account while the batch is checked, so check it again
+    for _ in range(settings.COMMIT_RETRIES):
+        details = storage.all()
+        deltas, entries, rejected = post(rows, details)
+        versions = {email: details[email].get("version", 0) for email in deltas}
+        try:
+            if deltas:
+                storage.commit(deltas, versions)
+        except ConflictError:
+            continue
+        get_ledger().append_many(entries)
+        return entries, rejected
+    raise ConflictError("Sorry, the bank is too busy to post this batch. Please try again.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="main.py batch", description="Post a file of transactions.")
+    parser.add_argument("file", help="a .csv or .jsonl file of deposits, withdrawals and transfers")
+    arguments = parser.parse_args(argv)
+
+    entries, rejected = run(arguments.file)
+    for number, reason in rejected:
+        print(f"Row {number} rejected: {reason}")
+    print(f"Posted {len(entries)} transactions, rejected {len(rejected)}.")
+    return 1 if rejected else 0
@@ -0,0 +1,408 @@
+"""This module contains the benchmarks of the portal's core operations.
+
+    python bench.py portal --members 1000 100000 1000000 --ledger-rows 10000000
+    python bench.py passwords --costs scrypt:16384 pbkdf2_sha256:600000
+    python bench.py ledger --rows 10000000
+    python bench.py groupcommit --delays 0 1 2 5 --sizes 64 256 --threads 32
+
+Each operation runs in its own process, against a generated database and ledger, with input() mocked
+the same way tests.py drives the portal. Results are written to a JSON file so runs can be compared.
+"""
+
+import argparse
+import contextlib
+import datetime as dt
+import io
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from unittest import mock
+
+import datagen
+import ledger
+import passwords
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+OPERATIONS = ["login", "transfer", "transact", "get_account_statement", "open_account", "record"]
+
+
+def database_path(directory, engine):
+    return os.path.join(directory, "database.sqlite3" if engine == "sqlite" else "database.json")
+
+
+def environment(directory, engine):
+    """Returns the environment that points the portal at a dataset."""
+    return dict(
+        os.environ,
+        BANK_PORTAL_DATABASE=database_path(directory, engine),
+        BANK_PORTAL_RECORDS=os.path.join(directory, "records.csv"),
+        BANK_PORTAL_MEMBER_COUNT=os.path.join(directory, "member_count.txt"),
+        BANK_PORTAL_ACCOUNT_BLOCKS=os.path.join(directory, "account_blocks.txt"),
+    )
+
+
+def percentile(timings, fraction):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def status_kb(field):
+    """Returns a memory figure of this process from /proc/self/status, or None where there is none."""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def peak_rss_kb():
+    """Returns the peak RSS of this process. ru_maxrss is kept across exec on Linux, so VmHWM is read first."""
+    return status_kb("VmHWM") or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_operation(operation, members, iterations, seed=0):
+    """Times one operation in this process. The portal is imported here, after the environment is set."""
+    import utilities
+
+    rng = random.Random(seed)
+    emails = [datagen.email(rng.randrange(members)) for _ in range(iterations)]
+
+    def login(email):
+        # the menu keeps its session, so without logging out only the first login would be timed
+        utilities.logout()
+        with mock.patch("utilities.input", create=True) as mocked_input:
+            mocked_input.side_effect = [email, datagen.PASSWORD]
+            return utilities.login()
+
+    user = login(emails[0])
+    calls = {
+        "login": lambda number: login(emails[number]),
+        "transfer": lambda number: user.transfer(1, datagen.account_number(rng.randrange(members))),
+        "transact": lambda number: user.transact("deposit", 1),
+        "get_account_statement": lambda number: login(emails[number]).get_account_statement(),
+        "record": lambda number: utilities.record(emails[number], "deposit", 1),
+    }
+
+    def open_account(number):
+        with mock.patch("utilities.input", create=True) as mocked_input:
+            mocked_input.side_effect = [
+                "Bench Mark", f"bench{seed}-{number}-{time.time_ns()}@bank.test", "c", "pass123", "pass123", "n"
+            ]
+            utilities.open_account()
+
+    calls["open_account"] = open_account
+
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for number in range(iterations):
+            started = time.perf_counter()
+            calls[operation](number)
+            timings.append(time.perf_counter() - started)
+    total = sum(timings)
+    return {
+        "operation": operation,
+        "members": members,
+        "iterations": iterations,
+        "p50_ms": round(percentile(timings, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(timings, 0.99) * 1000, 3),
+        "throughput_per_s": round(iterations / total, 1) if total else None,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def portal(arguments):
+    results = []
+    for members in arguments.members:
+        directory = os.path.join(arguments.data_dir, f"{arguments.engine}-{members}-{arguments.ledger_rows}")
+        print(f"Preparing {members:,} members and {arguments.ledger_rows:,} ledger rows in {directory}...")
+        if not os.path.exists(database_path(directory, arguments.engine)):
+            datagen.generate(directory, members, arguments.ledger_rows, arguments.engine)
+        for operation in arguments.operations:
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "worker", operation, str(members), str(arguments.iterations)],
+                env=environment(directory, arguments.engine), cwd=HERE, capture_output=True, text=True, check=True,
+            ).stdout
+            result = dict(json.loads(output.splitlines()[-1]), engine=arguments.engine,
+                          ledger_rows=arguments.ledger_rows)
+            print(
+                f"{operation:>22} {members:>9,} members: p50 {result['p50_ms']:>9} ms  p99 {result['p99_ms']:>9} ms  "
+                f"{result['throughput_per_s']:>9}/s  peak RSS {result['peak_rss_kb']:,} KB"
+            )
+            results.append(result)
+    return results
+
+
+def password_costs(arguments):
+    """Times logins per core at each password hashing cost, with and without the verified-login cache."""
+    results = []
+    for cost in arguments.costs:
+        scheme, _, value = cost.partition(":")
+        parameters = (int(value), 8, 1) if scheme == "scrypt" else (int(value),)
+        started = time.perf_counter()
+        stored = passwords.hash_password(datagen.PASSWORD, scheme, parameters)
+        hash_ms = (time.perf_counter() - started) * 1000
+        verified = passwords.get_verified()
+        timings = {}
+        for cache in ("cold", "warm"):
+            started = time.perf_counter()
+            for _ in range(arguments.iterations):
+                if cache == "cold":
+                    verified.clear()
+                passwords.verify(datagen.email(0), stored, datagen.PASSWORD)
+            timings[cache] = time.perf_counter() - started
+        result = {
+            "scheme": scheme,
+            "parameters": parameters,
+            "hash_ms": round(hash_ms, 3),
+            "logins_per_s_per_core": round(arguments.iterations / timings["cold"], 1),
+            "cached_logins_per_s_per_core": round(arguments.iterations / timings["warm"], 1),
+        }
+        print(
+            f"{cost:>22}: hash {result['hash_ms']:>9} ms  {result['logins_per_s_per_core']:>9}/s per core  "
+            f"{result['cached_logins_per_s_per_core']:>11}/s per core cached"
+        )
+        results.append(result)
+    return results
+
+
+def disk_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    index = f"{os.path.splitext(path)[0]}.index.sqlite3"
+    return os.path.getsize(path) + (os.path.getsize(index) if os.path.exists(index) else 0)
+
+
+def ledger_formats(arguments):
+    """Times statements from records.csv and from a columnar ledger holding the same rows."""
+    directory = os.path.join(arguments.data_dir, f"ledger-{arguments.members}-{arguments.rows}")
+    csv_path = os.path.join(directory, "records.csv")
+    columnar_path = os.path.join(directory, "records.ledger")
+    if not os.path.exists(csv_path):
+        print(f"Generating {arguments.rows:,} ledger rows in {directory}...")
+        os.makedirs(directory, exist_ok=True)
+        datagen.write_ledger(csv_path, arguments.members, arguments.rows)
+    if not os.path.exists(columnar_path):
+        started = time.perf_counter()
+        ledger.convert(csv_path, columnar_path)
+        print(f"Converted to {columnar_path} in {time.perf_counter() - started:.1f} s.")
+    results = []
+    for path in (csv_path, columnar_path):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "ledger-worker", path, str(arguments.members),
+             str(arguments.queries)],
+            cwd=HERE, capture_output=True, text=True, check=True,
+        ).stdout
+        result = dict(json.loads(output.splitlines()[-1]), rows=arguments.rows, disk_bytes=disk_size(path))
+        print(
+            f"{os.path.basename(path):>15}: first {result['first_ms']:>10} ms  p50 {result['p50_ms']:>8} ms  "
+            f"p99 {result['p99_ms']:>8} ms  peak RSS {result['peak_rss_kb']:,} KB "
+            f"({result['anonymous_rss_kb']:,} KB anonymous)  on disk {result['disk_bytes']:,} B"
+        )
+        results.append(result)
+    return results
+
+
+def ledger_worker(arguments):
+    """Times statements of random members from one ledger in this process."""
+    rng = random.Random(0)
+    records = ledger.open_ledger(arguments.path)
+    started = time.perf_counter()
+    # the first statement also brings the index up to date
+    records.rows_for(datagen.email(0))
+    first = time.perf_counter() - started
+    timings = []
+    for _ in range(arguments.queries):
+        email = datagen.email(rng.randrange(arguments.members))
+        started = time.perf_counter()
+        records.rows_for(email)
+        timings.append(time.perf_counter() - started)
+    print(json.dumps({
+        "ledger": os.path.basename(arguments.path),
+        "queries": arguments.queries,
+        "first_ms": round(first * 1000, 3),
+        "p50_ms": round(percentile(timings, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(timings, 0.99) * 1000, 3),
+        "peak_rss_kb": peak_rss_kb(),
+        # memory-mapped pages count towards RSS but are page cache the kernel can drop
+        "anonymous_rss_kb": status_kb("RssAnon"),
+    }))
+
+
+def group_commit(arguments):
+    """Times concurrent deposits, withdrawals and transfers with group commit off and at each delay and size."""
+    directory = os.path.join(arguments.data_dir, f"{arguments.engine}-{arguments.members}-0")
+    if not os.path.exists(database_path(directory, arguments.engine)):
+        print(f"Generating {arguments.members:,} members in {directory}...")
+        datagen.generate(directory, arguments.members, 0, arguments.engine)
+    settings = [(0, 0)] + [(size, delay) for size in arguments.sizes for delay in arguments.delays]
+    results = []
+    for size, delay in settings:
+        env = dict(
+            environment(directory, arguments.engine),
+            BANK_PORTAL_GROUP_COMMIT_SIZE=str(size),
+            BANK_PORTAL_GROUP_COMMIT_DELAY_MS=str(delay),
+        )
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "groupcommit-worker", str(arguments.members),
+             str(arguments.active), str(arguments.threads), str(arguments.operations)],
+            env=env, cwd=HERE, capture_output=True, text=True, check=True,
+        ).stdout
+        result = dict(json.loads(output.splitlines()[-1]), engine=arguments.engine, size=size, delay_ms=delay)
+        name = f"size {size}, {delay} ms" if size else "off"
+        print(
+            f"{name:>18}: {result['throughput_per_s']:>9}/s  p50 {result['p50_ms']:>8} ms  p99 {result['p99_ms']:>8} ms  "
+            f"{result['operations_per_write']:>6} operations per write"
+        )
+        results.append(result)
+    return results
+
+
+def group_commit_worker(arguments):
+    """Runs deposits, withdrawals and transfers from many threads at once, as the API's threads do."""
+    import threading
+
+    from groupcommit import get_group_commit
+    from ledger import get_ledger, new_row, transfer_rows
+    from member_factory import BankError, Customer
+    from storage import get_storage
+
+    storage = get_storage()
+    group = get_group_commit()
+    # the accounts in use are read, and so cached, first, so the run times writes rather than cold reads
+    numbers = random.Random(0).sample(range(arguments.members), arguments.active)
+    users = []
+    for number in numbers:
+        detail = storage.get(datagen.email(number))
+        storage.find_by_account_number(detail["account number"])
+        users.append(Customer.from_storage(detail))
+    timings = []
+
+    def teller(seed):
+        rng = random.Random(seed)
+        for _ in range(arguments.operations):
+            user = rng.choice(users)
+            operation = rng.choice(["deposit", "deposit", "withdraw", "transfer"])
+            account_number = rng.choice(users).account_number
+            started = time.perf_counter()
+            try:
+                # the same calls as the API's deposit, withdraw and transfer routes
+                if group is not None:
+                    group.submit(operation, user.email, 1, account_number if operation == "transfer" else None)
+                elif operation == "transfer":
+                    person = user.send(1, account_number)
+                    get_ledger().append_many(transfer_rows(user.email, user.name, person["email"], person["name"], 1))
+                else:
+                    user.post(operation, 1)
+                    get_ledger().append(new_row(user.email, "deposit" if operation == "deposit" else "withdrawal", 1))
+            except BankError:
+                pass
+            timings.append(time.perf_counter() - started)
+
+    get_ledger()
+    threads = [threading.Thread(target=teller, args=(seed,)) for seed in range(arguments.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    writes = group.batches if group is not None else len(timings)
+    print(json.dumps({
+        "threads": arguments.threads,
+        "operations": len(timings),
+        "throughput_per_s": round(len(timings) / elapsed, 1),
+        "p50_ms": round(percentile(timings, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(timings, 0.99) * 1000, 3),
+        "operations_per_write": round(len(timings) / writes, 1) if writes else None,
+    }))
+
+
+def worker(arguments):
+    print(json.dumps(run_operation(arguments.operation, arguments.members, arguments.iterations)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the bank portal.")
+    parser.add_argument("--output", default="bench_results.json", help="the JSON file results are written to")
+    suites = parser.add_subparsers(dest="suite", required=True)
+
+    suite = suites.add_parser("portal", help="time the portal's core operations as the data grows")
+    suite.add_argument("--members", type=int, nargs="+", default=[1000])
+    suite.add_argument("--ledger-rows", type=int, default=100_000)
+    suite.add_argument("--iterations", type=int, default=200)
+    suite.add_argument("--operations", nargs="+", choices=OPERATIONS, default=OPERATIONS)
+    suite.add_argument("--engine", choices=["json", "sqlite"], default="json")
+    suite.add_argument("--data-dir", default=os.path.join(HERE, "bench_data"))
+    suite.set_defaults(run=portal)
+
+    suite = suites.add_parser("passwords", help="time logins per core at each password hashing cost")
+    suite.add_argument(
+        "--costs", nargs="+",
+        default=["scrypt:4096", "scrypt:16384", "scrypt:65536", "pbkdf2_sha256:100000", "pbkdf2_sha256:600000"],
+        help="scheme:cost pairs, the cost being n for scrypt and iterations for PBKDF2",
+    )
+    suite.add_argument("--iterations", type=int, default=20)
+    suite.set_defaults(run=password_costs)
+
+    suite = suites.add_parser("ledger", help="compare statements from records.csv and the columnar ledger")
+    suite.add_argument("--rows", type=int, default=10_000_000)
+    suite.add_argument("--members", type=int, default=100_000)
+    suite.add_argument("--queries", type=int, default=1000)
+    suite.add_argument("--data-dir", default=os.path.join(HERE, "bench_data"))
+    suite.set_defaults(run=ledger_formats)
+
+    suite = suites.add_parser("ledger-worker")
+    suite.add_argument("path")
+    suite.add_argument("members", type=int)
+    suite.add_argument("queries", type=int)
+    suite.set_defaults(run=ledger_worker)
+
+    suite = suites.add_parser("groupcommit", help="compare concurrent operations with and without group commit")
+    suite.add_argument("--members", type=int, default=10_000)
+    suite.add_argument("--active", type=int, default=256, help="members whose accounts are used")
+    suite.add_argument("--threads", type=int, default=32, help="callers at once, like the API's worker threads")
+    suite.add_argument("--operations", type=int, default=200, help="operations by each thread")
+    suite.add_argument("--sizes", type=int, nargs="+", default=[64, 256])
+    suite.add_argument("--delays", type=float, nargs="+", default=[0, 1, 2, 5], help="milliseconds")
+    suite.add_argument("--engine", choices=["json", "sqlite"], default="json")
+    suite.add_argument("--data-dir", default=os.path.join(HERE, "bench_data"))
+    suite.set_defaults(run=group_commit)
+
+    suite = suites.add_parser("groupcommit-worker")
+    suite.add_argument("members", type=int)
+    suite.add_argument("active", type=int)
+    suite.add_argument("threads", type=int)
+    suite.add_argument("operations", type=int)
+    suite.set_defaults(run=group_commit_worker)
+
+    suite = suites.add_parser("worker")
+    suite.add_argument("operation", choices=OPERATIONS)
+    suite.add_argument("members", type=int)
+    suite.add_argument("iterations", type=int)
+    suite.set_defaults(run=worker)
+
+    arguments = parser.parse_args(argv)
+    results = arguments.run(arguments)
+    if not arguments.suite.endswith("worker"):
+        with open(arguments.output, "w") as file:
+            json.dump({
+                "suite": arguments.suite,
+                "time": dt.datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": results,
+            }, file, indent=4)
+        print(f"Results written to {arguments.output}.")
+
+
+if __name__ == "__main__":
+    main()
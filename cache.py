@@ -0,0 +1,187 @@
+"""This module contains the in-memory account cache shared by everything that reads members in a process."""
+
+import collections
+import threading
+
+from storage import COLUMNS, ConflictError, Storage
+
+FIELDS = tuple(COLUMNS)
+
+
+class CachedStorage(Storage):
+    """Wraps a storage engine and keeps the members it has read as compact tuples, least recently used first.
+
+    Every read first compares the engine's change token (the file stamps of the JSON engine, the data
+    version of the SQLite engine) with the one the cache was filled under and empties the cache if
+    anything else changed the data. Writes made through the cache go to the engine first and then
+    update the cached members, as long as the engine confirms they were the only change.
+    """
+
+    def __init__(self, engine, size):
+        self.engine = engine
+        self.size = size
+        self.lock = threading.Lock()
+        self.members = collections.OrderedDict()
+        self.accounts = {}
+        self.token = None
+        # bumped by every write, so a read that raced a write does not cache what it read
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _pack(detail):
+        return tuple(detail.get(key, 0 if key == "version" else None) for key in FIELDS)
+
+    def _clear(self):
+        if self.members:
+            self.invalidations += 1
+        self.members.clear()
+        self.accounts.clear()
+        self.generation += 1
+
+    def _validate(self):
+        """Empties the cache if the data changed since it was filled. Needs the cache lock."""
+        token = self.engine.change_token()
+        if token is None or token != self.token:
+            self._clear()
+            self.token = token
+
+    def _remember(self, detail):
+        self.members[detail["email"]] = self._pack(detail)
+        self.members.move_to_end(detail["email"])
+        if detail.get("account number") is not None:
+            self.accounts[detail["account number"]] = detail["email"]
+        while len(self.members) > self.size:
+            email, packed = self.members.popitem(last=False)
+            self.accounts.pop(packed[FIELDS.index("account number")], None)
+            self.evictions += 1
+
+    def _remember_read(self, detail, generation):
+        with self.lock:
+            if detail is not None and generation == self.generation:
+                self._remember(detail)
+
+    def exists(self):
+        return self.engine.exists()
+
+    def get(self, email):
+        with self.lock:
+            self._validate()
+            packed = self.members.get(email)
+            if packed is not None:
+                self.members.move_to_end(email)
+                self.hits += 1
+                return dict(zip(FIELDS, packed))
+            self.misses += 1
+            generation = self.generation
+        detail = self.engine.get(email)
+        self._remember_read(detail, generation)
+        return detail
+
+    def all(self):
+        return self.engine.all()
+
+    def snapshot(self):
+        return self.engine.snapshot()
+
+    def existing(self, emails):
+        return self.engine.existing(emails)
+
+    def find_by_account_number(self, account_number):
+        with self.lock:
+            self._validate()
+            email = self.accounts.get(account_number)
+            generation = self.generation
+        if email is not None:
+            return self.get(email)
+        detail = self.engine.find_by_account_number(account_number)
+        self._remember_read(detail, generation)
+        return detail
+
+    def _write(self, write, apply):
+        """Runs a write on the engine and applies it to the cached members if nothing else changed the data.
+
+        apply is given what the write returned.
+        """
+        before = self.engine.change_token()
+        try:
+            result = write()
+        except ConflictError:
+            with self.lock:
+                self._clear()
+            raise
+        after = self.engine.change_token()
+        with self.lock:
+            if before == self.token and after is not None and self.engine.is_own_change(before, after):
+                apply(result)
+                self.generation += 1
+            else:
+                self._clear()
+            self.token = after
+        return result
+
+    def insert(self, detail):
+        def apply(inserted):
+            # a member whose email was already taken was not saved
+            if inserted:
+                self._remember(detail)
+
+        return self._write(lambda: self.engine.insert(detail), apply)
+
+    def insert_many(self, details):
+        # bulk inserted members are left to be cached when they are first read, not to evict the busy ones
+        return self._write(lambda: self.engine.insert_many(details), lambda inserted: None)
+
+    def update(self, email, changes):
+        def apply(result):
+            packed = self.members.pop(email, None)
+            if packed is not None:
+                detail = dict(zip(FIELDS, packed))
+                self.accounts.pop(detail["account number"], None)
+                detail.update(changes)
+                detail["version"] += 1
+                self._remember(detail)
+
+        self._write(lambda: self.engine.update(email, changes), apply)
+
+    def commit(self, deltas, versions=None):
+        def apply(result):
+            for email, amount in deltas.items():
+                packed = self.members.get(email)
+                if packed is not None:
+                    detail = dict(zip(FIELDS, packed))
+                    detail["balance"] += amount
+                    detail["version"] += 1
+                    self.members[email] = self._pack(detail)
+
+        self._write(lambda: self.engine.commit(deltas, versions), apply)
+
+    def change_token(self):
+        return self.engine.change_token()
+
+    def is_own_change(self, before, after):
+        return self.engine.is_own_change(before, after)
+
+    def stats(self):
+        """Returns the cache counters, to tune its size."""
+        with self.lock:
+            return {
+                "size": len(self.members),
+                "capacity": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+            }
+
+    def __getattr__(self, name):
+        # engine specific methods such as compact()
+        if name == "engine":
+            raise AttributeError(name)
+        return getattr(self.engine, name)
+
+    def close(self):
+        self.engine.close()
@@ -0,0 +1,161 @@
+"""This module contains the generator of large, realistic datasets for testing how the portal scales.
+
+    python datagen.py --members 1000000 --ledger-rows 10000000 --output-dir bench_data/large
+
+It writes database.json (or database.sqlite3), member_count.txt, account_blocks.txt and records.csv in
+the portal's own formats. Both files are streamed to disk, and only one balance per member is kept in memory, so the
+ledger and the balances in the database agree.
+"""
+
+import argparse
+import array
+import datetime as dt
+import json
+import os
+import random
+
+import passwords
+import settings
+import storage
+
+FIRST_NAMES = [
+    "Ada", "Chinedu", "Emeka", "Fatima", "Grace", "Ifeoma", "Joshua", "Kemi", "Ngozi", "Oluwaseun",
+    "Sade", "Tunde", "Uchenna", "Yusuf", "Zainab", "Bola", "David", "Esther", "Femi", "Halima",
+]
+LAST_NAMES = [
+    "Adeyemi", "Bello", "Chukwu", "Danjuma", "Eze", "Fashola", "Garba", "Ibrahim", "Johnson", "Kalu",
+    "Lawal", "Musa", "Nwosu", "Okafor", "Onyenso", "Peters", "Quadri", "Sanni", "Udeh", "Williams",
+]
+PASSWORD = "pass123"
+
+
+def email(number):
+    return f"member{number}@bank.test"
+
+
+def account_number(number):
+    return storage.account_number(number)
+
+
+def name(number, seed):
+    """Returns the name of a member, worked out from its number so names never need to be kept."""
+    return (
+        f"{FIRST_NAMES[(number * 7919 + seed) % len(FIRST_NAMES)]} "
+        f"{LAST_NAMES[(number * 104729 // 7 + seed) % len(LAST_NAMES)]}"
+    )
+
+
+def write_ledger(path, members, rows, seed=0, start=dt.datetime(2022, 1, 1), days=365):
+    """Streams rows transactions in time order to records.csv. Returns the resulting balance of every member.
+
+    Like the portal, a transfer writes a row for the sender and a received row for the recipient.
+    """
+    rng = random.Random(seed)
+    balances = array.array("q", bytes(8 * members))
+    step = dt.timedelta(days=days) / max(rows, 1)
+    with open(path, "w", newline="") as file:
+        file.write("user,time,date,transaction,amount,account\r\n")
+        lines = []
+        for row in range(rows):
+            now = start + step * row
+            user = rng.randrange(members)
+            amount = rng.randint(1, 100_000)
+            kind = rng.random()
+            if kind < 0.5 or balances[user] < amount:
+                balances[user] += amount
+                lines.append(f"{email(user)},{now.hour}:{now.minute},{now.date()},deposit,{amount},\r\n")
+            elif kind < 0.8 or members < 2:
+                balances[user] -= amount
+                lines.append(f"{email(user)},{now.hour}:{now.minute},{now.date()},withdrawal,{amount},\r\n")
+            else:
+                recipient = (user + rng.randrange(1, members)) % members
+                balances[user] -= amount
+                balances[recipient] += amount
+                lines.append(
+                    f"{email(user)},{now.hour}:{now.minute},{now.date()},transfer,{amount},{name(recipient, seed)}\r\n"
+                    f"{email(recipient)},{now.hour}:{now.minute},{now.date()},received,{amount},{name(user, seed)}\r\n"
+                )
+            if len(lines) == 10_000:
+                file.write("".join(lines))
+                lines = []
+        file.write("".join(lines))
+    return balances
+
+
+def member_details(members, balances, seed=0):
+    """Yields the details of every member in the database.json schema."""
+    rng = random.Random(seed + 1)
+    # one hash for everyone, since hashing millions of passwords would take hours
+    password = passwords.hash_password(PASSWORD)
+    for number in range(members):
+        yield {
+            "id": str(number),
+            "name": name(number, seed),
+            "email": email(number),
+            "password": password,
+            "role": "customer",
+            "account type": rng.choice(["current", "savings"]),
+            "account number": account_number(number),
+            "balance": balances[number],
+        }
+
+
+def write_json_database(path, details):
+    """Streams members to a file laid out exactly like json.dump(..., indent=4) of the whole database."""
+    with open(path, "w") as file:
+        file.write("{")
+        separator = "\n"
+        for detail in details:
+            body = json.dumps(detail, indent=4).replace("\n", "\n    ")
+            file.write(f"{separator}    {json.dumps(detail['email'])}: {body}")
+            separator = ",\n"
+        file.write("\n}" if separator == ",\n" else "}")
+
+
+def write_sqlite_database(path, details, chunk=10_000):
+    engine = storage.SQLiteStorage(path)
+    batch = []
+    for detail in details:
+        batch.append(detail)
+        if len(batch) == chunk:
+            engine.insert_many(batch)
+            batch = []
+    engine.insert_many(batch)
+    engine.close()
+
+
+def generate(directory, members, ledger_rows, engine="json", seed=0):
+    """Writes a database, member and account number counters and ledger into directory. Returns the database path."""
+    os.makedirs(directory, exist_ok=True)
+    balances = write_ledger(os.path.join(directory, "records.csv"), members, ledger_rows, seed)
+    details = member_details(members, balances, seed)
+    if engine == "sqlite":
+        database = os.path.join(directory, "database.sqlite3")
+        write_sqlite_database(database, details)
+    else:
+        database = os.path.join(directory, "database.json")
+        write_json_database(database, details)
+    with open(os.path.join(directory, "member_count.txt"), "w") as file:
+        file.write(str(members))
+    # new accounts are numbered from the first block none of the generated ones are in
+    with open(os.path.join(directory, "account_blocks.txt"), "w") as file:
+        file.write(str(-(-members // settings.ACCOUNT_BLOCK_SIZE)))
+    return database
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a large member database and transaction history.")
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument("--ledger-rows", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--output-dir", default=".")
+    arguments = parser.parse_args(argv)
+
+    database = generate(arguments.output_dir, arguments.members, arguments.ledger_rows, arguments.engine,
+                        arguments.seed)
+    print(f"Wrote {arguments.members:,} members to {database} and {arguments.ledger_rows:,} ledger rows.")
+
+
+if __name__ == "__main__":
+    main()
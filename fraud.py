@@ -0,0 +1,259 @@
+"""This module contains the fraud rules checked before deposits, withdrawals and transfers are committed.
+
+The rules are read from BANK_PORTAL_FRAUD_RULES, fraud_rules.json by default, and read again within
+a second of the file changing, so they can be changed without a restart. Without the file there are
+no rules. For example:
+
+    {"rules": [
+        {"type": "velocity", "operations": ["withdraw", "transfer"], "window": 3600, "count": 10, "amount": 500000},
+        {"type": "daily", "operations": ["withdraw"], "amount": 200000},
+        {"type": "new_recipient", "amount": 100000}
+    ]}
+
+velocity allows at most count operations, or amount naira, of an account in any window of seconds.
+daily caps the naira an account moves in a day. new_recipient refuses transfers above amount to
+someone the account has never sent money to. operations defaults to all three.
+
+Each process keeps the recent operations of the accounts it has seen in memory: a ring buffer of the
+last HISTORY operations, the day's totals and the emails sent to. The first time an account is
+checked, its rows within the longest window, and its transfers if there is a new_recipient rule, are
+read from the ledger. After that a check of the account costs microseconds and reads nothing, unless
+it is a transfer to someone whose name the account has sent to before (see below).
+
+The limits are per process. Operations made in other processes after an account is first read are
+not counted, so a member who spreads operations across processes, such as several API workers, can
+go over them.
+
+The ledger names the recipient of a transfer, not their email, and names are not unique. A recipient
+counts as sent to before only if their own received rows, read from the ledger, match one of the
+account's transfers to their name: same date, time and amount, naming the account's holder.
+"""
+
+import collections
+import datetime as dt
+import json
+import os
+import sys
+import threading
+import time
+
+import metrics
+import settings
+from ledger import get_ledger
+from storage import get_storage
+
+# Operations kept for each account.
+HISTORY = 1000
+
+# Seconds between checks of whether the rules file has changed.
+RELOAD_INTERVAL = 1.0
+
+OPERATIONS = ("deposit", "withdraw", "transfer")
+
+# The operation each type of ledger row was made by.
+TRANSACTIONS = {"deposit": "deposit", "withdrawal": "withdraw", "transfer": "transfer"}
+
+
+def parse_rules(config):
+    """Returns the rules of a config, checked. Raises ValueError if one is not understood."""
+    rules = []
+    for rule in config.get("rules", []):
+        rule = dict(rule)
+        rule.setdefault("operations", list(OPERATIONS))
+        if not set(rule["operations"]) <= set(OPERATIONS):
+            raise ValueError(f"unknown operations in {rule}")
+        match rule.get("type"):
+            case "velocity":
+                if rule.get("window", 0) <= 0 or ("count" not in rule and "amount" not in rule):
+                    raise ValueError(f"a velocity rule needs a window and a count or amount: {rule}")
+            case "daily" | "new_recipient":
+                if "amount" not in rule:
+                    raise ValueError(f"a {rule['type']} rule needs an amount: {rule}")
+            case _:
+                raise ValueError(f"unknown rule type in {rule}")
+        rules.append(rule)
+    return rules
+
+
+class Account:
+    """What one process knows of an account's recent operations."""
+
+    __slots__ = ("history", "day", "totals", "recipients", "name", "sent")
+
+    def __init__(self, name=None):
+        # (time, operation, amount) of the latest operations, oldest first
+        self.history = collections.deque(maxlen=HISTORY)
+        self.day = None
+        self.totals = collections.Counter()
+        # the emails of the members sent to
+        self.recipients = set()
+        self.name = name
+        # the (date, time, amount) of the transfers in the ledger, by the name of who they were sent to
+        self.sent = {}
+
+    def add(self, when, operation, amount, day):
+        self.history.append((when, operation, amount))
+        if day != self.day:
+            self.day, self.totals = day, collections.Counter()
+        self.totals[operation] += amount
+
+
+class Rules:
+    def __init__(self, path, ledger_path):
+        self.path = path
+        self.ledger_path = ledger_path
+        self.lock = threading.Lock()
+        self.rules = []
+        self.stamp = None
+        self.checked = None
+        self.accounts = {}
+
+    def _reload(self):
+        """Reads the rules again if the file has changed. A file that cannot be read leaves the old rules."""
+        now = time.monotonic()
+        if self.checked is not None and now - self.checked < RELOAD_INTERVAL:
+            return
+        self.checked = now
+        try:
+            status = os.stat(self.path)
+        except FileNotFoundError:
+            stamp = None
+        else:
+            stamp = (status.st_ino, status.st_mtime_ns, status.st_size)
+        if stamp == self.stamp:
+            return
+        try:
+            rules = []
+            if stamp is not None:
+                with open(self.path) as file:
+                    rules = parse_rules(json.load(file))
+        except (OSError, ValueError, TypeError, AttributeError) as error:
+            print(f"Sorry, the fraud rules in {self.path} could not be read, so the old ones are kept: {error}",
+                  file=sys.stderr)
+            self.stamp = stamp
+            return
+        with self.lock:
+            self.rules, self.stamp = rules, stamp
+            # windows may be longer now, so accounts are read from the ledger again
+            self.accounts = {}
+
+    def _load(self, email, rules, now):
+        """Reads the operations of an account that the rules look back on from the ledger."""
+        detail = get_storage().get(email)
+        account = Account(detail["name"] if detail is not None else None)
+        ledger = get_ledger(self.ledger_path)
+        days = max([rule["window"] for rule in rules if rule["type"] == "velocity"] + [0]) / 86400
+        start = dt.date.fromtimestamp(now - days * 86400)
+        for row in ledger.rows_for(email, start=start, transactions=list(TRANSACTIONS)):
+            hour, minute = row["time"].split(":")
+            date = dt.date.fromisoformat(row["date"])
+            when = dt.datetime.combine(date, dt.time(int(hour), int(minute))).timestamp()
+            account.add(when, TRANSACTIONS[row["transaction"]], row["amount"], date)
+        if any(rule["type"] == "new_recipient" for rule in rules):
+            for row in ledger.rows_for(email, transactions=["transfer"]):
+                account.sent.setdefault(row["account"], set()).add((row["date"], row["time"], row["amount"]))
+        return account
+
+    def _sent_before(self, account, recipient):
+        """Returns True if the ledger shows a transfer from the account to recipient, read from their received rows."""
+        sent = account.sent.get(recipient["name"])
+        if not sent:
+            return False
+        rows = get_ledger(self.ledger_path).rows_for(recipient["email"], transactions=["received"])
+        return any(row["account"] == account.name and (row["date"], row["time"], row["amount"]) in sent for row in rows)
+
+    def reserve(self, email, operation, amount, account_number=None):
+        """Checks an operation against the rules and counts it, until it is released.
+
+        Returns what to pass to release if the operation is not committed after all, or None if there
+        are no rules. Raises BankError if a rule is broken, or if amount is not above 0, as it would take
+        away from the account's totals.
+        """
+        if amount <= 0:
+            from member_factory import INVALID_AMOUNT, BankError
+
+            raise BankError(INVALID_AMOUNT)
+        self._reload()
+        rules = [rule for rule in self.rules if operation in rule["operations"]]
+        if not rules:
+            return None
+        now = time.time()
+        day = dt.date.fromtimestamp(now)
+        detail = None
+        if operation == "transfer" and any(rule["type"] == "new_recipient" for rule in rules):
+            detail = get_storage().find_by_account_number(account_number)
+        account = self.accounts.get(email)
+        if account is None:
+            account = self._load(email, self.rules, now)
+        recipient = detail["email"] if detail is not None else None
+        # the ledger is only read when the recipient's name is one the account has sent to
+        known = recipient is not None and (recipient in account.recipients or self._sent_before(account, detail))
+        with self.lock:
+            account = self.accounts.setdefault(email, account)
+            if known:
+                account.recipients.add(recipient)
+            for rule in rules:
+                self._check(rule, account, operation, amount, recipient, now, day)
+            account.add(now, operation, amount, day)
+            new = recipient is not None and recipient not in account.recipients
+            if new:
+                account.recipients.add(recipient)
+        return account, (now, operation, amount), day, recipient if new else None
+
+    def _check(self, rule, account, operation, amount, recipient, now, day):
+        match rule["type"]:
+            case "velocity":
+                count, total = 1, amount
+                for when, done, done_amount in reversed(account.history):
+                    if when <= now - rule["window"]:
+                        break
+                    if done in rule["operations"]:
+                        count += 1
+                        total += done_amount
+                if count > rule.get("count", count) or total > rule.get("amount", total):
+                    self._reject(rule, "Sorry, you have made too many transactions. Please try again later.😓")
+            case "daily":
+                total = amount + (sum(account.totals[done] for done in rule["operations"]) if account.day == day else 0)
+                if total > rule["amount"]:
+                    self._reject(rule, f"Sorry, you can't move more than N{rule['amount']:,} in a day.❌")
+            case "new_recipient":
+                # an account number that is not found is refused when the transfer is made
+                if recipient is not None and amount > rule["amount"] and recipient not in account.recipients:
+                    self._reject(
+                        rule, f"Sorry, you can't send more than N{rule['amount']:,} to someone new at a time.❌"
+                    )
+
+    @staticmethod
+    def _reject(rule, message):
+        # member_factory checks the rules, so its error is only imported once one is needed
+        from member_factory import BankError
+
+        metrics.count("fraud_rejections_total", rule=rule["type"])
+        raise BankError(message)
+
+    def release(self, reservation):
+        """Uncounts an operation that was reserved but not committed."""
+        if reservation is None:
+            return
+        account, entry, day, recipient = reservation
+        with self.lock:
+            if account.history and account.history[-1] == entry:
+                account.history.pop()
+            elif entry in account.history:
+                account.history.remove(entry)
+            if account.day == day:
+                account.totals[entry[1]] -= entry[2]
+            account.recipients.discard(recipient)
+
+
+_rules = {}
+_rules_lock = threading.Lock()
+
+
+def get_rules(path=None, ledger_path=None):
+    """Returns the fraud rules of a rules file and ledger, loading them on first use."""
+    key = (path or settings.FRAUD_RULES, ledger_path or settings.RECORDS)
+    with _rules_lock:
+        if key not in _rules:
+            _rules[key] = Rules(*key)
+        return _rules[key]
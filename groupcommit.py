@@ -0,0 +1,138 @@
+"""This module contains group commit: the deposits, withdrawals and transfers of concurrent callers in
+one process, committed together.
+
+Every storage commit and ledger append is a synced write, so under load the disk, not the checks,
+limits how many operations a second the portal takes. With BANK_PORTAL_GROUP_COMMIT_SIZE above 0 the
+JSON API sends each operation to a committer thread instead. The thread waits up to
+BANK_PORTAL_GROUP_COMMIT_DELAY_MS after the first operation for others to arrive, up to
+GROUP_COMMIT_SIZE of them, then checks them in order against running balances (see batch.post),
+commits their balance changes in one storage write and their rows in one ledger append, and answers
+every caller. Each operation waits up to the delay longer, in return for one write per batch.
+"""
+
+import threading
+import time
+
+import metrics
+import settings
+from batch import post
+from fraud import get_rules
+from ledger import get_ledger
+from member_factory import BUSY, BankError
+from storage import ConflictError, get_storage
+
+
+class Operation:
+    def __init__(self, row):
+        self.row = row
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class GroupCommit:
+    def __init__(self, storage, ledger, delay, size):
+        self.storage = storage
+        self.ledger = ledger
+        self.delay = delay
+        self.size = size
+        self.condition = threading.Condition()
+        self.pending = []
+        self.thread = None
+        self.batches = 0
+
+    def submit(self, operation, email, amount, account_number=None):
+        """Commits a deposit, withdraw or transfer with others. Returns the recipient's details for a transfer.
+
+        Raises BankError if the operation breaks one of the bank's rules.
+        """
+        rules = get_rules()
+        reservation = rules.reserve(email, operation, amount, account_number)
+        waiting = Operation({"operation": operation, "email": email, "amount": amount, "account_number": account_number})
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                self.thread.start()
+            self.pending.append(waiting)
+            if len(self.pending) == 1 or len(self.pending) >= self.size:
+                self.condition.notify()
+        waiting.done.wait()
+        if waiting.error is not None:
+            rules.release(reservation)
+            raise waiting.error
+        return waiting.result
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                deadline = time.monotonic() + self.delay
+                while len(self.pending) < self.size and (remaining := deadline - time.monotonic()) > 0:
+                    self.condition.wait(remaining)
+                operations, self.pending = self.pending[:self.size], self.pending[self.size:]
+            try:
+                self._commit(operations)
+            except Exception as error:
+                for waiting in operations:
+                    waiting.error = error
+            for waiting in operations:
+                waiting.done.set()
+
+    def _details(self, rows):
+        """Reads the members a batch touches: its senders and the owners of the accounts it sends to."""
+        details = {}
+        for row in rows:
+            detail = self.storage.get(row["email"])
+            if detail is not None:
+                details[detail["email"]] = detail
+            if row["account_number"] is not None:
+                detail = self.storage.find_by_account_number(row["account_number"])
+                if detail is not None:
+                    details[detail["email"]] = detail
+        return details
+
+    def _commit(self, operations):
+        rows = [waiting.row for waiting in operations]
+        # another process may change an account while the batch is checked, so check it again
+        for _ in range(settings.COMMIT_RETRIES):
+            details = self._details(rows)
+            deltas, entries, rejected = post(rows, details)
+            versions = {email: details[email].get("version", 0) for email in deltas}
+            try:
+                if deltas:
+                    self.storage.commit(deltas, versions)
+            except ConflictError:
+                continue
+            self.ledger.append_many(entries)
+            self.batches += 1
+            metrics.count("group_commit_batches_total")
+            metrics.count("group_commit_operations_total", len(operations))
+            break
+        else:
+            for waiting in operations:
+                waiting.error = BankError(BUSY)
+            return
+        for number, reason in rejected:
+            operations[number - 1].error = BankError(reason)
+        accounts = {detail.get("account number"): detail for detail in details.values()}
+        for waiting in operations:
+            if waiting.error is None and waiting.row["operation"] == "transfer":
+                waiting.result = accounts[waiting.row["account_number"]]
+
+
+_group_commits = {}
+_group_commits_lock = threading.Lock()
+
+
+def get_group_commit(database=None, ledger_path=None):
+    """Returns the group commit of a database and ledger, or None if group commit is off."""
+    if settings.GROUP_COMMIT_SIZE <= 0:
+        return None
+    key = (database or settings.DATABASE, ledger_path or settings.RECORDS)
+    with _group_commits_lock:
+        if key not in _group_commits:
+            _group_commits[key] = GroupCommit(
+                get_storage(key[0]), get_ledger(key[1]), settings.GROUP_COMMIT_DELAY_MS / 1000, settings.GROUP_COMMIT_SIZE
+            )
+        return _group_commits[key]
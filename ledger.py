@@ -0,0 +1,601 @@
+"""This module contains the ledgers that keep a record of every transaction made in the bank.
+
+Paths ending in .ledger are kept by the columnar ledger, anything else by the records.csv ledger.
+numpy is only imported by the columnar ledger.
+"""
+
+import csv
+import datetime as dt
+import functools
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+
+import locking
+import metrics
+import settings
+
+FIELDS = ["user", "time", "date", "transaction", "amount", "account"]
+
+
+def new_row(user_email, transaction, amount, name=None, now=None):
+    """Returns a ledger row for a transaction made now."""
+    now = now or dt.datetime.now()
+    return {
+        "user": user_email,
+        "time": f"{now.hour}:{now.minute}",
+        "date": f"{now.date()}",
+        "transaction": transaction,
+        "amount": amount,
+        "account": name
+    }
+
+
+def transfer_rows(sender_email, sender_name, recipient_email, recipient_name, amount, now=None):
+    """Returns the ledger rows of a transfer: the sender's, naming the recipient, and the recipient's, naming the sender."""
+    now = now or dt.datetime.now()
+    return [
+        new_row(sender_email, "transfer", amount, recipient_name, now),
+        new_row(recipient_email, "received", amount, sender_name, now),
+    ]
+
+
+def parse_row(line):
+    """Turns one line of records.csv into a dict."""
+    row = dict(zip(FIELDS, next(csv.reader([line]))))
+    row["amount"] = int(row["amount"])
+    row["account"] = row["account"] or None
+    return row
+
+
+class Ledger:
+    """An append-only ledger kept in records.csv.
+
+    An SQLite index next to the file holds the byte offset, date and transaction type of every row by
+    user, so a statement reads only that user's rows. The index remembers how much of the file it has
+    seen and picks up rows appended by anything else the next time it is used.
+    """
+
+    def __init__(self, path="records.csv"):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(f"{os.path.splitext(path)[0]}.index.sqlite3", check_same_thread=False)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS rows (user TEXT, position INTEGER, date TEXT, type TEXT)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS rows_user ON rows(user, date)")
+            # statement pages carry on from a position
+            self.connection.execute("CREATE INDEX IF NOT EXISTS rows_user_position ON rows(user, position)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+
+    def _indexed(self):
+        """Returns the inode and size of the file the index was last synced with."""
+        with self.lock:
+            meta = dict(self.connection.execute("SELECT key, value FROM meta").fetchall())
+        return meta.get("inode"), meta.get("size", 0)
+
+    def _save_index(self, rows, inode, size, reset=False):
+        with self.lock, self.connection:
+            if reset:
+                self.connection.execute("DELETE FROM rows")
+            self.connection.executemany("INSERT INTO rows VALUES (?, ?, ?, ?)", rows)
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)", [("inode", inode), ("size", size)]
+            )
+
+    def _is_stale(self):
+        try:
+            status = os.stat(self.path)
+        except FileNotFoundError:
+            return self._indexed()[1] != 0
+        return (status.st_ino, status.st_size) != self._indexed()
+
+    def _sync(self):
+        """Indexes the rows written to the file since the index last saw it. Needs the ledger lock."""
+        inode, size = self._indexed()
+        try:
+            file = open(self.path, "rb")
+        except FileNotFoundError:
+            self._save_index([], None, 0, reset=True)
+            return
+        with file:
+            status = os.fstat(file.fileno())
+            # the file was replaced or truncated, so index it again from the start
+            reset = status.st_ino != inode or status.st_size < size
+            position = start = 0 if reset else size
+            file.seek(position)
+            rows = []
+            for line in iter(lambda: _record(file), b""):
+                if not _is_whole(line):
+                    break
+                if position or not line.startswith(b"user,"):
+                    row = next(csv.reader([line.decode()]))
+                    rows.append((row[0], position, row[2], row[3]))
+                position += len(line)
+        metrics.count("ledger_bytes_read_total", position - start, format="csv")
+        self._save_index(rows, status.st_ino, position, reset)
+
+    def _refresh(self):
+        if self._is_stale():
+            with locking.FileLock(self.lock_path):
+                self._sync()
+
+    @metrics.timed("ledger_seconds", format="csv", operation="append")
+    def append_many(self, rows):
+        """Appends rows (dicts with the FIELDS keys) to the ledger in one write."""
+        with locking.FileLock(self.lock_path):
+            self._sync()
+            _, size = self._indexed()
+            # the writer hands each line it writes to texts, one per row
+            texts = []
+            writer = csv.writer(_Lines(texts))
+            if size == 0:
+                writer.writerow(FIELDS)
+            header = "".join(texts).encode()
+            lines = [header]
+            index = []
+            position = size + len(header)
+            for row in rows:
+                texts.clear()
+                writer.writerow([row[field] for field in FIELDS])
+                line = "".join(texts).encode()
+                lines.append(line)
+                index.append((row["user"], position, row["date"], row["transaction"]))
+                position += len(line)
+            with open(self.path, "ab") as file:
+                file.write(b"".join(lines))
+                inode = os.fstat(file.fileno()).st_ino
+            self._save_index(index, inode, position)
+        metrics.count("ledger_bytes_written_total", position - size, format="csv")
+        return rows
+
+    def append(self, row):
+        return self.append_many([row])[0]
+
+    def mark(self):
+        """Returns the end of the rows written so far. Reads given it as upto ignore any written later."""
+        self._refresh()
+        return self._indexed()[1]
+
+    def last_date(self):
+        """Returns the latest date of any row, such as 2022-09-12, or None if there are no rows."""
+        self._refresh()
+        with self.lock:
+            return self.connection.execute("SELECT MAX(date) FROM rows").fetchone()[0]
+
+    def _select(self, user, start, end, transactions, upto, after=None, limit=None):
+        """Returns the positions of the rows of one user that match, in order."""
+        sql = "SELECT position FROM rows WHERE user = ?"
+        parameters = [user]
+        if upto is None:
+            self._refresh()
+        else:
+            # rows before a mark are indexed already
+            sql += " AND position < ?"
+            parameters.append(upto)
+        if after is not None:
+            sql += " AND position > ?"
+            parameters.append(after)
+        if start is not None:
+            sql += " AND date >= ?"
+            parameters.append(str(start))
+        if end is not None:
+            sql += " AND date <= ?"
+            parameters.append(str(end))
+        if transactions:
+            sql += f" AND type IN ({', '.join('?' for _ in transactions)})"
+            parameters.extend(transactions)
+        sql += " ORDER BY position"
+        if limit is not None:
+            sql += " LIMIT ?"
+            parameters.append(limit)
+        with self.lock:
+            return [row[0] for row in self.connection.execute(sql, parameters)]
+
+    def _read_rows(self, positions):
+        if not positions:
+            return []
+        lines = []
+        with open(self.path, "rb") as file:
+            for position in positions:
+                file.seek(position)
+                lines.append(_record(file))
+        if metrics.enabled:
+            metrics.count("ledger_bytes_read_total", sum(map(len, lines)), format="csv")
+        return [parse_row(line.decode()) for line in lines]
+
+    @metrics.timed("ledger_seconds", format="csv", operation="read")
+    def rows_for(self, user, start=None, end=None, transactions=None, upto=None):
+        """Returns the rows of one user, optionally only between two dates and of some transaction types."""
+        return self._read_rows(self._select(user, start, end, transactions, upto))
+
+    @metrics.timed("ledger_seconds", format="csv", operation="page")
+    def page_for(self, user, start=None, end=None, transactions=None, after=None, size=100, upto=None):
+        """Returns up to size of the rows of one user written after the position after, as rows_for does.
+
+        Also returns the position to pass as after for the rows that follow, or None if there are no more.
+        """
+        positions = self._select(user, start, end, transactions, upto, after, size + 1)
+        cursor = positions[size - 1] if len(positions) > size else None
+        return self._read_rows(positions[:size]), cursor
+
+    def rows(self, upto=None):
+        """Yields every row of the ledger in the order they were written."""
+        try:
+            file = open(self.path, newline="") if upto is None else open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with file:
+            # a mark is a byte position, so the lines before it are counted as bytes
+            for row in csv.DictReader(file if upto is None else _lines(file, upto)):
+                row["amount"] = int(row["amount"])
+                row["account"] = row["account"] or None
+                yield row
+
+    def close(self):
+        self.connection.close()
+
+
+def _record(file):
+    """Reads one row from a binary file: a line, and the lines after it while a quoted field is open."""
+    record = file.readline()
+    # csv doubles the quotes inside a quoted field, so an odd count means it goes on to the next line
+    while record.count(b'"') % 2 and record.endswith(b"\n"):
+        line = file.readline()
+        if not line:
+            break
+        record += line
+    return record
+
+
+def _is_whole(record):
+    """Returns False for a row an append has not finished writing."""
+    return record.endswith(b"\n") and not record.count(b'"') % 2
+
+
+class _Lines:
+    """A file for csv.writer that keeps what is written in a list."""
+
+    def __init__(self, texts):
+        self.write = texts.append
+
+
+def _lines(file, end):
+    """Yields the lines of a binary file that end by position end, decoded."""
+    position = 0
+    for line in file:
+        position += len(line)
+        if position > end:
+            return
+        yield line.decode()
+
+
+# The columns of the columnar ledger and their numpy types. user, transaction and account hold the
+# codes of strings interned in users.txt, transactions.txt and accounts.txt, with -1 for no account.
+COLUMNS = {"time": "i8", "amount": "i8", "user": "i4", "transaction": "i1", "account": "i4"}
+STRINGS = {"user": "users.txt", "transaction": "transactions.txt", "account": "accounts.txt"}
+# The bytes each row takes up across the column files: 8 + 8 + 4 + 1 + 4.
+ROW_BYTES = 25
+
+
+@functools.lru_cache(maxsize=4096)
+def _day(date):
+    """Returns the seconds from the epoch to the start of a date such as 2022-09-12."""
+    return (dt.date.fromisoformat(str(date)[:10]) - dt.date(1970, 1, 1)).days * 86400
+
+
+def _timestamp(row):
+    hour, minute = row["time"].split(":")
+    return _day(row["date"]) + int(hour) * 3600 + int(minute) * 60
+
+
+class Strings:
+    """An append-only table of strings kept one per line in a file, each coded by its line number."""
+
+    def __init__(self, path):
+        self.path = path
+        self.values = []
+        self.codes = {}
+        self.size = 0
+
+    def refresh(self):
+        """Reads the strings added since the table was last read."""
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            size = 0
+        if size < self.size:
+            self.values, self.codes, self.size = [], {}, 0
+        if size == self.size:
+            return
+        with open(self.path, "rb") as file:
+            file.seek(self.size)
+            data = file.read(size - self.size)
+        # a torn last line is left until it is finished or cut off
+        end = data.rfind(b"\n") + 1
+        for value in data[:end].decode().split("\n")[:-1]:
+            self.codes[value] = len(self.values)
+            self.values.append(value)
+        self.size += end
+
+    def intern(self, values):
+        """Returns the codes of values, adding the new ones to the table. Needs the ledger lock."""
+        self.refresh()
+        new = []
+        for value in values:
+            if value not in self.codes:
+                self.codes[value] = len(self.values)
+                self.values.append(value)
+                new.append(value)
+        if new:
+            with open(self.path, "ab") as file:
+                file.truncate(self.size)
+                data = "".join(f"{value}\n" for value in new).encode()
+                file.write(data)
+            self.size += len(data)
+        return [self.codes[value] for value in values]
+
+
+class ColumnarLedger:
+    """An append-only ledger kept as one binary file per column in a directory such as records.ledger.
+
+    Times are int64 seconds from the epoch, amounts int64, and users, transaction types and accounts
+    int codes of interned strings. Statements memory-map the columns and select rows with numpy, so
+    no text is parsed. An index file holds the row numbers sorted by user for the rows written when it
+    was built. Rows written since are found by scanning the user column, and once there are more than
+    reindex_after of them the index is built again.
+    """
+
+    reindex_after = 100_000
+
+    def __init__(self, path="records.ledger"):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.lock_path = os.path.join(path, "ledger.lock")
+        self.index_path = os.path.join(path, "index.i8")
+        self.lock = threading.Lock()
+        self.strings = {column: Strings(os.path.join(path, name)) for column, name in STRINGS.items()}
+        self.index = None
+        self.index_stamp = None
+        # the memory maps of the columns, kept until rows are written past their end
+        self.maps = {}
+
+    def _column_path(self, column):
+        return os.path.join(self.path, f"{column}.{COLUMNS[column]}")
+
+    def __len__(self):
+        """Returns the number of rows written to every column. A torn append only counts once it is finished."""
+        import numpy
+
+        counts = []
+        for column, dtype in COLUMNS.items():
+            try:
+                counts.append(os.path.getsize(self._column_path(column)) // numpy.dtype(dtype).itemsize)
+            except FileNotFoundError:
+                counts.append(0)
+        return min(counts)
+
+    def _read(self, column, count):
+        """Returns the first count values of a column, memory-mapped."""
+        import numpy
+
+        if count == 0:
+            return numpy.zeros(0, COLUMNS[column])
+        mapped = self.maps.get(column)
+        if mapped is None or len(mapped) < count:
+            mapped = numpy.memmap(self._column_path(column), dtype=COLUMNS[column], mode="r", shape=(count,))
+            self.maps[column] = mapped
+        return mapped[:count]
+
+    def _refresh_strings(self):
+        with self.lock:
+            for strings in self.strings.values():
+                strings.refresh()
+
+    @metrics.timed("ledger_seconds", format="columnar", operation="append")
+    def append_many(self, rows):
+        """Appends rows (dicts with the FIELDS keys) to the ledger."""
+        import numpy
+
+        rows = list(rows)
+        with locking.FileLock(self.lock_path):
+            with self.lock:
+                values = {
+                    column: self.strings[column].intern([row[column] for row in rows])
+                    for column in ("user", "transaction")
+                }
+                names = [row["account"] for row in rows if row["account"]]
+                codes = iter(self.strings["account"].intern(names))
+            values["account"] = [next(codes) if row["account"] else -1 for row in rows]
+            values["time"] = [_timestamp(row) for row in rows]
+            values["amount"] = [int(row["amount"]) for row in rows]
+            count = len(self)
+            for column, dtype in COLUMNS.items():
+                with open(self._column_path(column), "ab") as file:
+                    # cut off what a crash in the middle of an append left behind
+                    file.truncate(count * numpy.dtype(dtype).itemsize)
+                    file.write(numpy.asarray(values[column], dtype).tobytes())
+        metrics.count("ledger_bytes_written_total", len(rows) * ROW_BYTES, format="columnar")
+        return rows
+
+    def append(self, row):
+        return self.append_many([row])[0]
+
+    def reindex(self):
+        """Sorts the row numbers of every row written so far by user into the index file."""
+        import numpy
+
+        with locking.FileLock(self.lock_path):
+            count = len(self)
+            self._refresh_strings()
+            users = self._read("user", count)
+            order = numpy.argsort(users, kind="stable")
+            starts = numpy.zeros(len(self.strings["user"].values) + 1, "i8")
+            numpy.cumsum(numpy.bincount(users, minlength=len(starts) - 1), out=starts[1:])
+            descriptor, temp_path = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+            with os.fdopen(descriptor, "wb") as file:
+                file.write(numpy.array([count, len(starts) - 1], "i8").tobytes())
+                file.write(starts.tobytes())
+                file.write(order.astype("i8").tobytes())
+            os.replace(temp_path, self.index_path)
+
+    def _load_index(self):
+        """Returns the number of rows the index covers, where each user starts in it and the sorted row numbers."""
+        import numpy
+
+        try:
+            status = os.stat(self.index_path)
+        except FileNotFoundError:
+            return 0, numpy.zeros(1, "i8"), numpy.zeros(0, "i8")
+        stamp = (status.st_ino, status.st_mtime_ns)
+        if stamp != self.index_stamp:
+            index = numpy.memmap(self.index_path, dtype="i8", mode="r")
+            covered, users = int(index[0]), int(index[1])
+            self.index = covered, index[2:users + 3], index[users + 3:users + 3 + covered]
+            self.index_stamp = stamp
+        return self.index
+
+    def _positions(self, code, count):
+        """Returns the row numbers of one user's rows, in order."""
+        import numpy
+
+        covered, starts, order = self._load_index()
+        if count - covered > self.reindex_after:
+            self.reindex()
+            covered, starts, order = self._load_index()
+        indexed = order[starts[code]:starts[code + 1]] if code + 1 < len(starts) else order[:0]
+        tail = numpy.flatnonzero(self._read("user", count)[covered:] == code) + covered
+        return numpy.concatenate([indexed, tail])
+
+    def _to_rows(self, positions, count):
+        columns = {column: self._read(column, count)[positions].tolist() for column in COLUMNS}
+        users, transactions, accounts = (self.strings[column].values for column in STRINGS)
+        rows = []
+        for time, amount, user, transaction, account in zip(*columns.values()):
+            now = dt.datetime(1970, 1, 1) + dt.timedelta(seconds=time)
+            rows.append({
+                "user": users[user],
+                "time": f"{now.hour}:{now.minute}",
+                "date": f"{now.date()}",
+                "transaction": transactions[transaction],
+                "amount": amount,
+                "account": accounts[account] if account >= 0 else None,
+            })
+        return rows
+
+    def mark(self):
+        """Returns the number of rows written so far. Reads given it as upto ignore any written later."""
+        return len(self)
+
+    def last_date(self):
+        """Returns the latest date of any row, such as 2022-09-12, or None if there are no rows."""
+        count = len(self)
+        if count == 0:
+            return None
+        latest = dt.datetime(1970, 1, 1) + dt.timedelta(seconds=int(self._read("time", count).max()))
+        return f"{latest.date()}"
+
+    def _select(self, user, start, end, transactions, upto):
+        """Returns the row numbers of the rows of one user that match, in order, and the rows read."""
+        import numpy
+
+        # strings are written before the rows that use them, so count the rows first
+        count = len(self) if upto is None else min(upto, len(self))
+        self._refresh_strings()
+        code = self.strings["user"].codes.get(user)
+        if code is None or count == 0:
+            return numpy.zeros(0, "i8"), count
+        positions = self._positions(code, count)
+        if start is not None or end is not None:
+            times = self._read("time", count)[positions]
+            keep = numpy.ones(len(positions), bool)
+            if start is not None:
+                keep &= times >= _day(start)
+            if end is not None:
+                keep &= times < _day(end) + 86400
+            positions = positions[keep]
+        if transactions:
+            codes = [self.strings["transaction"].codes.get(transaction, -1) for transaction in transactions]
+            positions = positions[numpy.isin(self._read("transaction", count)[positions], codes)]
+        return positions, count
+
+    @metrics.timed("ledger_seconds", format="columnar", operation="read")
+    def rows_for(self, user, start=None, end=None, transactions=None, upto=None):
+        """Returns the rows of one user, optionally only between two dates and of some transaction types."""
+        positions, count = self._select(user, start, end, transactions, upto)
+        metrics.count("ledger_bytes_read_total", len(positions) * ROW_BYTES, format="columnar")
+        return self._to_rows(positions, count)
+
+    @metrics.timed("ledger_seconds", format="columnar", operation="page")
+    def page_for(self, user, start=None, end=None, transactions=None, after=None, size=100, upto=None):
+        """Returns up to size of the rows of one user written after row number after, as rows_for does.
+
+        Also returns the row number to pass as after for the rows that follow, or None if there are no more.
+        """
+        import numpy
+
+        positions, count = self._select(user, start, end, transactions, upto)
+        if after is not None:
+            positions = positions[numpy.searchsorted(positions, after, side="right"):]
+        cursor = int(positions[size - 1]) if len(positions) > size else None
+        positions = positions[:size]
+        metrics.count("ledger_bytes_read_total", len(positions) * ROW_BYTES, format="columnar")
+        return self._to_rows(positions, count), cursor
+
+    def rows(self, upto=None, chunk=100_000):
+        """Yields every row of the ledger in the order they were written."""
+        import numpy
+
+        count = len(self) if upto is None else min(upto, len(self))
+        self._refresh_strings()
+        for start in range(0, count, chunk):
+            yield from self._to_rows(numpy.arange(start, min(start + chunk, count)), count)
+
+    def close(self):
+        pass
+
+
+def open_ledger(path):
+    return ColumnarLedger(path) if path.rstrip("/").endswith(".ledger") else Ledger(path)
+
+
+def convert(source, destination, chunk=100_000):
+    """Copies every row of a ledger into another, e.g. records.csv into records.ledger. Returns the number copied."""
+    source, destination = open_ledger(source), open_ledger(destination)
+    count = 0
+    rows = []
+    for row in source.rows():
+        rows.append(row)
+        if len(rows) == chunk:
+            destination.append_many(rows)
+            count += len(rows)
+            rows = []
+    if rows:
+        destination.append_many(rows)
+        count += len(rows)
+    if isinstance(destination, ColumnarLedger):
+        destination.reindex()
+    source.close()
+    destination.close()
+    return count
+
+
+_ledgers = {}
+
+
+def get_ledger(path=None):
+    """Returns the ledger for a records path, creating it on first use."""
+    path = path or settings.RECORDS
+    if path not in _ledgers:
+        _ledgers[path] = open_ledger(path)
+    return _ledgers[path]
+
+
+if __name__ == "__main__":
+    # Usage: python ledger.py records.csv records.ledger, or the other way round
+    print(f"Copied {convert(*sys.argv[1:3]):,} rows.")
@@ -0,0 +1,160 @@
+"""This module contains the load test client of the JSON API in server.py.
+
+    python loadtest.py --spawn --members 10000 --sessions 2000 --requests 20
+
+Every session is a coroutine with its own keep-alive connection that logs in as a generated member,
+then uses the session token it was given to send a mix of balance, deposit, withdraw, transfer and statement requests. With --spawn a dataset
+is generated (see datagen.py) and a server is started on it; otherwise the server at --host and
+--port is used, and it must serve a dataset generated with the same --members.
+
+Spawned servers use the SQLite engine unless --engine json is given. The JSON engine rereads the whole
+file whenever another request changed it, so it is only suited to small member counts.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import bench
+import datagen
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# How often each request is sent, out of 100.
+MIX = {"balance": 40, "deposit": 20, "withdraw": 10, "transfer": 20, "statement": 10}
+
+
+class Connection:
+    """A keep-alive HTTP/1.1 connection to the server."""
+
+    def __init__(self, host, port, email):
+        self.host = host
+        self.port = port
+        self.authorization = "Basic " + base64.b64encode(f"{email}:{datagen.PASSWORD}".encode()).decode()
+        self.reader = self.writer = None
+
+    async def request(self, method, path, payload=None):
+        """Sends a request and returns the status and JSON payload of the response."""
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        body = json.dumps(payload).encode() if payload is not None else b""
+        self.writer.write(
+            f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nAuthorization: {self.authorization}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        await self.writer.drain()
+        head = (await self.reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+        headers = dict(line.lower().split(": ", 1) for line in head[1:] if line)
+        payload = json.loads(await self.reader.readexactly(int(headers["content-length"])))
+        return int(head[0].split(" ")[1]), payload
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def session(host, port, members, requests, seed, timings, failures):
+    rng = random.Random(seed)
+    connection = Connection(host, port, datagen.email(rng.randrange(members)))
+    operations = list(MIX)
+    weights = list(MIX.values())
+    try:
+        for operation in ["login", *rng.choices(operations, weights, k=requests)]:
+            match operation:
+                case "login" | "deposit" | "withdraw":
+                    payload = {"amount": rng.randint(1, 1000)} if operation != "login" else None
+                    call = ("POST", f"/{operation}", payload)
+                case "transfer":
+                    account_number = datagen.account_number(rng.randrange(members))
+                    call = ("POST", "/transfer", {"amount": rng.randint(1, 1000), "account_number": account_number})
+                case _:
+                    call = ("GET", f"/{operation}", None)
+            started = time.perf_counter()
+            status, payload = await connection.request(*call)
+            if operation == "login" and status == 200:
+                connection.authorization = f"Bearer {payload['token']}"
+            timings.setdefault(operation, []).append(time.perf_counter() - started)
+            # insufficient funds is an answer, anything else is a failure
+            if status >= 500 or status in (401, 404):
+                failures[operation] = failures.get(operation, 0) + 1
+    except (OSError, asyncio.IncompleteReadError) as error:
+        failures[type(error).__name__] = failures.get(type(error).__name__, 0) + 1
+    finally:
+        connection.close()
+
+
+async def load(host, port, members, sessions, requests, seed):
+    timings = {}
+    failures = {}
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(session(host, port, members, requests, seed + number, timings, failures) for number in range(sessions))
+    )
+    return timings, failures, time.perf_counter() - started
+
+
+def spawn(arguments):
+    """Starts a server on a generated dataset. Returns the server process."""
+    directory = os.path.join(arguments.data_dir, f"{arguments.engine}-{arguments.members}-{arguments.ledger_rows}")
+    if not os.path.exists(bench.database_path(directory, arguments.engine)):
+        print(f"Generating {arguments.members:,} members in {directory}...")
+        datagen.generate(directory, arguments.members, arguments.ledger_rows, arguments.engine)
+    process = subprocess.Popen(
+        [sys.executable, "main.py", "serve", "--host", arguments.host, "--port", str(arguments.port)],
+        env=bench.environment(directory, arguments.engine), cwd=HERE, stdout=subprocess.PIPE, text=True,
+    )
+    # the server says so once it is listening
+    process.stdout.readline()
+    return process
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the portal's JSON API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--members", type=int, default=1000, help="members in the dataset the server serves")
+    parser.add_argument("--sessions", type=int, default=1000, help="members connected at the same time")
+    parser.add_argument("--requests", type=int, default=20, help="requests sent by each session after login")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--spawn", action="store_true", help="generate a dataset and start a server on it")
+    parser.add_argument("--ledger-rows", type=int, default=100_000)
+    parser.add_argument("--engine", choices=["json", "sqlite"], default="sqlite")
+    parser.add_argument("--data-dir", default=os.path.join(HERE, "bench_data"))
+    arguments = parser.parse_args(argv)
+
+    # every session holds a socket open
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, min(hard, arguments.sessions + 256)), hard))
+
+    process = spawn(arguments) if arguments.spawn else None
+    try:
+        timings, failures, elapsed = asyncio.run(load(
+            arguments.host, arguments.port, arguments.members, arguments.sessions, arguments.requests, arguments.seed
+        ))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    total = sum(len(values) for values in timings.values())
+    print(f"{total:,} requests from {arguments.sessions:,} sessions in {elapsed:.2f} s: {total / elapsed:,.1f}/s")
+    for operation, values in sorted(timings.items()):
+        print(
+            f"{operation:>10}: {len(values):>8,} requests  p50 {bench.percentile(values, 0.50) * 1000:>9.3f} ms  "
+            f"p99 {bench.percentile(values, 0.99) * 1000:>9.3f} ms  failures {failures.get(operation, 0)}"
+        )
+    for name, count in failures.items():
+        if name not in timings:
+            print(f"{name:>10}: {count} sessions dropped")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,40 @@
+"""This module contains the file locks that let several portal processes share the bank's data files."""
+
+import contextlib
+import fcntl
+import os
+import zlib
+
+import metrics
+import settings
+
+
+class FileLock:
+    """An flock lock on a file. Every acquisition opens its own descriptor, so threads exclude each other too."""
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "a")
+        with metrics.timer("lock_wait_seconds"):
+            fcntl.flock(self.file, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+
+@contextlib.contextmanager
+def account_locks(directory, emails):
+    """Holds the locks of some accounts. Accounts share one of a fixed number of stripes, taken in order."""
+    os.makedirs(directory, exist_ok=True)
+    stripes = sorted({zlib.crc32(email.encode()) % settings.LOCK_STRIPES for email in emails})
+    with contextlib.ExitStack() as stack:
+        for stripe in stripes:
+            stack.enter_context(FileLock(os.path.join(directory, f"{stripe}.lock")))
+        yield
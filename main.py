@@ -1,5 +1,27 @@
+import importlib
 import os
+import sys
+
+# Subcommands that run without the menu, e.g. python main.py batch payroll.csv
+COMMANDS = {
+    "accrue": "accrual",
+    "balances": "balances",
+    "batch": "batch",
+    "onboard": "onboard",
+    "serve": "server",
+    "statement": "statements",
+}
+
+if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+    sys.exit(importlib.import_module(COMMANDS[sys.argv[1]]).main(sys.argv[2:]))
+
+# python main.py --script answers.txt answers the menu from a file, one answer per line, as does
+# piping answers to python main.py. The menu ends when the answers run out.
+if len(sys.argv) > 2 and sys.argv[1] == "--script":
+    sys.stdin = open(sys.argv[2])
+
 from utilities import start
 
-os.system("clear")
+if sys.stdin.isatty():
+    os.system("clear")
 start()
@@ -1,74 +1,130 @@
 """This module contains the classes used to create members of the bank."""
 
-import json
 import datetime as dt
-import pandas
+import re
+import metrics
+import settings
+from fraud import get_rules
+from ledger import get_ledger, new_row
+from passwords import hash_password, needs_rehash, verify
+from sessions import get_sessions
+from statements import print_statement, statement
+from storage import ConflictError, allocate_account_number, allocate_member_id, get_account_numbers, get_storage
+
+
+BUSY = "Sorry, the bank is busy. Please try again.😓"
+INVALID_INPUTS = "Sorry, invalid inputs!! Make sure to fill all fields correctly!!🤬😡"
+INVALID_AMOUNT = "Sorry, invalid amount!!😡"
+
+
+class BankError(Exception):
+    """Raised when a request breaks one of the bank's rules. The message is meant for the member."""
+
+
+def check_operation(operation, amount, balance, recipient=None):
+    """Checks a deposit, withdraw or transfer against the bank's rules. Raises BankError if it breaks one.
+
+    balance is the member's before it, and recipient the account a transfer is sent to or None if it was not found.
+    The portal, batches and group commit all check operations with this, so they refuse the same ones.
+    """
+    if operation not in ("deposit", "withdraw", "transfer"):
+        raise BankError("Sorry, invalid input!!🤬😡")
+    if amount <= 0:
+        raise BankError(INVALID_AMOUNT)
+    if operation == "deposit" and amount > settings.MAX_DEPOSIT:
+        raise BankError(f"Sorry, you can't deposit more than N{settings.MAX_DEPOSIT:,} at a time.❌")
+    if operation != "deposit" and amount > balance:
+        raise BankError("Sorry, insufficient funds.😡🤬")
+    if operation == "transfer" and recipient is None:
+        raise BankError("Sorry, account number not found.😓")
 
 
 class Person:
+    """A member of the bank.
+
+    Calling the class opens an account for a new member: it checks the fields and saves them. Members
+    already in the database are loaded with from_storage instead, which does neither.
+    """
+
+    # a session keeps a member for every logged-in user, so they are kept without a __dict__
+    __slots__ = ("name", "password", "email", "id", "role")
+
     def __init__(self, name=None, password=None, email=None):
         if not name or not password:
             raise TypeError("Sorry, all fields are required!")
         self.name = name
         self.password = password
         self.email = email
+        self.id = None
+
+    @classmethod
+    def from_storage(cls, detail):
+        """Returns the member saved as detail, without reading or writing anything."""
+        member = cls.__new__(cls)
+        member.name = detail["name"]
+        member.password = detail["password"]
+        member.email = detail["email"]
+        member.id = detail.get("id")
+        member.role = detail["role"]
+        return member
 
     def save_to_database(self, new_detail, email):
         """A method that saves a newly created instance to the database"""
-        try:
-            with open("database.json", "r") as database:
-                details = json.load(database)
-                # This condition is to avoid creating a new user in the database via the login function
-                if email in details:
-                    return
-
-        except FileNotFoundError:
-            with open("database.json", "x") as database:
-                json.dump(new_detail, database, indent=4)
-        else:
-            details.update(new_detail)
-            with open("database.json", "w") as database:
-                json.dump(details, database, indent=4)
-
-        with open("member_count.txt") as file:
-            member_id = file.read()
-
-        with open("member_count.txt", "w") as file:
-            file.write(f"{int(member_id) + 1}")
+        storage = get_storage()
+        if storage.contains(email):
+            raise BankError("Sorry, this email already exists in our database. Please use another email.🙁")
+
+        self.id = new_detail[email]["id"] = allocate_member_id()
+        # the email or account number was taken since they were checked
+        if not storage.insert(new_detail[email]):
+            raise BankError("Sorry, the account could not be opened. Please try again.😓")
+
+    def set_password(self, new_password):
+        if not new_password:
+            raise BankError(INVALID_INPUTS)
+        password = hash_password(new_password)
+        get_storage().update(self.email, {"password": password})
+        self.password = password
 
     def change_password(self):
         new_password = input("Type new password: ")
         new_password2 = input("Confirm new password: ")
-        database = pandas.read_json("database.json")
 
         if new_password != new_password2:
             print("\nSorry, passwords do not match!!😡")
             return False
 
-        with open("database.json", "w") as file:
-            database = database.to_dict()
-            database[self.email]["password"] = new_password
-            json.dump(database, file, indent=4)
-            print("\n Password changed successfully.🙂")
-            return True
+        try:
+            self.set_password(new_password)
+        except BankError as error:
+            print(f"\n{error}")
+            return False
+        print("\n Password changed successfully.🙂")
+        return True
 
 
 class Official(Person):
+    __slots__ = ("salary",)
+
+    SALARY = 100_000
+
     def __init__(self, name=None, email=None, password=None):
         super().__init__(name, password)
         self.role = "official"
-        name = self.name.replace(" ", "").lower()
-        self.email = email if email else f"{name.lower()}@bank.com"
-        self.salary = 100_000
+        self.email = email if email else official_email(self.name)
+        self.salary = self.SALARY
         self.save_to_database(self.get_detail(), self.email)
 
-    def get_detail(self):
-        with open("member_count.txt") as file:
-            member_id = file.read()
+    @classmethod
+    def from_storage(cls, detail):
+        member = super().from_storage(detail)
+        member.salary = cls.SALARY
+        return member
 
+    def get_detail(self):
         new_detail = {
             self.email: {
-                "id": member_id,
+                "id": self.id,
                 "name": self.name,
                 "email": self.email,
                 "password": self.password,
@@ -79,7 +135,9 @@ class Official(Person):
 
 
 class Customer(Person):
-    def __init__(self, name, email, password, account_type, balance=0):
+    __slots__ = ("balance", "account_type", "account_number")
+
+    def __init__(self, name, email, password, account_type, balance=0, account_number=None):
         super().__init__(name, password)
 
         if not email or not account_type:
@@ -89,31 +147,27 @@ class Customer(Person):
         self.email = email
         self.balance = balance
 
-        now = dt.datetime.now()
-
-        with open("member_count.txt") as file:
-            member_id = file.read()
-
-        account_number = int(
-            f"{now.microsecond}{now.second}{now.hour}"
-            f"{now.weekday()}{now.day}{now.month}{now.year}{member_id}"
-        )
-
-        self.account_number = account_number
-
         if account_type.lower() not in ["current", "savings"]:
             raise Exception("Sorry. Account type not supported.")
 
+        # a new member is given a number unless the caller has reserved one
+        self.account_number = allocate_account_number() if account_number is None else account_number
+
         self.account_type = account_type
         self.save_to_database(self.get_detail(), self.email)
 
-    def get_detail(self):
-        with open("member_count.txt") as file:
-            member_id = file.read()
+    @classmethod
+    def from_storage(cls, detail):
+        member = super().from_storage(detail)
+        member.balance = detail["balance"]
+        member.account_type = detail["account type"]
+        member.account_number = detail["account number"]
+        return member
 
+    def get_detail(self):
         new_detail = {
             self.email: {
-                "id": member_id,
+                "id": self.id,
                 "name": self.name,
                 "email": self.email,
                 "password": self.password,
@@ -126,64 +180,199 @@ class Customer(Person):
         return new_detail
 
     def check_balance(self):
-        database = pandas.read_json("database.json")
-        print(f"\nYour current account balance is N{database[self.email]['balance']}.😊")
+        detail = get_storage().get(self.email)
+        print(f"\nYour current account balance is N{detail['balance']}.😊")
         return
 
-    def transfer(self, amount, account_number):
-        database = pandas.read_json("database.json")
-        query = (database == account_number).any()
-        person = database.loc[:, query]
-
-        # if user has less amount of funds
-        if amount > database[self.email]["balance"]:
-            print(f"\nCurrent user balance is: {database[self.email]['balance']}")
-            print("\nSorry, insufficient funds.😓")
-            return False
+    @metrics.timed("operation_seconds", operation="transfer")
+    def send(self, amount, account_number):
+        """Sends amount to the owner of account_number and returns their details. Raises BankError if it can't."""
+        rules = get_rules()
+        reservation = rules.reserve(self.email, "transfer", amount, account_number)
+        try:
+            return self._send(amount, account_number)
+        except BaseException:
+            rules.release(reservation)
+            raise
+
+    def _send(self, amount, account_number):
+        storage = get_storage()
+        # another process may change either account between reading and committing, so retry
+        for _ in range(settings.COMMIT_RETRIES):
+            sender = storage.get(self.email)
+            person = storage.find_by_account_number(account_number)
+            check_operation("transfer", amount, sender["balance"], person)
+            deltas = {person["email"]: amount}
+            deltas[self.email] = deltas.get(self.email, 0) - amount
+            versions = {detail["email"]: detail.get("version", 0) for detail in (sender, person)}
+            try:
+                storage.commit(deltas, versions)
+            except ConflictError:
+                continue
+            return person
+
+        raise BankError(BUSY)
 
-        # if no account was found matching the account number
-        elif len(person.columns) == 0:
-            print("\nSorry, account number not found.😓")
+    def transfer(self, amount, account_number):
+        try:
+            person = self.send(amount, account_number)
+        except BankError as error:
+            print(f"\n{error}")
             return False
-        else:
-            person = person.squeeze()
 
-            with open("database.json", "w") as file:
-                database = database.to_dict()
-                database[person.email]["balance"] = database[person.email]["balance"] + amount
-                database[self.email]["balance"] = database[self.email]["balance"] - amount
+        print(f"Success!! N{amount} has been sent to {person['name']}!🙂")
+        print(person["name"])
+        return person
 
-                json.dump(database, file, indent=4)
-
-            print(f"Success!! N{amount} has been sent to {database[person.email]['name']}!🙂")
-            print(database[person.email]["name"])
-            return database[person.email]["name"]
+    @metrics.timed("operation_seconds", operation="transact")
+    def post(self, operation, amount):
+        """Deposits or withdraws amount and returns the details read before it. Raises BankError if it can't."""
+        rules = get_rules()
+        reservation = rules.reserve(self.email, operation, amount)
+        try:
+            return self._post(operation, amount)
+        except BaseException:
+            rules.release(reservation)
+            raise
+
+    def _post(self, operation, amount):
+        storage = get_storage()
+        for _ in range(settings.COMMIT_RETRIES):
+            detail = storage.get(self.email)
+            check_operation(operation, amount, detail["balance"])
+            if operation == "deposit":
+                storage.commit({self.email: amount})
+                return detail
+            try:
+                storage.commit({self.email: -amount}, {self.email: detail.get("version", 0)})
+            except ConflictError:
+                continue
+            return detail
+
+        raise BankError(BUSY)
 
     def transact(self, operation, amount):
-        database = pandas.read_json("database.json")
-        with open("database.json", "w") as file:
-            database = database.to_dict()
-            match operation:
-                case "deposit":
-                    database[self.email]["balance"] = database[self.email]["balance"] + amount
-                    json.dump(database, file, indent=4)
-                    print(f"Success!! N{amount} has been deposited to {database[self.email]['name']}!🙂")
-                    return True
-                case "withdraw":
-                    if database[self.email]["balance"] < amount:
-                        json.dump(database, file, indent=4)
-                        print("\nSorry, insufficient funds.😡🤬")
-                        return False
-                    else:
-                        database[self.email]["balance"] = database[self.email]["balance"] - amount
-                        json.dump(database, file, indent=4)
-                        print(f"Success!! here is your N{amount}💵💵! Enjoy!🙂")
-                        return True
-
-    def get_account_statement(self):
         try:
-            records = pandas.read_csv("records.csv")
-        except FileNotFoundError:
-            print("\nSorry, you have not made any transactions.😑")
+            detail = self.post(operation, amount)
+        except BankError as error:
+            print(f"\n{error}")
+            return False
+
+        if operation == "deposit":
+            print(f"Success!! N{amount} has been deposited to {detail['name']}!🙂")
         else:
-            print(records[records.user == self.email])
+            print(f"Success!! here is your N{amount}💵💵! Enjoy!🙂")
+        return True
+
+    def get_account_statement(self, start=None, end=None, transactions=None):
+        print_statement(statement(self.email, start, end, transactions), "\nSorry, you have not made any transactions.😑")
+
+
+@metrics.timed("operation_seconds", operation="login")
+def authenticate(email, password):
+    """Returns the Customer or Official an email and password belong to. Raises BankError if they don't match."""
+    storage = get_storage()
+    if not storage.exists():
+        raise BankError("Sorry, email and password not found. No database!😓")
+    detail = storage.get(email)
+    if detail is None:
+        raise BankError("Sorry, email not found!!😪")
+    if not verify(email, detail["password"], password):
+        raise BankError("Sorry, password incorrect!!😓")
+    # passwords saved in plaintext or with an older cost are hashed again now that the password is known
+    if needs_rehash(detail["password"]):
+        detail["password"] = hash_password(password)
+        storage.update(email, {"password": detail["password"]})
+    return (Customer if detail["role"] == "customer" else Official).from_storage(detail)
+
+
+def validate_customer(name, email, password, account_type):
+    """Raises BankError unless the details of a new customer are filled in correctly."""
+    # a line break would split the member's rows in the ledger
+    if not re.fullmatch(r"[^\r\n]+[A-Za-z]", name or "") or not email or not password:
+        raise BankError(INVALID_INPUTS)
+    if account_type not in ["current", "savings"]:
+        raise BankError(INVALID_INPUTS)
+
+
+def open_customer_account(name, email, password, account_type):
+    """Opens an account for a new customer and returns them. Raises BankError if it can't."""
+    name, email = str(name or "").title(), str(email or "").lower()
+    validate_customer(name, email, password, account_type)
+    if get_storage().contains(email):
+        raise BankError("Sorry, this email already exists in our database. Please use another email.🙁")
+    return Customer(name, email, hash_password(password), account_type)
+
+
+def official_email(name, suffix=""):
+    """Returns the email an official of a name is given: the name without spaces, at bank.com."""
+    return f"{name.replace(' ', '').lower()}{suffix}@bank.com"
+
+
+def open_official_account(name, password):
+    """Opens an account for a new official and returns them. Raises BankError if it can't."""
+    name = str(name or "").title()
+    if not name or not password:
+        raise BankError(INVALID_INPUTS)
+    email = official_email(name)
+    # if email already exists in the company
+    if get_storage().contains(email):
+        email = official_email(name, dt.datetime.now().second)
+    return Official(name, email=email, password=hash_password(password))
+
+
+def edit_customer(email, changes):
+    """Checks and saves changes to the details of a member. Raises BankError if one is not allowed.
+
+    Returns the member's email, as changed.
+    """
+    storage = get_storage()
+    detail = storage.get(email)
+    if detail is None:
+        raise BankError("Sorry, email not found!!😓")
+    changes = dict(changes)
+    for key, value in changes.items():
+        match key:
+            case "account number" | "balance":
+                try:
+                    changes[key] = int(value)
+                except (TypeError, ValueError):
+                    raise BankError("Sorry, invalid input.😡🤬")
+                if key == "account number" and storage.find_by_account_number(changes[key]) is not None:
+                    raise BankError("Sorry, this account number already exists.😡🤬")
+                if key == "account number" and get_account_numbers().may_allocate(changes[key]):
+                    # it would be given to a new account later, which could then not be saved
+                    raise BankError("Sorry, this account number is kept for new accounts.😡🤬")
+            case "account type":
+                if value not in ["savings", "current"]:
+                    raise BankError("Sorry, invalid account type.😡🤬")
+            case "role":
+                if value not in ["official", "customer"]:
+                    raise BankError("Sorry, invalid user role.😡🤬")
+            case "name":
+                changes[key] = str(value)
+                if "\r" in changes[key] or "\n" in changes[key]:
+                    raise BankError("Sorry, invalid name.😡🤬")
+            case "email":
+                changes[key] = str(value).lower()
+                if storage.contains(changes[key]):
+                    raise BankError("Sorry, this email already exists in our database.😡🤬")
+            case _:
+                raise BankError("Sorry, invalid input!!🤬😡")
+    storage.update(email, changes)
+    # the member has to log in again to pick up their new details
+    get_sessions().close_member(email)
+
+    # keep the ledger in step with the balance, so replaying it still gives the balance
+    rows = []
+    balance = detail.get("balance") or 0
+    if "balance" in changes and changes["balance"] != balance:
+        rows.append(new_row(email, "adjustment", changes["balance"] - balance))
+        balance = changes["balance"]
+    new_email = changes.get("email", email)
+    if new_email != email and balance:
+        # the history stays under the old email, so its balance is moved to the new one
+        rows += [new_row(email, "adjustment", -balance, new_email), new_row(new_email, "adjustment", balance, email)]
+    if rows:
+        get_ledger().append_many(rows)
+    return new_email
@@ -0,0 +1,186 @@
+"""This module contains the counters and timers of the portal's hot paths.
+
+Metrics are kept per process while BANK_PORTAL_METRICS is 1, and served by the JSON API on
+GET /metrics in the Prometheus text format, or as JSON with ?format=json. They cover:
+
+    bank_portal_operation_seconds          login, transfer, transact and record
+    bank_portal_storage_seconds            database reads and writes, by engine
+    bank_portal_storage_bytes_*_total      bytes of database.json and its journal read and written
+    bank_portal_ledger_seconds             ledger reads and appends
+    bank_portal_ledger_bytes_*_total       bytes of the ledger read and written
+    bank_portal_lock_wait_seconds          time spent waiting for file locks
+    bank_portal_cache_*_total              account cache hits, misses, invalidations and evictions
+    bank_portal_credential_cache_*_total   logins accepted without hashing the password again, and not
+    bank_portal_group_commit_*_total       batches committed together and the operations in them
+    bank_portal_fraud_rejections_total     operations refused by the fraud rules, by rule
+    bank_portal_request_seconds            API requests, by route
+    bank_portal_requests_total             API responses, by route and status
+
+Timers are histograms. When metrics are off, a timed function costs one extra call and a check of
+enabled, so they can be left on in production.
+"""
+
+import bisect
+import contextlib
+import functools
+import json
+import threading
+import time
+
+import settings
+
+PREFIX = "bank_portal_"
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+enabled = settings.METRICS
+
+_lock = threading.Lock()
+_counters = {}
+_timers = {}
+_collectors = []
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def count(name, amount=1, **labels):
+    """Adds amount to a counter."""
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def _observe(key, seconds):
+    with _lock:
+        timer = _timers.get(key)
+        if timer is None:
+            # the count of each bucket, then the number and sum of all observations
+            timer = _timers[key] = [0] * (len(BUCKETS) + 2) + [0.0]
+        timer[bisect.bisect_left(BUCKETS, seconds)] += 1
+        timer[-2] += 1
+        timer[-1] += seconds
+
+
+def observe(name, seconds, **labels):
+    """Adds a duration to a timer."""
+    if enabled:
+        _observe(_key(name, labels), seconds)
+
+
+def timed(name, **labels):
+    """Decorates a function to time its calls."""
+    key = _key(name, labels)
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _observe(key, time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """Times a block of code."""
+    if not enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _observe(_key(name, labels), time.perf_counter() - started)
+
+
+def collector(function):
+    """Registers a function that yields (name, labels, value) for counters kept elsewhere, read on export."""
+    _collectors.append(function)
+    return function
+
+
+def _collected():
+    counters = {}
+    for function in _collectors:
+        for name, labels, value in function():
+            key = _key(name, labels)
+            counters[key] = counters.get(key, 0) + value
+    return counters
+
+
+def snapshot():
+    """Returns the counters and timers as a JSON-ready dict."""
+    with _lock:
+        counters = dict(_counters)
+        timers = {key: list(timer) for key, timer in _timers.items()}
+    counters.update(_collected())
+    return {
+        "counters": [
+            {"name": PREFIX + name, "labels": dict(labels), "value": value}
+            for (name, labels), value in sorted(counters.items())
+        ],
+        "timers": [
+            {
+                "name": PREFIX + name,
+                "labels": dict(labels),
+                "count": timer[-2],
+                "sum": timer[-1],
+                "buckets": dict(zip([*map(str, BUCKETS), "+Inf"], timer[:-2])),
+            }
+            for (name, labels), timer in sorted(timers.items())
+        ],
+    }
+
+
+def _labels(labels, **more):
+    pairs = [*labels.items(), *more.items()]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f"{name}={json.dumps(str(value))}" for name, value in pairs) + "}"
+
+
+def prometheus():
+    """Returns the counters and timers in the Prometheus text exposition format."""
+    lines = []
+    typed = set()
+    metrics = snapshot()
+    for counter in metrics["counters"]:
+        if counter["name"] not in typed:
+            typed.add(counter["name"])
+            lines.append(f"# TYPE {counter['name']} counter")
+        lines.append(f"{counter['name']}{_labels(counter['labels'])} {counter['value']}")
+    for timer in metrics["timers"]:
+        name, labels = timer["name"], timer["labels"]
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, number in timer["buckets"].items():
+            cumulative += number
+            lines.append(f"{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labels)} {timer['sum']}")
+        lines.append(f"{name}_count{_labels(labels)} {timer['count']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,91 @@
+"""This module contains the bulk onboarding of new customers.
+
+    python main.py onboard members.csv
+
+The file is a CSV with the columns name, email, password and account_type, or a JSONL file with one
+object per line using the same keys. Every row is checked with the rules of opening an account in the
+portal. The valid ones are then saved together: one reservation of member ids, one of account numbers
+and one write of the database, instead of a read and rewrite of each per member.
+"""
+
+import argparse
+
+from batch import read_rows
+from member_factory import BankError, validate_customer
+from passwords import hash_password
+from storage import allocate_account_numbers, allocate_member_ids, get_storage
+
+
+def check(rows, storage):
+    """Checks every row against the rules of opening an account, in order.
+
+    Returns the (name, email, password, account type) of the valid rows and a list of (row number,
+    reason) for the rejected ones.
+    """
+    valid = []
+    rejected = []
+    for number, row in enumerate(rows, start=1):
+        name = str(row.get("name") or "").title()
+        email = str(row.get("email") or "").lower()
+        password = row.get("password")
+        account_type = str(row.get("account_type", row.get("account type")) or "").lower()
+        try:
+            validate_customer(name, email, password, account_type)
+        except BankError:
+            rejected.append((number, "invalid inputs"))
+            continue
+        valid.append((number, (name, email, str(password), account_type)))
+
+    # the database is read once for the whole file, not once per row
+    emails = storage.existing(member[1] for _, member in valid)
+    members = []
+    for number, member in valid:
+        if member[1] in emails:
+            rejected.append((number, "email already exists"))
+            continue
+        emails.add(member[1])
+        members.append(member)
+    return members, sorted(rejected)
+
+
+def open_accounts(rows):
+    """Opens an account for every valid row. Returns the new members' details and the rejections."""
+    storage = get_storage()
+    members, rejected = check(rows, storage)
+    if not members:
+        return [], rejected
+    ids = allocate_member_ids(len(members))
+    account_numbers = allocate_account_numbers(len(members))
+    details = [
+        {
+            "id": str(member_id),
+            "name": name,
+            "email": email,
+            "password": hash_password(password),
+            "role": "customer",
+            "account type": account_type,
+            "account number": account_number,
+            "balance": 0,
+        }
+        for member_id, account_number, (name, email, password, account_type) in zip(ids, account_numbers, members)
+    ]
+    if storage.insert_many(details) < len(details):
+        # another process opened some of these emails since they were checked
+        details = [detail for detail in details if storage.get(detail["email"])["id"] == detail["id"]]
+    return details, rejected
+
+
+def run(path):
+    return open_accounts(read_rows(path))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="main.py onboard", description="Open accounts for a file of new customers.")
+    parser.add_argument("file", help="a .csv or .jsonl file with name, email, password and account_type")
+    arguments = parser.parse_args(argv)
+
+    details, rejected = run(arguments.file)
+    for number, reason in rejected:
+        print(f"Row {number} rejected: {reason}.")
+    print(f"Opened {len(details)} accounts, rejected {len(rejected)}.")
+    return 1 if rejected else 0
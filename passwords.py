@@ -0,0 +1,148 @@
+"""This module contains the hashing and checking of members' passwords.
+
+Passwords are stored as salted scrypt or PBKDF2 hashes from hashlib, with their parameters:
+
+    scrypt$16384$8$1$<salt>$<hash>
+    pbkdf2_sha256$600000$<salt>$<hash>
+
+Anything else is taken to be a plaintext password from before hashing. Those still log in, and are
+rehashed with the current settings when they do, as are hashes made with older parameters.
+
+Deriving a hash is deliberately slow, so each process remembers the logins it verified recently.
+A login with the same email, stored hash and password within BANK_PORTAL_CREDENTIAL_CACHE_TTL
+seconds is accepted without deriving it again. The cache keys are HMACs under a key that never leaves
+the process, so it holds no passwords.
+"""
+
+import base64
+import collections
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+
+import metrics
+import settings
+
+SCHEMES = ("scrypt", "pbkdf2_sha256")
+
+
+def _encode(data):
+    return base64.b64encode(data).decode()
+
+
+def _derive(scheme, password, salt, parameters):
+    if scheme == "scrypt":
+        n, r, p = parameters
+        # scrypt needs 128 * n * r bytes, a little more than OpenSSL allows by default
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=32)
+    (iterations,) = parameters
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+
+
+def current_parameters(scheme=None):
+    scheme = scheme or settings.PASSWORD_SCHEME
+    if scheme == "scrypt":
+        return scheme, (settings.SCRYPT_N, settings.SCRYPT_R, settings.SCRYPT_P)
+    return scheme, (settings.PBKDF2_ITERATIONS,)
+
+
+def hash_password(password, scheme=None, parameters=None):
+    """Returns the salted hash of a password to store, made with the current settings unless given others."""
+    if parameters is None:
+        scheme, parameters = current_parameters(scheme)
+    scheme = scheme or settings.PASSWORD_SCHEME
+    if scheme not in SCHEMES:
+        raise ValueError(f"Unknown password scheme {scheme}.")
+    salt = os.urandom(16)
+    fields = [scheme, *map(str, parameters), _encode(salt), _encode(_derive(scheme, password, salt, parameters))]
+    return "$".join(fields)
+
+
+def _parse(stored):
+    """Returns the scheme, parameters, salt and hash of a stored password, or None if it is plaintext."""
+    scheme, _, rest = str(stored).partition("$")
+    if scheme not in SCHEMES:
+        return None
+    *parameters, salt, digest = rest.split("$")
+    return scheme, tuple(map(int, parameters)), base64.b64decode(salt), base64.b64decode(digest)
+
+
+def needs_rehash(stored):
+    """Returns True if a stored password is plaintext or was hashed with other parameters than the current."""
+    parsed = _parse(stored)
+    return parsed is None or parsed[:2] != current_parameters()
+
+
+class Verified:
+    """The logins verified recently, least recently used first."""
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.key = secrets.token_bytes(32)
+        self.lock = threading.Lock()
+        self.logins = collections.OrderedDict()
+
+    def _key(self, email, stored, password):
+        return hmac.new(self.key, f"{email}\0{stored}\0{password}".encode(), "sha256").digest()
+
+    def seen(self, email, stored, password):
+        if not self.size:
+            return False
+        key = self._key(email, stored, password)
+        with self.lock:
+            expires = self.logins.get(key)
+            if expires is None or expires < time.monotonic():
+                return False
+            self.logins.move_to_end(key)
+            return True
+
+    def add(self, email, stored, password):
+        if not self.size:
+            return
+        key = self._key(email, stored, password)
+        with self.lock:
+            self.logins[key] = time.monotonic() + self.ttl
+            self.logins.move_to_end(key)
+            while len(self.logins) > self.size:
+                self.logins.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.logins.clear()
+
+
+_verified = None
+_verified_lock = threading.Lock()
+
+
+def get_verified():
+    """Returns the verified logins of this process, creating them on first use."""
+    global _verified
+    with _verified_lock:
+        if _verified is None:
+            _verified = Verified(settings.CREDENTIAL_CACHE_TTL, settings.CREDENTIAL_CACHE_SIZE)
+        return _verified
+
+
+def verify(email, stored, password):
+    """Returns True if password is the one stored for a member, hashed or not."""
+    if not stored or not password:
+        return False
+    verified = get_verified()
+    if verified.seen(email, stored, password):
+        metrics.count("credential_cache_hits_total")
+        return True
+    metrics.count("credential_cache_misses_total")
+    parsed = _parse(stored)
+    if parsed is None:
+        matches = hmac.compare_digest(str(stored).encode(), password.encode())
+    else:
+        scheme, parameters, salt, digest = parsed
+        matches = hmac.compare_digest(_derive(scheme, password, salt, parameters), digest)
+    if matches:
+        verified.add(email, stored, password)
+    return matches
@@ -0,0 +1,20 @@
+"""This module contains the plain text views the portal uses to show members and their transactions.
+
+They are built without pandas, so the portal starts without importing it.
+"""
+
+from ledger import FIELDS
+
+
+def format_detail(detail):
+    """Returns the details of a member as aligned lines of text."""
+    width = max(len(key) for key in detail)
+    return "\n".join(f"{key:<{width}}    {value}" for key, value in detail.items())
+
+
+def format_statement(rows, first=0):
+    """Returns ledger rows as a table of text, numbered from first."""
+    table = [["", *FIELDS]]
+    table += [[str(number), *(str(row[field]) for field in FIELDS)] for number, row in enumerate(rows, first)]
+    widths = [max(len(line[column]) for line in table) for column in range(len(table[0]))]
+    return "\n".join("  ".join(cell.rjust(width) for cell, width in zip(line, widths)) for line in table)
@@ -0,0 +1,427 @@
+"""This module contains the JSON API of the portal, served over HTTP with asyncio.
+
+    python main.py serve --host 127.0.0.1 --port 8000
+
+Every connection is a coroutine, so one process serves thousands of members at once. Requests are
+checked by the same Customer and Official methods the menu uses. Those read and write the storage
+engine and the ledger, which block, so they run in a pool of threads.
+
+Members log in once with HTTP Basic auth (email:password) on POST /login, which answers with a
+session token. Later requests send it as "Authorization: Bearer <token>" instead, so the member is not
+looked up again. Basic auth is still accepted on any request. Deposits, withdrawals and transfers are
+committed in groups when BANK_PORTAL_GROUP_COMMIT_SIZE is set, see groupcommit.py. The routes are:
+
+    POST   /accounts                   {"name", "email", "password", "account_type"}
+    POST   /login
+    POST   /logout
+    GET    /balance
+    POST   /deposit                    {"amount"}
+    POST   /withdraw                   {"amount"}
+    POST   /transfer                   {"amount", "account_number"}
+    GET    /statement                  ?start=YYYY-MM-DD&end=YYYY-MM-DD&transaction=deposit&cursor=&size=
+    POST   /password                   {"password"}
+    POST   /admin/officials            {"name", "password"}
+    POST   /admin/customers            {"members": [{"name", "email", "password", "account_type"}, ...]}
+    GET    /admin/customers/<email>    ?cursor=&size=, read from the snapshot, see snapshot.py
+    PATCH  /admin/customers/<email>    {"account_number", "account_type", "role", "balance", "name", "email"}
+    GET    /metrics                    ?format=json, see metrics.py
+
+Statements are sent a page of rows at a time, with "next": the cursor to ask for the following page
+with, or null after the last one (see statements.py). Errors are answered with {"error": message}
+and a 4xx status. /metrics answers in the Prometheus text
+format unless JSON is asked for.
+"""
+
+import argparse
+import asyncio
+import base64
+import binascii
+import concurrent.futures
+import json
+import time
+import traceback
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import metrics
+import settings
+from groupcommit import get_group_commit
+from ledger import get_ledger, new_row, transfer_rows
+from member_factory import (
+    INVALID_AMOUNT,
+    BankError,
+    authenticate,
+    edit_customer,
+    open_customer_account,
+    open_official_account,
+)
+from onboard import open_accounts
+from sessions import get_sessions
+from snapshot import get_snapshot
+from statements import pages
+from storage import get_storage
+
+# The largest request body accepted, in bytes.
+MAX_BODY = 64 * 1024
+
+# The most rows of a statement sent in one response.
+MAX_PAGE_SIZE = 1000
+
+REASONS = {
+    200: "OK",
+    201: "Created",
+    400: "Bad Request",
+    401: "Unauthorized",
+    403: "Forbidden",
+    404: "Not Found",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Request:
+    def __init__(self, method, target, headers, body):
+        url = urlsplit(target)
+        self.method = method
+        self.path = unquote(url.path)
+        self.query = parse_qs(url.query)
+        self.headers = headers
+        try:
+            self.body = json.loads(body) if body.strip() else {}
+        except ValueError:
+            raise HTTPError(400, "Sorry, the request body is not valid JSON.🤬😡")
+        if not isinstance(self.body, dict):
+            raise HTTPError(400, "Sorry, the request body must be a JSON object.🤬😡")
+
+    def field(self, name):
+        # account_number and "account number" both name the same field
+        return self.body.get(name, self.body.get(name.replace("_", " ")))
+
+    def amount(self):
+        amount = self.body.get("amount")
+        if isinstance(amount, bool) or not isinstance(amount, int) or amount <= 0:
+            raise HTTPError(400, INVALID_AMOUNT)
+        return amount
+
+    def page(self):
+        """Returns the cursor and size of the statement page asked for."""
+        try:
+            cursor = int(self.query["cursor"][0]) if "cursor" in self.query else None
+            size = int(self.query.get("size", [settings.STATEMENT_PAGE_SIZE])[0])
+        except ValueError:
+            raise HTTPError(400, "Sorry, invalid cursor or size.🤬😡")
+        if size <= 0 or size > MAX_PAGE_SIZE or (cursor is not None and cursor < 0):
+            raise HTTPError(400, "Sorry, invalid cursor or size.🤬😡")
+        return cursor, size
+
+    def user(self):
+        """Returns the Customer or Official the request is authenticated as."""
+        scheme, _, credentials = self.headers.get("authorization", "").partition(" ")
+        if scheme.lower() == "bearer":
+            user = get_sessions().get(credentials.strip())
+            if user is None:
+                raise HTTPError(401, "Sorry, your session has ended. Please login again.")
+            return user
+        try:
+            email, _, password = base64.b64decode(credentials, validate=True).decode().partition(":")
+        except (binascii.Error, UnicodeDecodeError):
+            email = password = ""
+        if scheme.lower() != "basic" or not email or not password:
+            raise HTTPError(401, "Sorry, please login to authorize transaction.")
+        try:
+            return authenticate(email.lower(), password)
+        except BankError as error:
+            raise HTTPError(401, str(error))
+
+    def customer(self):
+        user = self.user()
+        if user.role != "customer":
+            raise HTTPError(403, "Sorry, only customers have accounts!😡")
+        return user
+
+    def official(self):
+        user = self.user()
+        if user.role != "official":
+            raise HTTPError(403, "Sorry, you don't have access to this portal!😡🤬")
+        return user
+
+
+def public(detail):
+    """Returns the details of a member without their password."""
+    return {key: value for key, value in detail.items() if key != "password"}
+
+
+def balance_of(user):
+    return {"balance": get_storage().get(user.email)["balance"]}
+
+
+def open_account(request):
+    user = open_customer_account(
+        request.field("name"), request.field("email"), request.field("password"), request.field("account_type")
+    )
+    return 201, {"email": user.email, "account number": user.account_number}
+
+
+def login(request):
+    user = request.user()
+    detail = public(get_storage().get(user.email))
+    return 200, dict(detail, token=get_sessions().open(user), expires_in=get_sessions().ttl)
+
+
+def logout(request):
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer":
+        get_sessions().close(token.strip())
+    return 200, {}
+
+
+def balance(request):
+    return 200, balance_of(request.customer())
+
+
+def deposit(request):
+    user = request.customer()
+    amount = request.amount()
+    group = get_group_commit()
+    if group is not None:
+        group.submit("deposit", user.email, amount)
+    else:
+        user.post("deposit", amount)
+        get_ledger().append(new_row(user.email, "deposit", amount))
+    return 200, balance_of(user)
+
+
+def withdraw(request):
+    user = request.customer()
+    amount = request.amount()
+    group = get_group_commit()
+    if group is not None:
+        group.submit("withdraw", user.email, amount)
+    else:
+        user.post("withdraw", amount)
+        get_ledger().append(new_row(user.email, "withdrawal", amount))
+    return 200, balance_of(user)
+
+
+def transfer(request):
+    user = request.customer()
+    amount = request.amount()
+    try:
+        account_number = int(request.field("account_number"))
+    except (TypeError, ValueError):
+        raise HTTPError(400, "Sorry, invalid account number!!😡")
+    group = get_group_commit()
+    if group is not None:
+        person = group.submit("transfer", user.email, amount, account_number)
+    else:
+        person = user.send(amount, account_number)
+        get_ledger().append_many(transfer_rows(user.email, user.name, person["email"], person["name"], amount))
+    return 200, dict(balance_of(user), recipient=person["name"])
+
+
+def statement(request):
+    user = request.customer()
+    start = request.query.get("start", [None])[0]
+    end = request.query.get("end", [None])[0]
+    cursor, size = request.page()
+    rows, cursor = next(pages(user.email, start, end, request.query.get("transaction"), cursor, size))
+    return 200, {"rows": rows, "next": cursor}
+
+
+def change_password(request):
+    request.user().set_password(request.field("password"))
+    return 200, {}
+
+
+def admin_open_account(request):
+    request.official()
+    user = open_official_account(request.field("name"), request.field("password"))
+    return 201, {"email": user.email}
+
+
+def admin_open_accounts(request):
+    request.official()
+    members = request.body.get("members")
+    if not isinstance(members, list) or not all(isinstance(member, dict) for member in members):
+        raise HTTPError(400, "Sorry, members must be a list of objects.🤬😡")
+    details, rejected = open_accounts(members)
+    return 201, {
+        "accounts": [{"email": detail["email"], "account number": detail["account number"]} for detail in details],
+        "rejected": [{"row": number, "reason": reason} for number, reason in rejected],
+    }
+
+
+def get_customer_details(request, email):
+    request.official()
+    # read from the snapshot, so officials' views do not hold up tellers
+    view = get_snapshot().current(email.lower())
+    detail = view.get(email.lower())
+    if detail is None:
+        raise HTTPError(404, "Sorry, email not found!!😓")
+    cursor, size = request.page()
+    rows, cursor = next(pages(detail["email"], cursor=cursor, size=size, source=view))
+    return 200, {
+        "detail": public(detail),
+        "rows": rows,
+        "next": cursor,
+        "as_of": view.taken_at.isoformat(timespec="seconds"),
+    }
+
+
+def edit_customer_details(request, email):
+    request.official()
+    changes = {key.replace("_", " "): value for key, value in request.body.items()}
+    if not changes:
+        raise HTTPError(400, "Sorry, invalid input!!🤬😡")
+    return 200, public(get_storage().get(edit_customer(email.lower(), changes)))
+
+
+def show_metrics(request):
+    if request.query.get("format") == ["json"]:
+        return 200, metrics.snapshot()
+    return 200, metrics.prometheus()
+
+
+ROUTES = {
+    ("POST", "/accounts"): open_account,
+    ("POST", "/login"): login,
+    ("POST", "/logout"): logout,
+    ("GET", "/balance"): balance,
+    ("POST", "/deposit"): deposit,
+    ("POST", "/withdraw"): withdraw,
+    ("POST", "/transfer"): transfer,
+    ("GET", "/statement"): statement,
+    ("POST", "/password"): change_password,
+    ("POST", "/admin/officials"): admin_open_account,
+    ("POST", "/admin/customers"): admin_open_accounts,
+    ("GET", "/metrics"): show_metrics,
+}
+
+# Routes that end with a member's email
+MEMBER_ROUTES = {
+    ("GET", "/admin/customers/"): get_customer_details,
+    ("PATCH", "/admin/customers/"): edit_customer_details,
+}
+
+
+def route(method, path):
+    """Returns the function that answers a request, and the email its path ends with for member routes."""
+    if (method, path) in ROUTES:
+        return ROUTES[method, path], None
+    prefix, _, email = path.rpartition("/")
+    if email and (method, f"{prefix}/") in MEMBER_ROUTES:
+        return MEMBER_ROUTES[method, f"{prefix}/"], email
+    raise HTTPError(404, "Sorry, there is nothing here.😓")
+
+
+def handle(method, target, headers, body):
+    """Answers one request. Returns the status and the payload of the response."""
+    started = time.perf_counter()
+    name = "none"
+    try:
+        request = Request(method, target, headers, body)
+        function, email = route(method, request.path)
+        name = function.__name__
+        status, payload = function(request) if email is None else function(request, email)
+    except HTTPError as error:
+        status, payload = error.status, {"error": str(error)}
+    except BankError as error:
+        status, payload = 400, {"error": str(error)}
+    except Exception:
+        traceback.print_exc()
+        status, payload = 500, {"error": "Sorry, something went wrong.😓"}
+    if metrics.enabled:
+        metrics.observe("request_seconds", time.perf_counter() - started, route=name)
+        metrics.count("requests_total", route=name, status=status)
+    return status, payload
+
+
+def response(status, payload, keep_alive):
+    """Encodes a response. A string payload is sent as plain text, anything else as JSON."""
+    if isinstance(payload, str):
+        body, content_type = payload.encode(), "text/plain; version=0.0.4; charset=utf-8"
+    else:
+        body, content_type = json.dumps(payload).encode(), "application/json"
+    head = (
+        f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    return head.encode() + body
+
+
+async def serve_connection(reader, writer):
+    """Answers the requests sent over one connection until the client closes it."""
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                break
+            try:
+                request_line, *lines = head.decode("latin-1").split("\r\n")[:-2]
+                method, target, version = request_line.split(" ", 2)
+                headers = {}
+                for line in lines:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+            except ValueError:
+                writer.write(response(400, {"error": "Sorry, invalid request.🤬😡"}, False))
+                break
+            if length > MAX_BODY or length < 0:
+                writer.write(response(413, {"error": "Sorry, the request is too large.🤬😡"}, False))
+                break
+            try:
+                body = await reader.readexactly(length)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            status, payload = await loop.run_in_executor(None, handle, method, target, headers, body)
+            keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+            writer.write(response(status, payload, keep_alive))
+            await writer.drain()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start(host="127.0.0.1", port=8000, workers=32):
+    """Starts serving in the running event loop and returns the asyncio server."""
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="portal"))
+    # open the storage engine and ledger before the worker threads race to do it
+    get_storage()
+    get_ledger()
+    get_sessions()
+    return await asyncio.start_server(serve_connection, host, port, backlog=4096)
+
+
+async def serve(host, port, workers):
+    server = await start(host, port, workers)
+    print(f"Serving the bank portal on http://{host}:{server.sockets[0].getsockname()[1]}.🙂", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="main.py serve", description="Serve the portal as a JSON API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=32, help="threads that run storage and ledger calls")
+    arguments = parser.parse_args(argv)
+
+    try:
+        asyncio.run(serve(arguments.host, arguments.port, arguments.workers))
+    except KeyboardInterrupt:
+        print("\nThank you and have a nice day.🙂")
+    return 0
@@ -0,0 +1,81 @@
+"""This module contains the sessions that keep members logged in between operations."""
+
+import collections
+import secrets
+import threading
+import time
+
+import settings
+
+
+class Sessions:
+    """Issues an expiring token for each login and holds the Customer or Official it belongs to.
+
+    Sessions are kept least recently used first. Every use moves a session to the end and pushes its
+    expiry back, so expired sessions are always at the front, and the oldest ones are dropped first
+    once there are more than size.
+    """
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        self.sessions = collections.OrderedDict()
+        self.evictions = 0
+
+    def _expire(self, now):
+        """Drops expired sessions and the oldest ones beyond size. Needs the lock."""
+        while self.sessions:
+            token, (user, expires) = next(iter(self.sessions.items()))
+            if expires > now and len(self.sessions) <= self.size:
+                break
+            del self.sessions[token]
+            self.evictions += 1
+
+    def open(self, user):
+        """Starts a session for a logged in member and returns its token."""
+        token = secrets.token_urlsafe(32)
+        now = time.monotonic()
+        with self.lock:
+            self.sessions[token] = (user, now + self.ttl)
+            self._expire(now)
+        return token
+
+    def get(self, token):
+        """Returns the member a token was issued to, or None if the session ended or expired."""
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            session = self.sessions.get(token)
+            if session is None:
+                return None
+            self.sessions[token] = (session[0], now + self.ttl)
+            self.sessions.move_to_end(token)
+            return session[0]
+
+    def close(self, token):
+        with self.lock:
+            self.sessions.pop(token, None)
+
+    def close_member(self, email):
+        """Ends every session of a member, e.g. after an official changed their details."""
+        with self.lock:
+            for token in [token for token, (user, _) in self.sessions.items() if user.email == email]:
+                del self.sessions[token]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.sessions)
+
+
+_sessions = None
+_sessions_lock = threading.Lock()
+
+
+def get_sessions():
+    """Returns the sessions of this process, creating them on first use."""
+    global _sessions
+    with _sessions_lock:
+        if _sessions is None:
+            _sessions = Sessions(settings.SESSION_TTL, settings.SESSION_LIMIT)
+        return _sessions
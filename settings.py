@@ -0,0 +1,71 @@
+"""This module contains the settings used to locate and tune the bank's data files."""
+
+import os
+
+# Paths ending in .sqlite3, .sqlite or .db are served by the SQLite engine, anything else by the JSON engine.
+DATABASE = os.environ.get("BANK_PORTAL_DATABASE", "database.json")
+
+# Number of journaled balance changes after which the JSON database is compacted in the background.
+JOURNAL_COMPACT_THRESHOLD = int(os.environ.get("BANK_PORTAL_JOURNAL_COMPACT_THRESHOLD", 100))
+
+# Accounts are spread over this many lock files, so transfers between unrelated accounts run in parallel.
+LOCK_STRIPES = int(os.environ.get("BANK_PORTAL_LOCK_STRIPES", 64))
+
+# Number of times a transaction is retried when another process changes one of its accounts first.
+COMMIT_RETRIES = int(os.environ.get("BANK_PORTAL_COMMIT_RETRIES", 20))
+
+MEMBER_COUNT = os.environ.get("BANK_PORTAL_MEMBER_COUNT", "member_count.txt")
+# Account numbers are handed out from blocks of ACCOUNT_BLOCK_SIZE, counted in the ACCOUNT_BLOCKS file.
+ACCOUNT_BLOCKS = os.environ.get("BANK_PORTAL_ACCOUNT_BLOCKS", "account_blocks.txt")
+ACCOUNT_BLOCK_SIZE = int(os.environ.get("BANK_PORTAL_ACCOUNT_BLOCK_SIZE", 1000))
+
+RECORDS = os.environ.get("BANK_PORTAL_RECORDS", "records.csv")
+
+# The largest amount that can be deposited at a time.
+MAX_DEPOSIT = 999_999
+
+# Most members each process keeps in its account cache. 0 turns the cache off.
+CACHE_SIZE = int(os.environ.get("BANK_PORTAL_CACHE_SIZE", 100_000))
+
+# Seconds a login stays valid without being used, and the most sessions each process keeps.
+SESSION_TTL = int(os.environ.get("BANK_PORTAL_SESSION_TTL", 15 * 60))
+SESSION_LIMIT = int(os.environ.get("BANK_PORTAL_SESSION_LIMIT", 100_000))
+
+# How passwords are hashed: "scrypt" or "pbkdf2_sha256", with the cost of each. Passwords hashed with
+# other settings are rehashed the next time their member logs in.
+PASSWORD_SCHEME = os.environ.get("BANK_PORTAL_PASSWORD_SCHEME", "scrypt")
+SCRYPT_N = int(os.environ.get("BANK_PORTAL_SCRYPT_N", 2 ** 14))
+SCRYPT_R = int(os.environ.get("BANK_PORTAL_SCRYPT_R", 8))
+SCRYPT_P = int(os.environ.get("BANK_PORTAL_SCRYPT_P", 1))
+PBKDF2_ITERATIONS = int(os.environ.get("BANK_PORTAL_PBKDF2_ITERATIONS", 600_000))
+
+# Seconds a verified login is remembered so the same login is not hashed again, and how many are kept.
+CREDENTIAL_CACHE_TTL = int(os.environ.get("BANK_PORTAL_CREDENTIAL_CACHE_TTL", 5 * 60))
+CREDENTIAL_CACHE_SIZE = int(os.environ.get("BANK_PORTAL_CREDENTIAL_CACHE_SIZE", 100_000))
+
+# Seconds between the copies of the accounts that admin views and reports read, see snapshot.py. 0
+# reads live data every time.
+SNAPSHOT_INTERVAL = int(os.environ.get("BANK_PORTAL_SNAPSHOT_INTERVAL", 60))
+
+# Set to 1 to keep the counters and timers of metrics.py, served on GET /metrics.
+METRICS = os.environ.get("BANK_PORTAL_METRICS", "0") == "1"
+
+# Most deposits, withdrawals and transfers the JSON API commits in one write, and the longest it waits
+# for them in milliseconds, see groupcommit.py. A size of 0 turns group commit off.
+GROUP_COMMIT_SIZE = int(os.environ.get("BANK_PORTAL_GROUP_COMMIT_SIZE", 0))
+GROUP_COMMIT_DELAY_MS = float(os.environ.get("BANK_PORTAL_GROUP_COMMIT_DELAY_MS", 2))
+
+# Rows of a statement read, shown and sent at a time, see statements.py.
+STATEMENT_PAGE_SIZE = int(os.environ.get("BANK_PORTAL_STATEMENT_PAGE_SIZE", 100))
+
+# Yearly interest on savings balances in percent, and the maintenance fee on current accounts in
+# naira, paid and charged once a business date, see accrual.py.
+INTEREST_RATE = float(os.environ.get("BANK_PORTAL_INTEREST_RATE", 3))
+MAINTENANCE_FEE = int(os.environ.get("BANK_PORTAL_MAINTENANCE_FEE", 1))
+
+# The fraud rules checked before deposits, withdrawals and transfers, see fraud.py. Without the file
+# there are none.
+FRAUD_RULES = os.environ.get("BANK_PORTAL_FRAUD_RULES", "fraud_rules.json")
+
+# Rows of an account between balance checkpoints, see balances.py.
+CHECKPOINT_INTERVAL = int(os.environ.get("BANK_PORTAL_CHECKPOINT_INTERVAL", 100))
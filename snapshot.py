@@ -0,0 +1,102 @@
+"""This module contains the read-only snapshot that admin views and reports read instead of live data.
+
+A snapshot is a copy of every member and a mark in the ledger, taken at one moment. The ledger is only
+ever appended to, so the rows before the mark never change and are read in place. Taking a copy holds
+no lock that tellers wait for (see Storage.snapshot), and reading one holds none at all, so a large
+report does not slow down deposits and transfers.
+
+A snapshot is replaced in the background once it is more than BANK_PORTAL_SNAPSHOT_INTERVAL seconds
+old, and readers keep using the old one until the new one is ready. Admin views can therefore be that
+many seconds behind, apart from members opened since, who bring the next copy forward when looked up.
+"""
+
+import datetime as dt
+import threading
+import time
+
+import settings
+from ledger import get_ledger
+from storage import get_storage
+
+
+class View:
+    """The members and the ledger as they were when one copy was taken."""
+
+    def __init__(self, details, ledger, mark, taken_at, taken):
+        self.details = details
+        self.ledger = ledger
+        self.mark = mark
+        self.taken_at = taken_at
+        self.taken = taken
+
+    def get(self, email):
+        """Returns a copy of the details of a member, or None if the email was not in the database."""
+        detail = self.details.get(email)
+        return dict(detail) if detail is not None else None
+
+    def all(self):
+        """Returns every member. They are shared with other readers, so they must not be changed."""
+        return self.details
+
+    def rows_for(self, user, start=None, end=None, transactions=None):
+        return self.ledger.rows_for(user, start, end, transactions, upto=self.mark)
+
+    def page_for(self, user, start=None, end=None, transactions=None, after=None, size=100):
+        return self.ledger.page_for(user, start, end, transactions, after, size, upto=self.mark)
+
+    def rows(self):
+        return self.ledger.rows(upto=self.mark)
+
+
+class Snapshot:
+    def __init__(self, storage, ledger, interval):
+        self.storage = storage
+        self.ledger = ledger
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.view = None
+        self.refreshing = False
+
+    def refresh(self):
+        """Takes a new copy and returns its view."""
+        # rows are appended after their balances are committed, so marking the ledger first keeps every
+        # row before the mark in the copy of the balances
+        taken_at, taken = dt.datetime.now(), time.monotonic()
+        mark = self.ledger.mark()
+        view = View(self.storage.snapshot(), self.ledger, mark, taken_at, taken)
+        with self.lock:
+            if self.view is None or view.taken > self.view.taken:
+                self.view = view
+            self.refreshing = False
+        return view
+
+    def current(self, email=None):
+        """Returns the view of the latest copy, starting a new copy in the background if it is too old.
+
+        If email is given and its member was opened since the copy was taken, a new one is taken now.
+        """
+        view = self.view
+        if view is None or self.interval <= 0:
+            return self.refresh()
+        if email is not None and email not in view.details and self.storage.contains(email):
+            return self.refresh()
+        with self.lock:
+            start = time.monotonic() - view.taken > self.interval and not self.refreshing
+            if start:
+                self.refreshing = True
+        if start:
+            threading.Thread(target=self.refresh, daemon=True).start()
+        return view
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_snapshot(database=None, ledger_path=None):
+    """Returns the snapshot of a database and ledger, creating it on first use."""
+    key = (database or settings.DATABASE, ledger_path or settings.RECORDS)
+    with _snapshots_lock:
+        if key not in _snapshots:
+            _snapshots[key] = Snapshot(get_storage(key[0]), get_ledger(key[1]), settings.SNAPSHOT_INTERVAL)
+        return _snapshots[key]
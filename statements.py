@@ -0,0 +1,104 @@
+"""This module contains account statements, read from the ledger a page at a time.
+
+    python main.py statement member1@bank.test --start 2022-01-01 --end 2022-06-30 --format csv > statement.csv
+
+A statement is never read whole. Each page is up to BANK_PORTAL_STATEMENT_PAGE_SIZE rows of one account,
+found through the ledger's index, and comes with a cursor: the position in the ledger to carry on
+after. The ledger is only ever appended to, so a cursor stays valid however many rows are written
+after it. The API hands the cursor to the client, while the menu, this command and exports keep
+reading pages until there are none left, holding one page in memory at a time.
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import sys
+
+import settings
+from ledger import FIELDS, get_ledger
+from reports import format_statement
+
+
+def pages(user, start=None, end=None, transactions=None, cursor=None, size=None, source=None):
+    """Yields the pages of a user's statement as (rows, cursor of the next page or None).
+
+    source is a ledger or a snapshot's view, the live ledger by default. At least one page is yielded,
+    empty if the user has no rows.
+    """
+    source = source or get_ledger()
+    size = size or settings.STATEMENT_PAGE_SIZE
+    while True:
+        rows, cursor = source.page_for(user, start, end, transactions, cursor, size)
+        yield rows, cursor
+        if cursor is None:
+            return
+
+
+def statement(user, start=None, end=None, transactions=None, cursor=None, size=None, source=None):
+    """Yields the rows of a user's statement in the order they were written, a page at a time."""
+    for rows, _ in pages(user, start, end, transactions, cursor, size, source):
+        yield from rows
+
+
+def write_csv(rows, file):
+    writer = csv.DictWriter(file, fieldnames=FIELDS, lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def write_json(rows, file):
+    """Writes rows as a JSON array, one row per line, without holding them all."""
+    separator = "[\n"
+    for row in rows:
+        file.write(separator + json.dumps(row))
+        separator = ",\n"
+    file.write("[]\n" if separator == "[\n" else "\n]\n")
+
+
+def write_text(rows, file):
+    """Writes rows as tables of text, one per page, numbered on from the one before."""
+    number = 0
+    page = []
+    for row in rows:
+        page.append(row)
+        if len(page) == settings.STATEMENT_PAGE_SIZE:
+            file.write(format_statement(page, number) + "\n")
+            number += len(page)
+            page = []
+    if page or not number:
+        file.write(format_statement(page, number) + "\n")
+
+
+EXPORTS = {"text": write_text, "csv": write_csv, "json": write_json}
+
+
+def print_statement(rows, empty, heading=None):
+    """Prints a statement a page at a time after heading, or empty if it has no rows."""
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        print(empty)
+        return
+    if heading is not None:
+        print(heading)
+    write_text(itertools.chain([first], rows), sys.stdout)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="main.py statement", description="Export the statement of an account.")
+    parser.add_argument("email")
+    parser.add_argument("--start", help="YYYY-MM-DD")
+    parser.add_argument("--end", help="YYYY-MM-DD")
+    parser.add_argument("--transaction", action="append", help="only rows of this type, may be repeated")
+    parser.add_argument("--format", choices=EXPORTS, default="text")
+    parser.add_argument("--output", help="file to write to instead of the terminal")
+    arguments = parser.parse_args(argv)
+
+    rows = statement(arguments.email.lower(), arguments.start, arguments.end, arguments.transaction)
+    if arguments.output is None:
+        EXPORTS[arguments.format](rows, sys.stdout)
+        return 0
+    with open(arguments.output, "w", newline="") as file:
+        EXPORTS[arguments.format](rows, file)
+    return 0
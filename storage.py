@@ -0,0 +1,838 @@
+"""This module contains the storage engines used to persist members of the bank."""
+
+import atexit
+import json
+import os
+import pathlib
+import sqlite3
+import stat
+import sys
+import tempfile
+import threading
+
+import locking
+import metrics
+import settings
+
+SQLITE_EXTENSIONS = (".sqlite3", ".sqlite", ".db")
+
+# Maps the keys used in member details to the columns of the SQLite members table.
+COLUMNS = {
+    "id": "id",
+    "name": "name",
+    "email": "email",
+    "password": "password",
+    "role": "role",
+    "account type": "account_type",
+    "account number": "account_number",
+    "balance": "balance",
+    "version": "version",
+}
+
+
+class ConflictError(Exception):
+    """Raised when an account changed after it was read and before the change to it was committed."""
+
+
+class Storage:
+    """The interface every storage engine implements. Members are dicts keyed by their email."""
+
+    def exists(self):
+        """Returns True if the database has been created."""
+        raise NotImplementedError
+
+    def get(self, email):
+        """Returns the details of a member, or None if the email is not in the database."""
+        raise NotImplementedError
+
+    def contains(self, email):
+        return self.get(email) is not None
+
+    def existing(self, emails):
+        """Returns the set of emails that are already in the database, read at once."""
+        return set(emails) & self.snapshot().keys()
+
+    def all(self):
+        """Returns a dict of every member in the database keyed by email."""
+        raise NotImplementedError
+
+    def snapshot(self):
+        """Returns every member as all() does, as at one moment, without holding up writers meanwhile.
+
+        The JSON engine never locks to read: files are replaced, not rewritten, and the journal is only
+        appended to.
+        """
+        return self.all()
+
+    def find_by_account_number(self, account_number):
+        """Returns the details of the member that owns an account number, or None."""
+        raise NotImplementedError
+
+    def insert(self, detail):
+        """Saves a new member. Returns False if the email already exists."""
+        raise NotImplementedError
+
+    def insert_many(self, details):
+        """Saves many new members in one write. Emails that already exist are skipped. Returns the number saved."""
+        return sum(self.insert(detail) for detail in details)
+
+    def update(self, email, changes):
+        """Changes some details of an existing member."""
+        raise NotImplementedError
+
+    def commit(self, deltas, versions=None):
+        """Adds each amount in deltas ({email: amount}) to the balance of that member in one write.
+
+        If versions ({email: version}) is given, nothing is written and ConflictError is raised unless
+        every one of those members is still at that version. Every committed change bumps the version.
+        """
+        raise NotImplementedError
+
+    def adjust_balances(self, deltas):
+        self.commit(deltas)
+
+    def change_token(self):
+        """Returns a cheap value that changes whenever the data changes. None means changes cannot be seen."""
+        return None
+
+    def is_own_change(self, before, after):
+        """Returns True if the last write of this thread was the only change between two change tokens."""
+        return False
+
+    def close(self):
+        pass
+
+
+class AccountIndex:
+    """A persistent account number to email index kept in SQLite next to a JSON database."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS accounts (account_number TEXT PRIMARY KEY, email TEXT NOT NULL)"
+            )
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def source(self):
+        """Returns the stamp of the database file the index was last synced with."""
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+        return row[0] if row else None
+
+    def _stamp(self, source):
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('source', ?)", (source,))
+
+    def rebuild(self, details, source):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM accounts")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO accounts VALUES (?, ?)",
+                [
+                    (str(detail["account number"]), email)
+                    for email, detail in details.items()
+                    if detail.get("account number") is not None
+                ],
+            )
+            self._stamp(source)
+
+    def lookup(self, account_number):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT email FROM accounts WHERE account_number = ?", (str(account_number),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def change(self, source, add=(), remove=(), rename=None):
+        """Adds (account number, email) pairs, removes account numbers and renames an email in one write."""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "DELETE FROM accounts WHERE account_number = ?", [(str(number),) for number in remove]
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO accounts VALUES (?, ?)", [(str(number), email) for number, email in add]
+            )
+            if rename:
+                self.connection.execute("UPDATE accounts SET email = ? WHERE email = ?", (rename[1], rename[0]))
+            self._stamp(source)
+
+    def close(self):
+        self.connection.close()
+
+
+def _umask():
+    """Returns the process's umask. It can only be read by setting it, so it is set back at once."""
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+class JSONStorage(Storage):
+    """Stores every member in a single JSON file, the original database.json layout.
+
+    Balance changes are appended to a journal next to the file instead of rewriting it. The journal
+    starts with the inode of the file it applies to, so once the file has been atomically replaced
+    by a compaction the old journal is recognised as already folded in and ignored.
+
+    Appending to the journal takes the database lock shared and rewriting the file takes it exclusive.
+    Balance changes also hold the locks of the accounts they touch, so changes to unrelated accounts
+    run in parallel while changes to the same account are checked against its version one at a time.
+
+    The parsed file is kept until it is replaced, along with how much of its journal has been applied,
+    so a read only parses the journal lines appended since the last one.
+    """
+
+    def __init__(self, path="database.json"):
+        self.path = path
+        base = os.path.splitext(path)[0]
+        self.journal_path = f"{base}.journal"
+        self.lock_path = f"{base}.lock"
+        self.account_locks_path = f"{base}.locks"
+        self.index = AccountIndex(f"{base}.index.sqlite3")
+        self.local = threading.local()
+        # the entries in the journal, and how many of them this process appended
+        self.pending = 0
+        self.appended = 0
+        # the members as last read, the stamps of the file and journal they were read from, and the
+        # bytes of the journal applied to them
+        self.state = None
+        self.state_lock = threading.Lock()
+        self.compactor = None
+        atexit.register(self._compact_at_exit)
+
+    def _stamp(self):
+        """Returns a stamp that changes whenever the database file is rewritten."""
+        try:
+            status = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return f"{status.st_mtime_ns}:{status.st_size}"
+
+    def _sync_index(self, details=None):
+        """Rebuilds the account number index if the database was changed behind its back."""
+        stamp = self._stamp()
+        if stamp != self.index.source():
+            self.index.rebuild(self._current() if details is None else details, stamp)
+
+    def _snapshot_id(self):
+        try:
+            return os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return None
+
+    def _journal_snapshot_id(self):
+        """Returns the inode recorded in the journal header, or None if there is no usable journal."""
+        try:
+            with open(self.journal_path) as journal:
+                return json.loads(journal.readline())["snapshot"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def _journal_lines(journal):
+        """Returns the whole lines of a journal from where it is read and how many bytes they take."""
+        data = journal.read()
+        # an append in progress is left for the next read
+        end = data.rfind(b"\n") + 1
+        metrics.count("storage_bytes_read_total", end, engine="json")
+        return data[:end].splitlines(), end
+
+    @staticmethod
+    def _parse_entries(lines):
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # a torn line left by a crash in the middle of an append
+                continue
+        return entries
+
+    def _read_journal(self, snapshot_id):
+        """Returns the balance changes journaled since the database file was last written, the stamp of
+        the journal and the bytes of it read.
+
+        The changes are None if the journal belongs to another version of the file.
+        """
+        try:
+            with open(self.journal_path, "rb") as journal:
+                stamp = os.fstat(journal.fileno()).st_ino
+                lines, end = self._journal_lines(journal)
+        except FileNotFoundError:
+            return [], None, 0
+        try:
+            if not lines or json.loads(lines[0])["snapshot"] != snapshot_id:
+                return None, stamp, end
+        except (ValueError, KeyError):
+            return None, stamp, end
+        return self._parse_entries(lines[1:]), stamp, end
+
+    @staticmethod
+    def _apply(details, entries):
+        for deltas in entries:
+            for email, amount in deltas.items():
+                if email in details:
+                    details[email]["balance"] = details[email]["balance"] + amount
+                    details[email]["version"] = details[email].get("version", 0) + 1
+
+    def _read(self):
+        """Reads the file and its whole journal."""
+        while True:
+            try:
+                with open(self.path) as database:
+                    details = json.load(database)
+                    status = os.fstat(database.fileno())
+                snapshot_id = status.st_ino
+                metrics.count("storage_bytes_read_total", status.st_size, engine="json")
+            except FileNotFoundError:
+                return None
+            entries, journal, offset = self._read_journal(snapshot_id)
+            if entries is None:
+                # the file was compacted while it was being read, so read it again
+                if self._snapshot_id() != snapshot_id:
+                    continue
+                # otherwise the journal was folded into this file before a crash could reset it
+                entries = []
+            break
+        self._apply(details, entries)
+        stamp = (status.st_ino, status.st_size, status.st_mtime_ns)
+        return {"details": details, "stamp": stamp, "journal": journal, "offset": offset, "entries": len(entries)}
+
+    def _catch_up(self, state):
+        """Applies the journal lines appended since state was read. Returns False if it has to be read again."""
+        try:
+            status = os.stat(self.path)
+            journal = open(self.journal_path, "rb")
+        except FileNotFoundError:
+            return False
+        with journal:
+            journal_status = os.fstat(journal.fileno())
+            if (status.st_ino, status.st_size, status.st_mtime_ns) != state["stamp"] \
+                    or journal_status.st_ino != state["journal"] or journal_status.st_size < state["offset"]:
+                return False
+            if journal_status.st_size == state["offset"]:
+                return True
+            journal.seek(state["offset"])
+            lines, end = self._journal_lines(journal)
+        entries = self._parse_entries(lines)
+        self._apply(state["details"], entries)
+        state["offset"] += end
+        state["entries"] += len(entries)
+        return True
+
+    @metrics.timed("storage_seconds", engine="json", operation="read")
+    def _current(self):
+        """Returns every member with the journal applied. They are shared, so they must not be changed."""
+        with self.state_lock:
+            if self.state is None or not self._catch_up(self.state):
+                self.state = self._read()
+            if self.state is None:
+                self.pending = 0
+                return {}
+            self.pending = self.state["entries"]
+            return self.state["details"]
+
+    def _load(self):
+        """Returns a copy of every member with the journal applied."""
+        return {email: dict(detail) for email, detail in self._current().items()}
+
+    @metrics.timed("storage_seconds", engine="json", operation="write")
+    def _replace(self, path, write):
+        """Writes a file through a synced temp file and renames it into place. Returns the new inode."""
+        directory = os.path.dirname(os.path.abspath(path))
+        descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            # mkstemp makes the file readable by its owner only, so give it the mode open() would have
+            try:
+                mode = stat.S_IMODE(os.stat(path).st_mode)
+            except FileNotFoundError:
+                mode = 0o666 & ~_umask()
+            os.fchmod(descriptor, mode)
+            with os.fdopen(descriptor, "w") as file:
+                write(file)
+                file.flush()
+                os.fsync(file.fileno())
+            status = os.stat(temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        if hasattr(os, "O_DIRECTORY"):
+            descriptor = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(descriptor)
+            finally:
+                os.close(descriptor)
+        metrics.count("storage_bytes_written_total", status.st_size, engine="json")
+        return status.st_ino
+
+    def _start_journal(self, snapshot_id):
+        self._replace(self.journal_path, lambda journal: journal.write(json.dumps({"snapshot": snapshot_id}) + "\n"))
+        self.pending = self.appended = 0
+
+    def _dump(self, details):
+        """Atomically replaces the database file with details and starts an empty journal for it."""
+        snapshot_id = self._replace(self.path, lambda database: json.dump(details, database, indent=4))
+        self._start_journal(snapshot_id)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def get(self, email):
+        detail = self._current().get(email)
+        return dict(detail) if detail is not None else None
+
+    def all(self):
+        return self._load()
+
+    def existing(self, emails):
+        return set(emails) & self._current().keys()
+
+    def find_by_account_number(self, account_number):
+        self._sync_index()
+        email = self.index.lookup(account_number)
+        return self.get(email) if email is not None else None
+
+    def insert(self, detail):
+        with locking.FileLock(self.lock_path):
+            details = self._load()
+            if detail["email"] in details:
+                return False
+            self._sync_index(details)
+            details[detail["email"]] = detail
+            self._dump(details)
+            add = [(detail["account number"], detail["email"])] if detail.get("account number") is not None else []
+            self.index.change(self._stamp(), add=add)
+            return True
+
+    def insert_many(self, details):
+        with locking.FileLock(self.lock_path):
+            saved = self._load()
+            new = [detail for detail in details if detail["email"] not in saved]
+            if not new:
+                return 0
+            self._sync_index(saved)
+            for detail in new:
+                saved[detail["email"]] = detail
+            self._dump(saved)
+            add = [(detail["account number"], detail["email"]) for detail in new if detail.get("account number") is not None]
+            self.index.change(self._stamp(), add=add)
+            return len(new)
+
+    def update(self, email, changes):
+        with locking.FileLock(self.lock_path):
+            details = self._load()
+            self._sync_index(details)
+            detail = details[email]
+            old_account_number = detail.get("account number")
+            detail.update(changes)
+            detail["version"] = detail.get("version", 0) + 1
+            new_email = detail["email"]
+            # the email is the key of a member, so changing it moves the member
+            if new_email != email:
+                details[new_email] = details.pop(email)
+            self._dump(details)
+            remove = [old_account_number] if old_account_number is not None else []
+            add = [(detail["account number"], new_email)] if detail.get("account number") is not None else []
+            rename = (email, new_email) if new_email != email else None
+            self.index.change(self._stamp(), add=add, remove=remove, rename=rename)
+
+    @metrics.timed("storage_seconds", engine="json", operation="write")
+    def _append(self, deltas):
+        with open(self.journal_path, "ab+") as journal:
+            # finish a torn line left by a crash so it cannot swallow this entry
+            journal.seek(0, os.SEEK_END)
+            line = json.dumps(deltas).encode() + b"\n"
+            if journal.tell():
+                journal.seek(-1, os.SEEK_END)
+                if journal.read(1) != b"\n":
+                    line = b"\n" + line
+            journal.write(line)
+            journal.flush()
+            os.fsync(journal.fileno())
+            end = journal.tell()
+        self.local.appended = (end - len(line), end)
+        metrics.count("storage_bytes_written_total", len(line), engine="json")
+
+    def change_token(self):
+        token = []
+        for path in (self.path, self.journal_path):
+            try:
+                status = os.stat(path)
+            except FileNotFoundError:
+                token.append(None)
+            else:
+                token.append((status.st_ino, status.st_size, status.st_mtime_ns))
+        return tuple(token)
+
+    def is_own_change(self, before, after):
+        (snapshot_before, journal_before), (snapshot_after, journal_after) = before, after
+        if snapshot_before != snapshot_after or journal_before is None or journal_after is None:
+            return False
+        appended = getattr(self.local, "appended", None)
+        return journal_before[0] == journal_after[0] and appended == (journal_before[1], journal_after[1])
+
+    def commit(self, deltas, versions=None):
+        versions = versions or {}
+        self.local.appended = None
+        with locking.account_locks(self.account_locks_path, {*deltas, *versions}):
+            while True:
+                with locking.FileLock(self.lock_path, shared=True):
+                    if self._journal_snapshot_id() == self._snapshot_id():
+                        if versions:
+                            details = self._current()
+                            for email, version in versions.items():
+                                if email not in details or details[email].get("version", 0) != version:
+                                    raise ConflictError(f"{email} changed before the transaction was committed.")
+                        self._append(deltas)
+                        break
+                # the journal belongs to an older file, so start a new one before appending
+                with locking.FileLock(self.lock_path):
+                    snapshot_id = self._snapshot_id()
+                    if self._journal_snapshot_id() != snapshot_id:
+                        self._start_journal(snapshot_id)
+        self.pending += 1
+        self.appended += 1
+        if self.pending >= settings.JOURNAL_COMPACT_THRESHOLD:
+            self._compact_in_background()
+
+    def compact(self):
+        """Folds the journal into the database file."""
+        if not self.exists():
+            return
+        with locking.FileLock(self.lock_path):
+            details = self._load()
+            if self.pending:
+                self._dump(details)
+                self.index.change(self._stamp())
+
+    def _compact_at_exit(self):
+        # a process that only read the database leaves the journal to the ones that write it
+        if self.appended:
+            self.compact()
+
+    def _compact_in_background(self):
+        if self.compactor is None or not self.compactor.is_alive():
+            self.compactor = threading.Thread(target=self.compact, daemon=True)
+            self.compactor.start()
+
+    def close(self):
+        self._compact_at_exit()
+        atexit.unregister(self._compact_at_exit)
+        self.index.close()
+
+
+class SQLiteStorage(Storage):
+    """Stores members in an SQLite table keyed by email with a unique index on account number."""
+
+    def __init__(self, path="database.sqlite3"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS members ("
+                "email TEXT PRIMARY KEY, id TEXT, name TEXT, password TEXT, role TEXT, "
+                "account_type TEXT, account_number TEXT, balance INTEGER, version INTEGER NOT NULL DEFAULT 0)"
+            )
+            self.connection.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS members_account_number ON members(account_number)"
+            )
+
+    @staticmethod
+    def _to_detail(row):
+        detail = {key: row[column] for key, column in COLUMNS.items()}
+        # account numbers are stored as text because older ones do not fit in a 64-bit integer
+        if detail["account number"] is not None:
+            detail["account number"] = int(detail["account number"])
+        return detail
+
+    @staticmethod
+    def _to_row(detail):
+        detail = dict(detail)
+        if detail.get("account number") is not None:
+            detail["account number"] = str(detail["account number"])
+        detail["version"] = detail.get("version") or 0
+        return tuple(detail.get(key) for key in COLUMNS)
+
+    def _query(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def exists(self):
+        return True
+
+    @metrics.timed("storage_seconds", engine="sqlite", operation="read")
+    def get(self, email):
+        rows = self._query("SELECT * FROM members WHERE email = ?", (email,))
+        return self._to_detail(rows[0]) if rows else None
+
+    @metrics.timed("storage_seconds", engine="sqlite", operation="read")
+    def all(self):
+        return {row["email"]: self._to_detail(row) for row in self._query("SELECT * FROM members")}
+
+    def existing(self, emails):
+        emails = list(set(emails))
+        found = set()
+        # in slices, to stay under SQLite's limit on parameters
+        for start in range(0, len(emails), 500):
+            chunk = emails[start:start + 500]
+            placeholders = ", ".join("?" for _ in chunk)
+            rows = self._query(f"SELECT email FROM members WHERE email IN ({placeholders})", chunk)
+            found.update(row["email"] for row in rows)
+        return found
+
+    def snapshot(self):
+        # a connection of its own, so the copy does not hold the lock writes in this process wait for;
+        # one SELECT in WAL mode reads a single version of the table while others write
+        connection = sqlite3.connect(f"{pathlib.Path(self.path).absolute().as_uri()}?mode=ro", uri=True)
+        connection.row_factory = sqlite3.Row
+        try:
+            return {row["email"]: self._to_detail(row) for row in connection.execute("SELECT * FROM members")}
+        finally:
+            connection.close()
+
+    @metrics.timed("storage_seconds", engine="sqlite", operation="read")
+    def find_by_account_number(self, account_number):
+        rows = self._query("SELECT * FROM members WHERE account_number = ?", (str(account_number),))
+        return self._to_detail(rows[0]) if rows else None
+
+    @metrics.timed("storage_seconds", engine="sqlite", operation="write")
+    def insert_many(self, details):
+        """Saves many new members in one transaction. Emails that already exist are skipped."""
+        columns = ", ".join(COLUMNS.values())
+        placeholders = ", ".join("?" for _ in COLUMNS)
+        rows = [self._to_row(detail) for detail in details]
+        with self.lock, self.connection:
+            before = self.connection.total_changes
+            self.connection.executemany(
+                f"INSERT OR IGNORE INTO members ({columns}) VALUES ({placeholders})", rows
+            )
+            return self.connection.total_changes - before
+
+    def insert(self, detail):
+        return self.insert_many([detail]) == 1
+
+    @metrics.timed("storage_seconds", engine="sqlite", operation="write")
+    def update(self, email, changes):
+        changes = dict(changes)
+        if changes.get("account number") is not None:
+            changes["account number"] = str(changes["account number"])
+        assignments = ", ".join(f"{COLUMNS[key]} = ?" for key in changes)
+        with self.lock, self.connection:
+            self.connection.execute(
+                f"UPDATE members SET {assignments}, version = version + 1 WHERE email = ?",
+                (*changes.values(), email),
+            )
+
+    @metrics.timed("storage_seconds", engine="sqlite", operation="write")
+    def commit(self, deltas, versions=None):
+        versions = versions or {}
+        # an account is only updated if it still has its version, so counting the rows updated checks
+        # every version without reading them first
+        checked = [(deltas.get(email, 0), email, version) for email, version in versions.items()]
+        with self.lock, self.connection:
+            before = self.connection.total_changes
+            self.connection.executemany(
+                "UPDATE members SET balance = balance + ?, version = version + 1 WHERE email = ? AND version = ?",
+                checked,
+            )
+            if self.connection.total_changes - before != len(checked):
+                raise ConflictError("An account changed before the transaction was committed.")
+            self.connection.executemany(
+                "UPDATE members SET balance = balance + ?, version = version + 1 WHERE email = ?",
+                [(amount, email) for email, amount in deltas.items() if email not in versions],
+            )
+
+    def change_token(self):
+        # data_version changes when another connection commits, but not for the writes of this one
+        return self._query("PRAGMA data_version")[0][0]
+
+    def is_own_change(self, before, after):
+        return before == after
+
+    def close(self):
+        self.connection.close()
+
+
+_engines = {}
+
+
+@metrics.collector
+def _cache_counters():
+    for engine in list(_engines.values()):
+        if hasattr(engine, "stats"):
+            stats = engine.stats()
+            for name in ("hits", "misses", "invalidations", "evictions"):
+                yield f"cache_{name}_total", {}, stats[name]
+
+
+def get_storage(path=None):
+    """Returns the storage engine for a database path, creating it on first use."""
+    # imported here because the cache wraps the engines defined in this module
+    from cache import CachedStorage
+
+    path = path or settings.DATABASE
+    if path not in _engines:
+        engine = SQLiteStorage(path) if path.endswith(SQLITE_EXTENSIONS) else JSONStorage(path)
+        _engines[path] = CachedStorage(engine, settings.CACHE_SIZE) if settings.CACHE_SIZE else engine
+    return _engines[path]
+
+
+def allocate_member_ids(count, path=None):
+    """Reserves count member ids in one move of the counter in member_count.txt, atomically across processes.
+
+    Returns them as a range.
+    """
+    path = path or settings.MEMBER_COUNT
+    with locking.FileLock(f"{path}.lock"):
+        with open(path) as file:
+            first = int(file.read())
+        with open(path, "w") as file:
+            file.write(f"{first + count}")
+    return range(first, first + count)
+
+
+def allocate_member_id(path=None):
+    """Returns the next member id."""
+    return str(allocate_member_ids(1, path)[0])
+
+
+# Account numbers are the 9 digit serial numbers from here on, followed by a check digit.
+FIRST_ACCOUNT_SERIAL = 100_000_000
+
+
+def check_digit(number):
+    """Returns the Luhn check digit of a number."""
+    total = 0
+    for position, digit in enumerate(reversed(str(number))):
+        digit = int(digit)
+        if position % 2 == 0:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    return (10 - total % 10) % 10
+
+
+def account_number(serial):
+    """Returns the 10 digit account number of the serial-th account."""
+    base = FIRST_ACCOUNT_SERIAL + serial
+    if base > 999_999_999:
+        raise OverflowError("Sorry, the bank has run out of account numbers.")
+    return base * 10 + check_digit(base)
+
+
+def is_account_number(number):
+    """Returns True if a number is a well formed account number, i.e. its check digit matches."""
+    number = str(number)
+    return len(number) == 10 and number.isdigit() and check_digit(number[:-1]) == int(number[-1])
+
+
+class AccountNumbers:
+    """Hands out account numbers from blocks of serial numbers reserved in a counter file.
+
+    A block is reserved by moving the counter on under a file lock, once every block_size numbers, so
+    handing out a number does not touch the disk. Numbers left in a block when the process ends are
+    never used. A forked process reserves its own blocks instead of reusing its parent's.
+    """
+
+    def __init__(self, path, block_size):
+        self.path = path
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.next = self.end = 0
+        self.pid = None
+
+    def _next_block(self):
+        """Returns the first block not yet reserved. The caller holds the counter file's lock."""
+        try:
+            with open(self.path) as file:
+                return int(file.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _reserve(self, count):
+        """Reserves the serial numbers of enough blocks to hold count numbers and returns the first."""
+        blocks = -(-count // self.block_size)
+        with locking.FileLock(f"{self.path}.lock"):
+            block = self._next_block()
+            with open(self.path, "w") as file:
+                file.write(f"{block + blocks}")
+        return block * self.block_size, (block + blocks) * self.block_size
+
+    def allocate(self):
+        """Returns a new account number."""
+        with self.lock:
+            if self.next == self.end or self.pid != os.getpid():
+                self.next, self.end = self._reserve(1)
+                self.pid = os.getpid()
+            serial = self.next
+            self.next += 1
+        return account_number(serial)
+
+    def allocate_many(self, count):
+        """Returns count new account numbers, reserved at once."""
+        start, _ = self._reserve(count)
+        return [account_number(serial) for serial in range(start, start + count)]
+
+    def may_allocate(self, number):
+        """Returns True if number could still be handed out: it is in this process's block, or in no block yet.
+
+        Blocks reserved by other running processes are not known, so a number in one of them is not caught.
+        """
+        if not is_account_number(number):
+            return False
+        serial = int(number) // 10 - FIRST_ACCOUNT_SERIAL
+        with self.lock:
+            if self.pid == os.getpid() and self.next <= serial < self.end:
+                return True
+        with locking.FileLock(f"{self.path}.lock"):
+            return serial >= self._next_block() * self.block_size
+
+
+_account_numbers = {}
+
+
+def get_account_numbers(path=None):
+    """Returns the account number allocator of a counter file, creating it on first use."""
+    path = path or settings.ACCOUNT_BLOCKS
+    if path not in _account_numbers:
+        _account_numbers[path] = AccountNumbers(path, settings.ACCOUNT_BLOCK_SIZE)
+    return _account_numbers[path]
+
+
+def allocate_account_number(path=None):
+    """Returns a new, unique account number."""
+    return get_account_numbers(path).allocate()
+
+
+def allocate_account_numbers(count, path=None):
+    """Returns count new, unique account numbers, reserved in one move of the counter."""
+    return get_account_numbers(path).allocate_many(count)
+
+
+def migrate_json_to_sqlite(json_path="database.json", sqlite_path="database.sqlite3"):
+    """Copies every member of a database.json file into an SQLite database. Returns the number copied."""
+    # read through the engine, so balance changes still in the journal are copied too
+    source = JSONStorage(json_path)
+    try:
+        details = source.all()
+    finally:
+        source.close()
+    engine = SQLiteStorage(sqlite_path)
+    try:
+        return engine.insert_many(details.values())
+    finally:
+        engine.close()
+
+
+if __name__ == "__main__":
+    # Usage: python storage.py [database.json] [database.sqlite3]
+    count = migrate_json_to_sqlite(*sys.argv[1:3])
+    print(f"Migrated {count} members.")
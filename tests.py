@@ -1,14 +1,50 @@
+import asyncio
+import base64
+import contextlib
+import csv
+import datetime as dt
+import http.client
+import io
 import json
+import multiprocessing
 import unittest
 import random
+import shutil
 import utilities
 import os
 import pandas
+import tempfile
+import accrual
+import balances
+import batch
+import cache
+import datagen
+import fraud
+import groupcommit
+import ledger
+import member_factory
+import metrics
+import onboard
+import passwords
+import reports
+import server
+import sessions
+import snapshot
+import statements
+import settings
+import storage
+import subprocess
+import sys
+import threading
+import time
 from member_factory import Official, Customer
 from unittest import TestCase, mock
 
 
 class TestUtilities(TestCase):
+    def setUp(self):
+        utilities.logout()
+
     @mock.patch('utilities.input', create=True)
     @unittest.skipUnless(os.path.exists("database.json"), "Test only runs when database exists.")
     def test_login_customer_with_correct_detail(self, mocked_input):
@@ -109,8 +145,7 @@ class TestUtilities(TestCase):
     @unittest.skipUnless(os.path.exists("database.json"), "Test only runs when database exists.")
     def test_withdraw_with_insufficient_funds(self, mocked_input):
         """Tests that a withdrawal is NOT made when there is insufficient funds"""
-        database = pandas.read_json("database.json")
-        test_user_balance = database["test1@gmail.com"]["balance"]
+        test_user_balance = storage.get_storage().get("test1@gmail.com")["balance"]
         mocked_input.side_effect = ["test1@gmail.com", "ass", f"{test_user_balance + 1}", "n"]
         self.assertEqual(utilities.withdraw(), False, "Expected None.")
 
@@ -136,3 +171,1593 @@ class TestUtilities(TestCase):
             json.dump(database, file, indent=4)
 
     """And so on and so forth"""
+
+
+class TestScript(TestCase):
+    @unittest.skipUnless(os.path.exists("database.json"), "Test only runs when database exists.")
+    def test_long_script_runs_without_recursion(self):
+        """Tests that a scripted session longer than the recursion limit runs to the end of its answers"""
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ("database.json", "records.csv", "member_count.txt"):
+                shutil.copy(name, directory)
+            script = os.path.join(directory, "script.txt")
+            answers = ["5", "test1@gmail.com", "ass", *["y", "5"] * sys.getrecursionlimit()]
+            with open(script, "w") as file:
+                file.write("\n".join(answers) + "\n")
+            result = subprocess.run(
+                [sys.executable, "main.py", "--script", script],
+                env=dict(
+                    os.environ,
+                    BANK_PORTAL_DATABASE=os.path.join(directory, "database.json"),
+                    BANK_PORTAL_RECORDS=os.path.join(directory, "records.csv"),
+                    BANK_PORTAL_MEMBER_COUNT=os.path.join(directory, "member_count.txt"),
+                ),
+                capture_output=True, text=True, timeout=120,
+            )
+        self.assertEqual((result.returncode, result.stderr), (0, ""))
+        self.assertEqual(result.stdout.count("Your current account balance"), sys.getrecursionlimit() + 1)
+        self.assertTrue(result.stdout.endswith("Thank you and have a nice day.🙂\n"))
+
+
+class TestStorage(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.detail = {
+            "id": "1",
+            "name": "Test One",
+            "email": "test1@gmail.com",
+            "password": "ass",
+            "role": "customer",
+            "account type": "current",
+            "account number": 920487614012920221,
+            "balance": 8500,
+            "version": 0,
+        }
+
+    def engines(self):
+        yield storage.JSONStorage(os.path.join(self.directory.name, "database.json"))
+        yield storage.SQLiteStorage(os.path.join(self.directory.name, "database.sqlite3"))
+
+    def test_insert_and_get(self):
+        """Tests that a saved member can be read back and is not saved twice"""
+        for engine in self.engines():
+            self.assertTrue(engine.insert(dict(self.detail)))
+            self.assertFalse(engine.insert(dict(self.detail)))
+            self.assertEqual(engine.get("test1@gmail.com"), self.detail)
+            self.assertIsNone(engine.get("nobody@gmail.com"))
+            engine.close()
+
+    def test_find_by_account_number(self):
+        """Tests that a member is found by account number"""
+        for engine in self.engines():
+            engine.insert(dict(self.detail))
+            self.assertEqual(engine.find_by_account_number(920487614012920221)["email"], "test1@gmail.com")
+            self.assertIsNone(engine.find_by_account_number(1))
+            engine.close()
+
+    def test_existing(self):
+        """Tests that the emails already saved are picked out of many at once"""
+        for engine in self.engines():
+            engine.insert(dict(self.detail))
+            emails = ["test1@gmail.com", "nobody@gmail.com"] + [f"new{number}@gmail.com" for number in range(1000)]
+            self.assertEqual(engine.existing(emails), {"test1@gmail.com"})
+            self.assertEqual(engine.existing([]), set())
+            engine.close()
+
+    def test_update_and_adjust_balances(self):
+        """Tests that details and balances are changed in the database"""
+        for engine in self.engines():
+            engine.insert(dict(self.detail))
+            engine.update("test1@gmail.com", {"password": "new"})
+            engine.adjust_balances({"test1@gmail.com": -500})
+            detail = engine.get("test1@gmail.com")
+            self.assertEqual((detail["password"], detail["balance"]), ("new", 8000))
+            engine.close()
+
+    def test_account_number_index_follows_edits(self):
+        """Tests that account number lookups follow changes to the account number and email"""
+        for engine in self.engines():
+            engine.insert(dict(self.detail))
+            engine.update("test1@gmail.com", {"account number": 1234567890})
+            self.assertIsNone(engine.find_by_account_number(920487614012920221))
+            engine.update("test1@gmail.com", {"email": "one@gmail.com"})
+            self.assertIsNone(engine.get("test1@gmail.com"))
+            self.assertEqual(engine.find_by_account_number(1234567890)["email"], "one@gmail.com")
+            engine.close()
+
+    def test_account_number_index_rebuilt_after_outside_write(self):
+        """Tests that the index is rebuilt when database.json is rewritten by something else"""
+        engine = storage.JSONStorage(os.path.join(self.directory.name, "database.json"))
+        engine.insert(dict(self.detail))
+        self.assertIsNotNone(engine.find_by_account_number(920487614012920221))
+        with open(engine.path, "w") as file:
+            json.dump({"test1@gmail.com": dict(self.detail, **{"account number": 42})}, file, indent=4)
+        self.assertIsNone(engine.find_by_account_number(920487614012920221))
+        self.assertEqual(engine.find_by_account_number(42)["email"], "test1@gmail.com")
+        engine.close()
+
+    def test_balance_changes_are_journaled(self):
+        """Tests that balance changes are kept in the journal until they are compacted into the file"""
+        engine = storage.JSONStorage(os.path.join(self.directory.name, "database.json"))
+        engine.insert(dict(self.detail))
+        engine.adjust_balances({"test1@gmail.com": 1000})
+        with open(engine.path) as file:
+            self.assertEqual(json.load(file)["test1@gmail.com"]["balance"], 8500)
+        self.assertEqual(engine.get("test1@gmail.com")["balance"], 9500)
+        engine.compact()
+        with open(engine.path) as file:
+            self.assertEqual(json.load(file)["test1@gmail.com"]["balance"], 9500)
+        self.assertEqual(engine.get("test1@gmail.com")["balance"], 9500)
+        engine.close()
+
+    def test_torn_journal_line_is_ignored(self):
+        """Tests that a half written journal entry left by a crash does not corrupt later entries"""
+        engine = storage.JSONStorage(os.path.join(self.directory.name, "database.json"))
+        engine.insert(dict(self.detail))
+        engine.adjust_balances({"test1@gmail.com": 1000})
+        with open(engine.journal_path, "a") as journal:
+            journal.write('{"test1@gmail.com": 5')
+        engine.adjust_balances({"test1@gmail.com": -500})
+        self.assertEqual(engine.get("test1@gmail.com")["balance"], 9000)
+        engine.close()
+
+    def test_reads_only_parse_new_journal_lines(self):
+        """Tests that once the file is read, commits and reads only parse what was journaled since"""
+        path = os.path.join(self.directory.name, "database.json")
+        engine, other = storage.JSONStorage(path), storage.JSONStorage(path)
+        engine.insert(dict(self.detail))
+        engine.get("test1@gmail.com")
+        other.get("test1@gmail.com")
+        with mock.patch("storage.json.load", side_effect=AssertionError("database.json was parsed")):
+            engine.commit({"test1@gmail.com": -500}, {"test1@gmail.com": 0})
+            # as another process would, through its own copy
+            other.commit({"test1@gmail.com": -500}, {"test1@gmail.com": 1})
+            engine.commit({"test1@gmail.com": 100}, {"test1@gmail.com": 2})
+            detail = engine.get("test1@gmail.com")
+        self.assertEqual((detail["balance"], detail["version"]), (7600, 3))
+        engine.compact()
+        self.assertEqual(storage.JSONStorage(path).get("test1@gmail.com")["balance"], 7600)
+        engine.close()
+        other.close()
+
+    def test_rewritten_files_keep_their_mode(self):
+        """Tests that new files get the umask's mode and rewritten ones keep theirs"""
+        path = os.path.join(self.directory.name, "database.json")
+        engine = storage.JSONStorage(path)
+        umask = os.umask(0o027)
+        try:
+            engine.insert(dict(self.detail))
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        self.assertEqual(os.stat(engine.journal_path).st_mode & 0o777, 0o640)
+        os.chmod(path, 0o644)
+        engine.adjust_balances({"test1@gmail.com": 1000})
+        engine.compact()
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+        engine.close()
+
+    def test_reading_process_leaves_the_journal(self):
+        """Tests that a process that only reads does not compact the journal when it exits"""
+        path = os.path.join(self.directory.name, "database.json")
+        engine = storage.JSONStorage(path)
+        engine.insert(dict(self.detail))
+        engine.adjust_balances({"test1@gmail.com": 1000})
+        before = os.stat(path)
+        with open(engine.journal_path) as journal:
+            journal_before = journal.read()
+        script = f"import storage; print(storage.JSONStorage({path!r}).get('test1@gmail.com')['balance'])"
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, timeout=60)
+        self.assertEqual((result.stdout, result.stderr), ("9500\n", ""))
+        after = os.stat(path)
+        self.assertEqual((after.st_ino, after.st_mtime_ns), (before.st_ino, before.st_mtime_ns))
+        with open(engine.journal_path) as journal:
+            self.assertEqual(journal.read(), journal_before)
+        other = storage.JSONStorage(path)
+        other.all()
+        other.close()
+        self.assertEqual(os.stat(path).st_ino, before.st_ino)
+        engine.close()
+        self.assertNotEqual(os.stat(path).st_ino, before.st_ino)
+
+    def test_commit_with_stale_version_conflicts(self):
+        """Tests that a change is refused when the account changed after it was read"""
+        for engine in self.engines():
+            engine.insert(dict(self.detail))
+            engine.commit({"test1@gmail.com": -500}, {"test1@gmail.com": 0})
+            with self.assertRaises(storage.ConflictError):
+                engine.commit({"test1@gmail.com": -500}, {"test1@gmail.com": 0})
+            self.assertEqual(engine.get("test1@gmail.com")["balance"], 8000)
+            engine.close()
+
+    def test_migrate_json_to_sqlite(self):
+        """Tests that every member of a database.json file is copied into SQLite"""
+        json_path = os.path.join(self.directory.name, "database.json")
+        sqlite_path = os.path.join(self.directory.name, "migrated.sqlite3")
+        with open(json_path, "w") as file:
+            json.dump({"test1@gmail.com": self.detail}, file, indent=4)
+        self.assertEqual(storage.migrate_json_to_sqlite(json_path, sqlite_path), 1)
+        engine = storage.SQLiteStorage(sqlite_path)
+        self.assertEqual(engine.get("test1@gmail.com"), self.detail)
+        engine.close()
+
+    def test_migrate_copies_the_journal(self):
+        """Tests that balance changes not yet compacted into database.json are migrated"""
+        json_path = os.path.join(self.directory.name, "database.json")
+        sqlite_path = os.path.join(self.directory.name, "migrated.sqlite3")
+        source = storage.JSONStorage(json_path)
+        source.insert(dict(self.detail))
+        source.adjust_balances({"test1@gmail.com": 1000})
+        source.close()
+        self.assertEqual(storage.migrate_json_to_sqlite(json_path, sqlite_path), 1)
+        engine = storage.SQLiteStorage(sqlite_path)
+        self.assertEqual(engine.get("test1@gmail.com")["balance"], 9500)
+        engine.close()
+
+
+def allocate_account_numbers(path, count, results):
+    """Allocates account numbers from a separate process and reports them"""
+    allocator = storage.AccountNumbers(path, 10)
+    results.put([allocator.allocate() for _ in range(count)])
+
+
+class TestAccountNumbers(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "account_blocks.txt")
+
+    def test_numbers_are_fixed_length_with_a_check_digit(self):
+        """Tests that account numbers have 10 digits, the last a Luhn check digit"""
+        self.assertEqual(storage.check_digit(7992739871), 3)
+        allocator = storage.AccountNumbers(self.path, 10)
+        numbers = [allocator.allocate() for _ in range(25)]
+        self.assertEqual(numbers[0], 1000000008)
+        self.assertTrue(all(len(str(number)) == 10 and storage.is_account_number(number) for number in numbers))
+        self.assertFalse(storage.is_account_number(numbers[0] + 1))
+
+    def test_a_block_is_reserved_once(self):
+        """Tests that the counter file is only touched when a block runs out"""
+        allocator = storage.AccountNumbers(self.path, 10)
+        with mock.patch.object(allocator, "_reserve", wraps=allocator._reserve) as reserve:
+            for _ in range(25):
+                allocator.allocate()
+        self.assertEqual(reserve.call_count, 3)
+        with open(self.path) as file:
+            self.assertEqual(file.read(), "3")
+
+    def test_numbers_are_unique_across_threads_and_processes(self):
+        """Tests that allocators in several threads and processes never hand out the same number"""
+        allocator = storage.AccountNumbers(self.path, 10)
+        numbers = []
+        threads = [threading.Thread(target=lambda: numbers.extend(allocator.allocate() for _ in range(50)))
+                   for _ in range(4)]
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        processes = [context.Process(target=allocate_account_numbers, args=(self.path, 50, results)) for _ in range(4)]
+        for worker in threads + processes:
+            worker.start()
+        for _ in processes:
+            numbers += results.get(timeout=30)
+        for worker in threads + processes:
+            worker.join()
+        self.assertEqual(len(numbers), 400)
+        self.assertEqual(len(set(numbers)), 400)
+        self.assertEqual(len(set(allocator.allocate_many(30) + numbers)), 430)
+
+    def test_numbers_still_to_be_handed_out_are_known(self):
+        """Tests that numbers left in this process's block or in no block yet may still be allocated"""
+        allocator = storage.AccountNumbers(self.path, 10)
+        given = allocator.allocate()
+        self.assertFalse(allocator.may_allocate(given))
+        self.assertTrue(allocator.may_allocate(storage.account_number(5)))
+        self.assertTrue(allocator.may_allocate(storage.account_number(500)))
+        self.assertFalse(allocator.may_allocate(given + 1))
+        self.assertFalse(allocator.may_allocate(920487614012920221))
+
+    def test_edits_and_opens_cannot_take_a_number_twice(self):
+        """Tests that an edit can't take a number kept for new accounts, and a refused save is reported"""
+        # SQLite refuses a second member with the same account number
+        database = os.path.join(os.path.dirname(self.path), "database.sqlite3")
+        for name, value in [("DATABASE", database), ("ACCOUNT_BLOCKS", self.path)]:
+            patcher = mock.patch.object(settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: storage._engines.pop(database).close())
+        self.addCleanup(lambda: storage._account_numbers.pop(self.path))
+        with contextlib.redirect_stdout(io.StringIO()):
+            customer = member_factory.open_customer_account("Test One", "test1@gmail.com", "ass", "current")
+        with self.assertRaises(member_factory.BankError):
+            member_factory.edit_customer(customer.email, {"account number": storage.account_number(1)})
+        member_factory.edit_customer(customer.email, {"account number": 1234567890})
+        with mock.patch("member_factory.allocate_account_number", return_value=1234567890):
+            with self.assertRaises(member_factory.BankError):
+                member_factory.open_customer_account("Test Two", "test2@gmail.com", "ass", "current")
+        self.assertIsNone(storage.get_storage().get("test2@gmail.com"))
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.database = os.path.join(directory.name, "database.json")
+        patcher = mock.patch.object(settings, "DATABASE", self.database)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: storage._engines.pop(self.database).close())
+        storage.get_storage().insert({
+            "id": "1", "name": "Test One", "email": "test1@gmail.com", "password": "ass", "role": "customer",
+            "account type": "current", "account number": 1000000000, "balance": 0,
+        })
+        self.addCleanup(metrics.reset)
+        self.addCleanup(metrics.enable, False)
+
+    def counters(self):
+        return {(counter["name"], tuple(counter["labels"].values())): counter["value"]
+                for counter in metrics.snapshot()["counters"]}
+
+    def test_nothing_is_kept_while_disabled(self):
+        """Tests that metrics are off unless enabled"""
+        metrics.enable(False)
+        member_factory.authenticate("test1@gmail.com", "ass").post("deposit", 100)
+        self.assertEqual(metrics.snapshot()["timers"], [])
+
+    def test_operations_and_storage_are_measured(self):
+        """Tests that timers and counters follow operations, database I/O and lock waits"""
+        metrics.enable()
+        user = member_factory.authenticate("test1@gmail.com", "ass")
+        user.post("deposit", 100)
+        user.post("withdraw", 40)
+        timers = {(timer["name"], tuple(timer["labels"].values())): timer for timer in metrics.snapshot()["timers"]}
+        self.assertEqual(timers["bank_portal_operation_seconds", ("transact",)]["count"], 2)
+        self.assertEqual(timers["bank_portal_operation_seconds", ("login",)]["count"], 1)
+        self.assertEqual(sum(timers["bank_portal_lock_wait_seconds", ()]["buckets"].values()),
+                         timers["bank_portal_lock_wait_seconds", ()]["count"])
+        counters = self.counters()
+        self.assertGreater(counters["bank_portal_storage_bytes_read_total", ("json",)], 0)
+        self.assertGreater(counters["bank_portal_storage_bytes_written_total", ("json",)], 0)
+        self.assertGreater(counters["bank_portal_cache_hits_total", ()], 0)
+
+    def test_prometheus_format(self):
+        """Tests that timers are exported as cumulative histograms"""
+        metrics.enable()
+        for seconds in (0.0002, 0.003, 7):
+            metrics.observe("operation_seconds", seconds, operation="login")
+        metrics.count("requests_total", status=200)
+        lines = metrics.prometheus().splitlines()
+        self.assertIn("# TYPE bank_portal_operation_seconds histogram", lines)
+        self.assertIn('bank_portal_operation_seconds_bucket{operation="login",le="0.0005"} 1', lines)
+        self.assertIn('bank_portal_operation_seconds_bucket{operation="login",le="0.005"} 2', lines)
+        self.assertIn('bank_portal_operation_seconds_bucket{operation="login",le="+Inf"} 3', lines)
+        self.assertIn('bank_portal_operation_seconds_count{operation="login"} 3', lines)
+        self.assertIn('bank_portal_requests_total{status="200"} 1', lines)
+
+
+class TestMembers(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.database = os.path.join(directory.name, "database.json")
+        patcher = mock.patch.object(settings, "DATABASE", self.database)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: storage._engines.pop(self.database).close())
+        self.engine = storage.get_storage()
+        self.engine.insert({"id": "7", "name": "Ada Lovelace", "email": "ada@gmail.com", "password": "pw",
+                            "role": "customer", "account type": "savings", "account number": 1000000008,
+                            "balance": 250})
+        self.engine.insert({"id": "8", "name": "Test Official", "email": "o@bank.com", "password": "pw",
+                            "role": "official"})
+
+    def test_login_loads_members_without_saving_them(self):
+        """Tests that logging in builds members from their stored details, without opening accounts again"""
+        with mock.patch.object(self.engine, "contains") as contains, \
+                mock.patch("member_factory.allocate_account_number") as allocate:
+            customer = member_factory.authenticate("ada@gmail.com", "pw")
+            official = member_factory.authenticate("o@bank.com", "pw")
+        contains.assert_not_called()
+        allocate.assert_not_called()
+        self.assertEqual(
+            (customer.id, customer.name, customer.account_type, customer.account_number, customer.balance),
+            ("7", "Ada Lovelace", "savings", 1000000008, 250),
+        )
+        self.assertEqual((official.id, official.role, official.salary), ("8", "official", 100_000))
+        self.assertFalse(hasattr(customer, "__dict__"))
+        # the plaintext password was hashed on login, and the member carries the hash
+        self.assertEqual(customer.password, self.engine.get("ada@gmail.com")["password"])
+
+    @mock.patch.multiple(settings, SCRYPT_N=2 ** 8)
+    def test_officials_of_the_same_name_get_their_own_accounts(self):
+        """Tests that a second official of a two word name gets another email, and a taken email is refused"""
+        count = os.path.join(os.path.dirname(self.database), "member_count.txt")
+        with open(count, "w") as file:
+            file.write("1")
+        with mock.patch.object(settings, "MEMBER_COUNT", count), mock.patch("member_factory.dt") as clock:
+            clock.datetime.now.return_value = dt.datetime(2022, 6, 1, 9, 0, 42)
+            first = member_factory.open_official_account("john doe", "pw1")
+            second = member_factory.open_official_account("John Doe", "pw2")
+            with self.assertRaises(member_factory.BankError):
+                member_factory.open_official_account("john doe", "pw3")
+            with self.assertRaises(member_factory.BankError):
+                Official("Someone Else", email="o@bank.com", password="pw")
+        self.assertEqual((first.email, second.email), ("johndoe@bank.com", "johndoe42@bank.com"))
+        self.assertEqual((first.id, second.id), ("1", "2"))
+        self.assertEqual(member_factory.authenticate("johndoe42@bank.com", "pw2").name, "John Doe")
+        self.assertEqual(self.engine.get("o@bank.com")["name"], "Test Official")
+
+
+class TestSessions(TestCase):
+    def setUp(self):
+        self.user = Customer.__new__(Customer)
+        self.user.email = "test1@gmail.com"
+
+    @mock.patch("sessions.time.monotonic")
+    def test_sessions_expire_when_unused(self, monotonic):
+        """Tests that a session lasts ttl seconds after it was last used"""
+        monotonic.return_value = 0
+        store = sessions.Sessions(ttl=60, size=10)
+        token = store.open(self.user)
+        monotonic.return_value = 50
+        self.assertIs(store.get(token), self.user)
+        monotonic.return_value = 100
+        self.assertIs(store.get(token), self.user)
+        monotonic.return_value = 161
+        self.assertIsNone(store.get(token))
+        self.assertEqual(len(store), 0)
+
+    def test_least_recently_used_sessions_are_evicted(self):
+        """Tests that sessions are capped in memory"""
+        store = sessions.Sessions(ttl=60, size=2)
+        first, second = store.open(self.user), store.open(self.user)
+        store.get(first)
+        store.open(self.user)
+        self.assertIsNone(store.get(second))
+        self.assertIs(store.get(first), self.user)
+        store.close_member("test1@gmail.com")
+        self.assertEqual(len(store), 0)
+
+    @mock.patch("utilities.input", create=True)
+    @unittest.skipUnless(os.path.exists("database.json"), "Test only runs when database exists.")
+    def test_menu_logs_in_once(self, mocked_input):
+        """Tests that the menu asks for the password once until the member is done"""
+        self.addCleanup(utilities.logout)
+        mocked_input.side_effect = ["test1@gmail.com", "ass"]
+        user = utilities.login()
+        self.assertIs(utilities.login(), user)
+        mocked_input.side_effect = ["n"]
+        utilities.again()
+        mocked_input.side_effect = ["test1@gmail.com", "ss"]
+        self.assertIsNone(utilities.login())
+
+    @mock.patch("utilities.input", create=True)
+    @unittest.skipUnless(os.path.exists("database.json"), "Test only runs when database exists.")
+    def test_menu_asks_for_a_login_of_the_right_role(self, mocked_input):
+        """Tests that a session is only used for transactions its member's role can do"""
+        self.addCleanup(utilities.logout)
+        mocked_input.side_effect = ["test2@bank.com", "1234"]
+        official = utilities.login("official")
+        mocked_input.side_effect = ["test2@bank.com", "1234"]
+        self.assertIsNone(utilities.login("customer"))
+        self.assertIs(utilities.login("official"), official)
+        mocked_input.side_effect = ["test1@gmail.com", "ass"]
+        customer = utilities.login("customer")
+        self.assertEqual(customer.role, "customer")
+        self.assertIs(utilities.login(), customer)
+        mocked_input.side_effect = ["test1@gmail.com", "ass"]
+        self.assertIsNone(utilities.login("official"))
+
+
+@mock.patch.multiple(settings, SCRYPT_N=2 ** 8, PBKDF2_ITERATIONS=1000)
+class TestPasswords(TestCase):
+    def setUp(self):
+        passwords.get_verified().clear()
+
+    def test_hash_and_verify(self):
+        """Tests that both schemes hash with a salt and verify only the right password"""
+        for scheme in passwords.SCHEMES:
+            stored = passwords.hash_password("pass123", scheme)
+            self.assertTrue(stored.startswith(f"{scheme}$"))
+            self.assertNotEqual(stored, passwords.hash_password("pass123", scheme))
+            self.assertTrue(passwords.verify("a@gmail.com", stored, "pass123"))
+            self.assertFalse(passwords.verify("a@gmail.com", stored, "pass124"))
+        self.assertTrue(passwords.verify("a@gmail.com", "ass", "ass"))
+        self.assertFalse(passwords.verify("a@gmail.com", "ass", "as"))
+
+    def test_needs_rehash(self):
+        """Tests that plaintext passwords and hashes with another cost are rehashed"""
+        stored = passwords.hash_password("pass123")
+        self.assertFalse(passwords.needs_rehash(stored))
+        self.assertTrue(passwords.needs_rehash("pass123"))
+        with mock.patch.object(settings, "SCRYPT_N", 2 ** 9):
+            self.assertTrue(passwords.needs_rehash(stored))
+
+    def test_verified_logins_are_cached(self):
+        """Tests that a repeated login does not derive the hash again, unless the password changed"""
+        stored = passwords.hash_password("pass123")
+        with mock.patch("passwords._derive", wraps=passwords._derive) as derive:
+            for _ in range(3):
+                self.assertTrue(passwords.verify("a@gmail.com", stored, "pass123"))
+            self.assertFalse(passwords.verify("a@gmail.com", stored, "wrong"))
+            self.assertTrue(passwords.verify("a@gmail.com", passwords.hash_password("pass123"), "pass123"))
+        self.assertEqual(derive.call_count, 4)
+
+    def test_plaintext_password_is_hashed_on_login(self):
+        """Tests that logging in replaces a plaintext password with its hash"""
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, "database.json")
+            with mock.patch.object(settings, "DATABASE", database):
+                self.addCleanup(lambda: storage._engines.pop(database).close())
+                engine = storage.get_storage()
+                engine.insert({"id": "1", "name": "Test Official", "email": "o@bank.com", "password": "1234",
+                               "role": "official"})
+                self.assertIsInstance(member_factory.authenticate("o@bank.com", "1234"), Official)
+                stored = engine.get("o@bank.com")["password"]
+                self.assertTrue(stored.startswith("scrypt$"))
+                self.assertIsInstance(member_factory.authenticate("o@bank.com", "1234"), Official)
+                self.assertEqual(engine.get("o@bank.com")["password"], stored)
+                with self.assertRaises(member_factory.BankError):
+                    member_factory.authenticate("o@bank.com", "12345")
+
+
+class TestCache(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def member(self, number):
+        return {
+            "id": str(number),
+            "name": f"Test {number}",
+            "email": f"test{number}@gmail.com",
+            "password": "ass",
+            "role": "customer",
+            "account type": "current",
+            "account number": 1000000000 + number,
+            "balance": 1000,
+            "version": 0,
+        }
+
+    def test_write_through_keeps_members_cached(self):
+        """Tests that reads are served from the cache and balance changes update it"""
+        for engine in (
+            storage.JSONStorage(os.path.join(self.directory, "database.json")),
+            storage.SQLiteStorage(os.path.join(self.directory, "database.sqlite3")),
+        ):
+            cached = cache.CachedStorage(engine, 10)
+            cached.insert(self.member(1))
+            cached.get("test1@gmail.com")
+            cached.commit({"test1@gmail.com": 500}, {"test1@gmail.com": 0})
+            self.assertEqual(cached.get("test1@gmail.com")["balance"], 1500)
+            self.assertEqual(cached.find_by_account_number(1000000001)["version"], 1)
+            self.assertEqual(engine.get("test1@gmail.com")["balance"], 1500)
+            self.assertEqual(cached.stats()["hits"], 2)
+            cached.close()
+
+    def test_refused_insert_is_not_cached(self):
+        """Tests that a member whose email is taken does not replace the saved one in the cache"""
+        for engine in (
+            storage.JSONStorage(os.path.join(self.directory, "database.json")),
+            storage.SQLiteStorage(os.path.join(self.directory, "database.sqlite3")),
+        ):
+            cached = cache.CachedStorage(engine, 10)
+            cached.insert(self.member(1))
+            self.assertFalse(cached.insert(dict(self.member(2), email="test1@gmail.com")))
+            self.assertEqual(cached.get("test1@gmail.com")["name"], "Test 1")
+            self.assertIsNone(cached.find_by_account_number(1000000002))
+            cached.close()
+
+    def test_outside_writes_invalidate_the_cache(self):
+        """Tests that a change made by another process is seen through the cache"""
+        path = os.path.join(self.directory, "database.sqlite3")
+        cached = cache.CachedStorage(storage.SQLiteStorage(path), 10)
+        cached.insert(self.member(1))
+        cached.get("test1@gmail.com")
+        other = storage.SQLiteStorage(path)
+        other.commit({"test1@gmail.com": -1000})
+        other.close()
+        self.assertEqual(cached.get("test1@gmail.com")["balance"], 0)
+        self.assertEqual(cached.stats()["invalidations"], 1)
+        cached.close()
+
+    def test_least_recently_used_members_are_evicted(self):
+        """Tests that the cache never holds more members than its capacity"""
+        engine = storage.SQLiteStorage(os.path.join(self.directory, "database.sqlite3"))
+        cached = cache.CachedStorage(engine, 2)
+        for number in (1, 2, 3):
+            engine.insert(self.member(number))
+            cached.get(f"test{number}@gmail.com")
+        self.assertEqual(cached.stats()["size"], 2)
+        self.assertEqual(cached.stats()["evictions"], 1)
+        self.assertEqual(cached.get("test1@gmail.com")["balance"], 1000)
+        self.assertEqual(cached.stats()["misses"], 4)
+        cached.close()
+
+
+class TestLedger(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.ledger = ledger.Ledger(os.path.join(directory.name, "records.csv"))
+        self.addCleanup(self.ledger.close)
+
+    def row(self, user, date, transaction, amount=1000, account=None):
+        return {"user": user, "time": "14:5", "date": date, "transaction": transaction, "amount": amount,
+                "account": account}
+
+    def test_rows_for_user(self):
+        """Tests that a statement contains only the rows of that user, in order"""
+        self.ledger.append(self.row("test1@gmail.com", "2022-09-12", "deposit"))
+        self.ledger.append(self.row("test2@gmail.com", "2022-09-12", "deposit"))
+        self.ledger.append(self.row("test1@gmail.com", "2022-09-13", "transfer", 500, "Test Two"))
+        rows = self.ledger.rows_for("test1@gmail.com")
+        self.assertEqual(rows, [
+            self.row("test1@gmail.com", "2022-09-12", "deposit"),
+            self.row("test1@gmail.com", "2022-09-13", "transfer", 500, "Test Two"),
+        ])
+        with open(self.ledger.path) as file:
+            self.assertEqual(file.readline().strip(), ",".join(ledger.FIELDS))
+
+    def test_rows_for_with_filters(self):
+        """Tests that statements can be limited to a date range and to some transaction types"""
+        self.ledger.append_many([
+            self.row("test1@gmail.com", "2022-09-12", "deposit"),
+            self.row("test1@gmail.com", "2022-09-20", "withdrawal"),
+            self.row("test1@gmail.com", "2022-09-25", "deposit"),
+        ])
+        self.assertEqual(len(self.ledger.rows_for("test1@gmail.com", start="2022-09-13")), 2)
+        self.assertEqual(len(self.ledger.rows_for("test1@gmail.com", end="2022-09-20")), 2)
+        self.assertEqual(len(self.ledger.rows_for("test1@gmail.com", transactions=["deposit"])), 2)
+
+    def test_quoted_line_breaks_stay_in_their_row(self):
+        """Tests that a name with a line break is read back whole, by this ledger and by one indexing it afresh"""
+        self.ledger.append_many(ledger.transfer_rows("a@x.com", "A", "b@x.com", 'Foo\n"Bar"', 5))
+        self.ledger.append(self.row("b@x.com", "2022-09-12", "deposit"))
+        other = ledger.Ledger(self.ledger.path)
+        self.addCleanup(other.close)
+        for source in (self.ledger, other):
+            self.assertEqual([row["account"] for row in source.rows_for("a@x.com")], ['Foo\n"Bar"'])
+            self.assertEqual([row["transaction"] for row in source.rows_for("b@x.com")], ["received", "deposit"])
+        os.remove(f"{os.path.splitext(self.ledger.path)[0]}.index.sqlite3")
+        fresh = ledger.Ledger(self.ledger.path)
+        self.addCleanup(fresh.close)
+        self.assertEqual(fresh.rows_for("a@x.com"), self.ledger.rows_for("a@x.com"))
+        self.assertEqual(len(list(fresh.rows())), 3)
+
+    def test_names_with_line_breaks_are_refused(self):
+        """Tests that new and edited names can't hold a line break"""
+        for name in ("Foo\n", "Foo\nBar", "Foo\rBar"):
+            with self.assertRaises(member_factory.BankError):
+                member_factory.validate_customer(name, "a@x.com", "pw", "current")
+        member_factory.validate_customer("Foo Bar", "a@x.com", "pw", "current")
+
+    def test_rows_appended_elsewhere_are_indexed(self):
+        """Tests that rows written to records.csv without the ledger are picked up"""
+        self.ledger.append(self.row("test1@gmail.com", "2022-09-12", "deposit"))
+        with open(self.ledger.path, "a", newline="") as file:
+            file.write("test1@gmail.com,16:14,2022-09-25,withdrawal,1000,\r\n")
+        self.assertEqual(len(self.ledger.rows_for("test1@gmail.com")), 2)
+
+
+class TestColumnarLedger(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.csv_path = os.path.join(self.directory, "records.csv")
+        datagen.write_ledger(self.csv_path, 20, 2000, seed=3)
+        self.path = os.path.join(self.directory, "records.ledger")
+        with open(self.csv_path) as file:
+            self.count = len(file.readlines()) - 1
+        self.assertEqual(ledger.convert(self.csv_path, self.path), self.count)
+
+    def test_statements_match_the_csv_ledger(self):
+        """Tests that the columnar ledger returns the same statements as records.csv, before and after reindexing"""
+        records, columnar = ledger.Ledger(self.csv_path), ledger.get_ledger(self.path)
+        self.addCleanup(lambda: ledger._ledgers.pop(self.path))
+        self.addCleanup(records.close)
+        self.assertIsInstance(columnar, ledger.ColumnarLedger)
+        columnar.reindex_after = 5
+        for number in range(3):
+            for target in (records, columnar):
+                target.append_many([ledger.new_row(datagen.email(number), "deposit", 10 + number)] * 4)
+            for user in [datagen.email(user) for user in range(21)] + ["nobody@bank.test"]:
+                self.assertEqual(columnar.rows_for(user), records.rows_for(user))
+                self.assertEqual(
+                    columnar.rows_for(user, "2022-03-01", "2022-06-30", ["withdrawal", "transfer"]),
+                    records.rows_for(user, "2022-03-01", "2022-06-30", ["withdrawal", "transfer"]),
+                )
+
+    def test_pages_match_the_csv_ledger(self):
+        """Tests that reading a statement a page at a time gives the same rows from either ledger"""
+        records, columnar = ledger.Ledger(self.csv_path), ledger.ColumnarLedger(self.path)
+        self.addCleanup(records.close)
+        for user in [datagen.email(user) for user in range(3)] + ["nobody@bank.test"]:
+            expected = records.rows_for(user, "2022-02-01")
+            for source in (records, columnar):
+                self.assertEqual(list(statements.statement(user, "2022-02-01", size=7, source=source)), expected)
+
+    def test_last_date_matches_the_csv_ledger(self):
+        """Tests that both ledgers report the date of their latest row"""
+        records, columnar = ledger.Ledger(self.csv_path), ledger.ColumnarLedger(self.path)
+        self.addCleanup(records.close)
+        with open(self.csv_path, newline="") as file:
+            expected = max(row["date"] for row in csv.DictReader(file))
+        self.assertEqual((records.last_date(), columnar.last_date()), (expected, expected))
+        empty = ledger.ColumnarLedger(os.path.join(self.directory, "empty.ledger"))
+        self.assertIsNone(empty.last_date())
+
+    def test_torn_append_is_cut_off(self):
+        """Tests that a row only half written by a crash is ignored and then overwritten"""
+        columnar = ledger.ColumnarLedger(self.path)
+        with open(os.path.join(self.path, "amount.i8"), "ab") as file:
+            file.write(b"\x01\x02\x03")
+        with open(os.path.join(self.path, "users.txt"), "a") as file:
+            file.write("torn@bank")
+        self.assertEqual(len(columnar), self.count)
+        columnar.append(ledger.new_row("new@bank.test", "deposit", 5))
+        self.assertEqual(len(columnar), self.count + 1)
+        self.assertEqual([row["amount"] for row in columnar.rows_for("new@bank.test")], [5])
+        self.assertEqual(columnar.rows_for("torn@bank"), [])
+
+    def test_convert_back_to_csv(self):
+        """Tests that converting back gives the original records.csv"""
+        path = os.path.join(self.directory, "back.csv")
+        self.assertEqual(ledger.convert(self.path, path), self.count)
+        with open(self.csv_path, "rb") as original, open(path, "rb") as converted:
+            self.assertEqual(converted.read(), original.read())
+
+
+class TestStatements(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.ledger = ledger.Ledger(os.path.join(directory.name, "records.csv"))
+        self.addCleanup(self.ledger.close)
+        self.ledger.append_many([
+            {"user": "test1@gmail.com" if number % 3 else "test2@gmail.com", "time": "9:30",
+             "date": f"2022-09-{number + 1:02}", "transaction": "deposit", "amount": number, "account": None}
+            for number in range(20)
+        ])
+
+    def test_pages_carry_on_from_their_cursor(self):
+        """Tests that each page starts after the cursor of the one before, and the last has no cursor"""
+        pages = list(statements.pages("test1@gmail.com", size=5, source=self.ledger))
+        self.assertEqual([len(rows) for rows, _ in pages], [5, 5, 3])
+        self.assertIsNone(pages[-1][1])
+        rows, cursor = pages[0]
+        self.assertEqual([row["amount"] for row in rows], [1, 2, 4, 5, 7])
+        # rows written since do not move a cursor, they are read at the end
+        self.ledger.append(ledger.new_row("test1@gmail.com", "withdrawal", 7))
+        amounts = [row["amount"] for row in statements.statement("test1@gmail.com", cursor=cursor, size=5,
+                                                                 source=self.ledger)]
+        self.assertEqual(amounts, [8, 10, 11, 13, 14, 16, 17, 19, 7])
+        self.assertEqual(list(statements.pages("nobody@gmail.com", source=self.ledger)), [([], None)])
+
+    def test_date_bounds(self):
+        """Tests that a statement can be limited to the rows between two dates"""
+        rows = statements.statement("test2@gmail.com", "2022-09-04", "2022-09-13", size=1, source=self.ledger)
+        self.assertEqual([row["date"] for row in rows], ["2022-09-04", "2022-09-07", "2022-09-10", "2022-09-13"])
+
+    def test_exports(self):
+        """Tests that statements are exported as CSV and JSON that read back as the rows"""
+        expected = self.ledger.rows_for("test2@gmail.com")
+        for name, read in (("csv", lambda text: list(csv.DictReader(io.StringIO(text)))), ("json", json.loads)):
+            output = io.StringIO()
+            statements.EXPORTS[name](statements.statement("test2@gmail.com", size=2, source=self.ledger), output)
+            rows = read(output.getvalue())
+            for row in rows:
+                row["amount"], row["account"] = int(row["amount"]), row["account"] or None
+            self.assertEqual(rows, expected)
+        output = io.StringIO()
+        statements.write_json(iter([]), output)
+        self.assertEqual(json.loads(output.getvalue()), [])
+
+    def test_command(self):
+        """Tests that python main.py statement writes a statement to a file"""
+        path = os.path.join(os.path.dirname(self.ledger.path), "statement.json")
+        with mock.patch.object(settings, "RECORDS", self.ledger.path):
+            self.addCleanup(lambda: ledger._ledgers.pop(self.ledger.path).close())
+            status = statements.main(["TEST2@gmail.com", "--start", "2022-09-10", "--format", "json", "--output", path])
+        with open(path) as file:
+            self.assertEqual((status, [row["amount"] for row in json.load(file)]), (0, [9, 12, 15, 18]))
+
+
+class TestDatagen(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.database = datagen.generate(self.directory, 50, 500, seed=7)
+
+    def test_database_has_the_portal_layout(self):
+        """Tests that the streamed database is exactly what json.dump would write"""
+        with open(self.database) as file:
+            content = file.read()
+        details = json.loads(content)
+        self.assertEqual(content, json.dumps(details, indent=4))
+        self.assertEqual(len(details), 50)
+
+    def test_ledger_agrees_with_balances(self):
+        """Tests that replaying the generated ledger gives every balance in the database"""
+        records = os.path.join(self.directory, "records.csv")
+        with open(records) as file:
+            rows = list(csv.DictReader(file))
+        self.assertEqual(len([row for row in rows if row["transaction"] != "received"]), 500)
+        with mock.patch.multiple(settings, DATABASE=self.database, RECORDS=records):
+            self.addCleanup(lambda: storage._engines.pop(self.database).close())
+            self.addCleanup(lambda: ledger._ledgers.pop(records).close())
+            self.assertEqual(balances.reconcile(), [])
+            self.assertTrue(all(detail["balance"] >= 0 for detail in storage.get_storage().all().values()))
+
+    @mock.patch("utilities.input", create=True)
+    def test_generated_data_loads_through_the_portal(self, mocked_input):
+        """Tests that a generated member can log in and see their statement"""
+        paths = {"DATABASE": self.database, "RECORDS": os.path.join(self.directory, "records.csv")}
+        with mock.patch.multiple(settings, **paths):
+            mocked_input.side_effect = [datagen.email(3), datagen.PASSWORD]
+            user = utilities.login()
+            self.assertIsInstance(user, Customer)
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                user.get_account_statement()
+            self.assertIn(datagen.email(3), output.getvalue())
+            storage._engines.pop(self.database).close()
+            ledger._ledgers.pop(paths["RECORDS"]).close()
+
+
+class TestReports(TestCase):
+    def test_portal_starts_without_pandas(self):
+        """Tests that the portal modules do not import pandas"""
+        output = subprocess.run(
+            [sys.executable, "-c", "import sys, utilities; print('pandas' in sys.modules)"],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        self.assertEqual(output.strip(), "False")
+
+    def test_format_statement(self):
+        """Tests that ledger rows are shown as a numbered table"""
+        rows = [{"user": "test1@gmail.com", "time": "14:5", "date": "2022-09-12", "transaction": "deposit",
+                 "amount": 8500, "account": None}]
+        lines = reports.format_statement(rows).splitlines()
+        self.assertEqual(lines[0].split(), ledger.FIELDS)
+        self.assertEqual(lines[1].split(), ["0", "test1@gmail.com", "14:5", "2022-09-12", "deposit", "8500", "None"])
+
+
+class TestBatch(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        database = os.path.join(self.directory, "database.json")
+        records = os.path.join(self.directory, "records.csv")
+        for name, value in [("DATABASE", database), ("RECORDS", records)]:
+            patcher = mock.patch.object(settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: storage._engines.pop(database).close())
+        self.addCleanup(lambda: ledger._ledgers.pop(records).close())
+        for number in (1, 2):
+            storage.get_storage().insert({
+                "id": str(number),
+                "name": f"Test {number}",
+                "email": f"test{number}@gmail.com",
+                "password": "ass",
+                "role": "customer",
+                "account type": "current",
+                "account number": 1000000000 + number,
+                "balance": 1000,
+            })
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as file:
+            file.write(content)
+        return path
+
+    def test_batch_applies_valid_rows_and_rejects_the_rest(self):
+        """Tests that a CSV batch is checked row by row against running balances"""
+        path = self.write("batch.csv", (
+            "operation,email,amount,account_number\n"
+            "deposit,test1@gmail.com,500,\n"
+            "transfer,test1@gmail.com,1500,1000000002\n"
+            "withdraw,test1@gmail.com,1,\n"
+            "deposit,test2@gmail.com,1000000,\n"
+            "transfer,test2@gmail.com,10,42\n"
+            "withdraw,nobody@gmail.com,10,\n"
+        ))
+        entries, rejected = batch.run(path)
+        self.assertEqual([entry["transaction"] for entry in entries], ["deposit", "transfer", "received"])
+        self.assertEqual(rejected, [
+            (3, "Sorry, insufficient funds.😡🤬"), (4, "Sorry, you can't deposit more than N999,999 at a time.❌"),
+            (5, "Sorry, account number not found.😓"), (6, "Sorry, account not found.😓"),
+        ])
+        engine = storage.get_storage()
+        self.assertEqual(engine.get("test1@gmail.com")["balance"], 0)
+        self.assertEqual(engine.get("test2@gmail.com")["balance"], 2500)
+        self.assertEqual(len(ledger.get_ledger().rows_for("test1@gmail.com")), 2)
+
+    def test_batch_reads_jsonl(self):
+        """Tests that a JSONL batch is posted"""
+        path = self.write("batch.jsonl", (
+            '{"operation": "withdraw", "email": "test2@gmail.com", "amount": 250}\n'
+            '{"operation": "transfer", "email": "test2@gmail.com", "amount": 250, "account_number": 1000000001}\n'
+        ))
+        entries, rejected = batch.run(path)
+        self.assertEqual((len(entries), rejected), (3, []))
+        self.assertEqual(storage.get_storage().get("test2@gmail.com")["balance"], 500)
+
+
+class TestOnboard(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.database = os.path.join(self.directory, "database.json")
+        self.blocks = os.path.join(self.directory, "account_blocks.txt")
+        paths = {
+            "DATABASE": self.database,
+            "MEMBER_COUNT": os.path.join(self.directory, "member_count.txt"),
+            "ACCOUNT_BLOCKS": self.blocks,
+            "SCRYPT_N": 2 ** 8,
+        }
+        patcher = mock.patch.multiple(settings, **paths)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: storage._engines.pop(self.database).close())
+        self.addCleanup(lambda: storage._account_numbers.pop(self.blocks))
+        with open(paths["MEMBER_COUNT"], "w") as file:
+            file.write("1")
+        storage.get_storage().insert({
+            "id": "0", "name": "Test One", "email": "test1@gmail.com", "password": "ass", "role": "customer",
+            "account type": "current", "account number": 1000000000, "balance": 0,
+        })
+
+    def test_valid_members_are_saved_in_one_write(self):
+        """Tests that a file of new members is checked like open_account and saved with one write of each file"""
+        path = os.path.join(self.directory, "members.csv")
+        with open(path, "w") as file:
+            file.write(
+                "name,email,password,account_type\n"
+                "ada lovelace,Ada@gmail.com,pw1,savings\n"
+                "grace hopper,grace@gmail.com,pw2,current\n"
+                "ada again,ada@gmail.com,pw3,savings\n"
+                "test one,test1@gmail.com,pw4,savings\n"
+                "alan turing,alan@gmail.com,,current\n"
+                "1234,bob@gmail.com,pw5,current\n"
+                "edsger dijkstra,edsger@gmail.com,pw6,checking\n"
+                "barbara liskov,barbara@gmail.com,pw7,current\n"
+            )
+        engine = storage.get_storage().engine
+        with mock.patch.object(engine, "_dump", wraps=engine._dump) as dump, \
+                mock.patch.object(engine, "get", side_effect=AssertionError("a member was read by email")):
+            details, rejected = onboard.run(path)
+        self.assertEqual(dump.call_count, 1)
+        self.assertEqual([detail["email"] for detail in details], ["ada@gmail.com", "grace@gmail.com", "barbara@gmail.com"])
+        self.assertEqual(rejected, [
+            (3, "email already exists"), (4, "email already exists"), (5, "invalid inputs"), (6, "invalid inputs"),
+            (7, "invalid inputs"),
+        ])
+        self.assertEqual([detail["id"] for detail in details], ["1", "2", "3"])
+        self.assertEqual(len({detail["account number"] for detail in details}), 3)
+        with open(settings.MEMBER_COUNT) as file, open(self.blocks) as blocks:
+            self.assertEqual((file.read(), blocks.read()), ("4", "1"))
+        user = member_factory.authenticate("grace@gmail.com", "pw2")
+        self.assertEqual((user.name, user.account_type, user.account_number), ("Grace Hopper", "current", details[1]["account number"]))
+
+
+class TestGroupCommit(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        database = os.path.join(directory.name, "database.json")
+        records = os.path.join(directory.name, "records.csv")
+        self.engine = storage.JSONStorage(database)
+        self.addCleanup(self.engine.close)
+        self.ledger = ledger.Ledger(records)
+        self.addCleanup(self.ledger.close)
+        self.engine.insert_many([
+            {"id": str(number), "name": f"Test {number}", "email": f"test{number}@gmail.com", "password": "ass",
+             "role": "customer", "account type": "current", "account number": 1000000000 + number, "balance": 1000}
+            for number in (1, 2)
+        ])
+
+    def test_concurrent_operations_are_committed_together(self):
+        """Tests that operations submitted at the same time share one write and each gets its own answer"""
+        group = groupcommit.GroupCommit(self.engine, self.ledger, 0.2, 100)
+        calls = [("deposit", "test1@gmail.com", 100, None)] * 4 + [
+            ("withdraw", "test2@gmail.com", 600, None),
+            ("withdraw", "test2@gmail.com", 600, None),
+            ("transfer", "test1@gmail.com", 50, 1000000002),
+            ("transfer", "test1@gmail.com", 50, 42),
+        ]
+        answers = [None] * len(calls)
+
+        def submit(number):
+            try:
+                answers[number] = group.submit(*calls[number])
+            except member_factory.BankError as error:
+                answers[number] = str(error)
+
+        with mock.patch.object(self.engine, "_append", wraps=self.engine._append) as append:
+            threads = [threading.Thread(target=submit, args=(number,)) for number in range(len(calls))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(group.batches, 1)
+        self.assertEqual(append.call_count, 1)
+        self.assertEqual(answers[:4], [None] * 4)
+        self.assertEqual(sorted(map(str, answers[4:6])), ["None", "Sorry, insufficient funds.😡🤬"])
+        self.assertEqual(answers[6]["email"], "test2@gmail.com")
+        self.assertEqual(answers[7], "Sorry, account number not found.😓")
+        self.assertEqual(self.engine.get("test1@gmail.com")["balance"], 1350)
+        self.assertEqual(self.engine.get("test2@gmail.com")["balance"], 450)
+        self.assertEqual(len(list(self.ledger.rows())), 7)
+
+    def test_batches_are_cut_at_size(self):
+        """Tests that a full batch is committed without waiting out the delay"""
+        group = groupcommit.GroupCommit(self.engine, self.ledger, 60, 1)
+        started = time.monotonic()
+        group.submit("deposit", "test1@gmail.com", 5)
+        self.assertLess(time.monotonic() - started, 30)
+        self.assertEqual(self.engine.get("test1@gmail.com")["balance"], 1005)
+
+
+class TestBalances(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        database = os.path.join(directory.name, "database.json")
+        self.records = os.path.join(directory.name, "records.csv")
+        for name, value in [("DATABASE", database), ("RECORDS", self.records), ("CHECKPOINT_INTERVAL", 2)]:
+            patcher = mock.patch.object(settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: storage._engines.pop(database).close())
+        self.addCleanup(lambda: ledger._ledgers.pop(self.records).close())
+        self.addCleanup(lambda: balances._checkpoints.pop(self.records).close())
+        for number in (1, 2):
+            storage.get_storage().insert({
+                "id": str(number),
+                "name": f"Test {number}",
+                "email": f"test{number}@gmail.com",
+                "password": "ass",
+                "role": "customer",
+                "account type": "current",
+                "account number": 1000000000 + number,
+                "balance": 0,
+            })
+
+    def test_balance_on_a_date(self):
+        """Tests that past balances from checkpoints and the rows since match a full replay"""
+        rng = random.Random(5)
+        rows = []
+        for day in range(1, 21):
+            now = dt.datetime(2022, 9, day, 12)
+            for _ in range(rng.randint(0, 3)):
+                user = rng.choice(["test1@gmail.com", "test2@gmail.com"])
+                rows.append(ledger.new_row(user, rng.choice(["deposit", "withdrawal", "received"]), rng.randint(1, 99),
+                                           now=now))
+        ledger.get_ledger().append_many(rows)
+        self.assertGreater(balances.checkpoint(), 0)
+        for day in range(0, 22):
+            date = f"{dt.date(2022, 8, 31) + dt.timedelta(days=day)}"
+            for user in ["test1@gmail.com", "test2@gmail.com", "nobody@gmail.com"]:
+                expected = sum(balances.change(row) for row in rows if row["user"] == user and row["date"] <= date)
+                self.assertEqual(balances.balance_on(user, date), expected)
+
+    def test_edited_names_cannot_hold_line_breaks(self):
+        """Tests that an edit can't give a member a name that would split their rows in the ledger"""
+        with self.assertRaises(member_factory.BankError):
+            member_factory.edit_customer("test2@gmail.com", {"name": "Test\nTwo"})
+        member_factory.edit_customer("test2@gmail.com", {"name": "Test Two"})
+        self.assertEqual(storage.get_storage().get("test2@gmail.com")["name"], "Test Two")
+        self.assertEqual(balances.balance_on("test2@gmail.com", dt.date.today()), 0)
+
+    def test_reconcile(self):
+        """Tests that transfers and edited balances keep the ledger and the database in step"""
+        with contextlib.redirect_stdout(io.StringIO()):
+            user = Customer.from_storage(storage.get_storage().get("test1@gmail.com"))
+            user.transact("deposit", 500)
+            ledger.get_ledger().append(ledger.new_row(user.email, "deposit", 500))
+            person = user.transfer(200, 1000000002)
+            ledger.get_ledger().append_many(
+                ledger.transfer_rows(user.email, user.name, person["email"], person["name"], 200)
+            )
+        member_factory.edit_customer("test2@gmail.com", {"balance": 1000})
+        member_factory.edit_customer("test2@gmail.com", {"email": "test3@gmail.com"})
+        self.assertEqual(balances.reconcile(), [])
+        self.assertEqual(balances.balance_on("test3@gmail.com", dt.date.today()), 1000)
+
+        storage.get_storage().commit({"test1@gmail.com": 5})
+        self.assertEqual(balances.reconcile(), [("test1@gmail.com", 305, 300)])
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(balances.main(["reconcile"]), 1)
+        self.assertIn("test1@gmail.com: N305, ledger N300", output.getvalue())
+
+
+class TestAccrual(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        database = os.path.join(directory.name, "database.json")
+        self.records = os.path.join(directory.name, "records.csv")
+        paths = {"DATABASE": database, "RECORDS": self.records, "INTEREST_RATE": 3.0, "MAINTENANCE_FEE": 2}
+        for name, value in paths.items():
+            patcher = mock.patch.object(settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: storage._engines.pop(database).close())
+        self.addCleanup(lambda: ledger._ledgers.pop(self.records).close())
+        accrual.get_accruals()
+        self.addCleanup(lambda: accrual._accruals.pop(self.records).close())
+        self.balances = {"saver@gmail.com": ("savings", 36_500), "small@gmail.com": ("savings", 100),
+                         "current@gmail.com": ("current", 500), "low@gmail.com": ("current", 1),
+                         "empty@gmail.com": ("current", 0)}
+        for number, (email, (account_type, balance)) in enumerate(self.balances.items(), start=1):
+            storage.get_storage().insert({"id": str(number), "name": f"Test {number}", "email": email,
+                                          "password": "ass", "role": "customer", "account type": account_type,
+                                          "account number": 1000000000 + number, "balance": balance})
+            if balance:
+                ledger.get_ledger().append(ledger.new_row(email, "deposit", balance, now=dt.datetime(2022, 6, 1, 9)))
+        storage.get_storage().insert({"id": "9", "name": "Test Official", "email": "o@bank.com", "password": "ass",
+                                      "role": "official"})
+
+    def test_interest_and_fees(self):
+        """Tests that savings earn a day's interest and current accounts pay the fee, never more than they hold"""
+        self.assertEqual(accrual.run("2022-06-30"), ((3, 3, 3), True))
+        found = {email: detail["balance"] for email, detail in storage.get_storage().all().items()
+                 if detail["role"] == "customer"}
+        self.assertEqual(found, {"saver@gmail.com": 36_503, "small@gmail.com": 100, "current@gmail.com": 498,
+                                 "low@gmail.com": 0, "empty@gmail.com": 0})
+        rows = ledger.get_ledger().rows_for("saver@gmail.com", start="2022-06-30", end="2022-06-30")
+        self.assertEqual([(row["transaction"], row["amount"], row["time"]) for row in rows], [("interest", 3, "23:59")])
+        self.assertEqual(balances.reconcile(), [])
+
+    def test_a_date_is_run_once(self):
+        """Tests that running a business date again changes nothing"""
+        accrual.run("2022-06-30")
+        with mock.patch.object(storage.get_storage(), "commit") as commit:
+            self.assertEqual(accrual.run("2022-06-30"), ((3, 3, 3), False))
+        commit.assert_not_called()
+        self.assertEqual(accrual.run("2022-07-01")[1], True)
+        self.assertEqual(storage.get_storage().get("current@gmail.com")["balance"], 496)
+
+    def test_an_unfinished_date_is_refused(self):
+        """Tests that a date that stopped after committing is only run again when asked to"""
+        with mock.patch.object(ledger.get_ledger(), "append_many", side_effect=OSError):
+            with self.assertRaises(OSError):
+                accrual.run("2022-06-30")
+        with self.assertRaises(accrual.AccrualError):
+            accrual.run("2022-06-30")
+        self.assertEqual(storage.get_storage().get("saver@gmail.com")["balance"], 36_503)
+        # a failed commit leaves the date free to run again
+        with mock.patch.object(storage.get_storage(), "commit", side_effect=storage.ConflictError):
+            with self.assertRaises(storage.ConflictError):
+                accrual.run("2022-07-01")
+        self.assertIsNone(accrual.get_accruals().get("2022-07-01"))
+        self.assertEqual(accrual.run("2022-06-30", retry=True)[1], True)
+
+    def test_dates_before_the_ledger_are_refused(self):
+        """Tests that a date is refused once the ledger has rows of a later day, so replays stay in date order"""
+        accrual.run("2022-07-01")
+        with self.assertRaises(accrual.AccrualError):
+            accrual.run("2022-06-30")
+        self.assertEqual(accrual.run("2022-07-01"), ((3, 3, 3), False))
+        storage.get_storage().commit({"saver@gmail.com": 5})
+        ledger.get_ledger().append(ledger.new_row("saver@gmail.com", "deposit", 5, now=dt.datetime(2022, 7, 5, 9)))
+        with self.assertRaises(accrual.AccrualError):
+            accrual.run("2022-07-04")
+        self.assertIsNone(accrual.get_accruals().get("2022-07-04"))
+        self.assertEqual(accrual.run("2022-07-05")[1], True)
+        self.assertEqual(balances.balance_on("saver@gmail.com", "2022-07-05"),
+                         storage.get_storage().get("saver@gmail.com")["balance"])
+        self.assertEqual(balances.reconcile(), [])
+
+    def test_changes_are_vectorized(self):
+        """Tests the changes worked out for arrays of balances"""
+        import numpy
+
+        amounts = accrual.changes(numpy.array([365_000, 10, -5, 0, 7]), numpy.array([True, True, True, False, False]),
+                                  10.0, 5)
+        self.assertEqual(amounts.tolist(), [100, 0, 0, 0, -5])
+
+
+class TestFraud(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        database = os.path.join(directory.name, "database.json")
+        self.records = os.path.join(directory.name, "records.csv")
+        self.path = os.path.join(directory.name, "fraud_rules.json")
+        for name, value in [("DATABASE", database), ("RECORDS", self.records), ("FRAUD_RULES", self.path)]:
+            patcher = mock.patch.object(settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(fraud, "RELOAD_INTERVAL", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: storage._engines.pop(database).close())
+        ledger.get_ledger()
+        fraud.get_rules()
+        self.addCleanup(lambda: ledger._ledgers.pop(self.records).close())
+        self.addCleanup(lambda: fraud._rules.pop((self.path, self.records)))
+        for number in (1, 2, 3):
+            storage.get_storage().insert({"id": str(number), "name": f"Test {number}", "email": f"test{number}@gmail.com",
+                                          "password": "ass", "role": "customer", "account type": "current",
+                                          "account number": 1000000000 + number, "balance": 10_000})
+        self.user = Customer.from_storage(storage.get_storage().get("test1@gmail.com"))
+
+    def write(self, *rules):
+        with open(self.path, "w") as file:
+            json.dump({"rules": list(rules)}, file)
+
+    def test_no_rules_without_the_file(self):
+        """Tests that nothing is checked when there is no rules file"""
+        self.assertIsNone(fraud.get_rules().reserve("test1@gmail.com", "withdraw", 10 ** 9))
+
+    @mock.patch("fraud.time.time")
+    def test_velocity(self, now):
+        """Tests that an account can only make count operations, or move amount, in any window"""
+        now.return_value = 1_000_000
+        self.write({"type": "velocity", "operations": ["withdraw"], "window": 60, "count": 2, "amount": 500})
+        self.user.post("withdraw", 100)
+        self.user.post("deposit", 5000)
+        self.user.post("withdraw", 100)
+        with self.assertRaises(member_factory.BankError):
+            self.user.post("withdraw", 100)
+        now.return_value += 31
+        with self.assertRaises(member_factory.BankError):
+            self.user.post("withdraw", 401)
+        # a withdrawal refused for insufficient funds does not count
+        with self.assertRaises(member_factory.BankError):
+            self.user.post("withdraw", 10 ** 6)
+        now.return_value += 30
+        self.user.post("withdraw", 400)
+        self.assertEqual(storage.get_storage().get("test1@gmail.com")["balance"], 14_400)
+
+    def test_daily_cap_and_new_recipients(self):
+        """Tests the daily cap, and that large transfers only go to someone sent to before, the ledger included"""
+        ledger.get_ledger().append_many(ledger.transfer_rows("test1@gmail.com", "Test 1", "test2@gmail.com", "Test 2", 1))
+        self.write({"type": "daily", "operations": ["withdraw", "transfer"], "amount": 3000},
+                   {"type": "new_recipient", "amount": 1000})
+        self.user.send(2000, 1000000002)
+        with self.assertRaises(member_factory.BankError):
+            self.user.send(1001, 1000000003)
+        self.user.send(500, 1000000003)
+        with self.assertRaises(member_factory.BankError):
+            self.user.post("withdraw", 501)
+        self.user.post("deposit", 501)
+        with self.assertRaisesRegex(member_factory.BankError, "account number not found"):
+            self.user.send(1, 1000000009)
+        # a new day starts at nothing
+        day = fraud.get_rules().accounts["test1@gmail.com"].day
+        fraud.get_rules().accounts["test1@gmail.com"].day = day - dt.timedelta(days=1)
+        self.user.send(2500, 1000000003)
+
+    def test_new_recipients_are_told_apart_by_email(self):
+        """Tests that having sent to someone does not count for another member with the same name"""
+        engine = storage.get_storage()
+        engine.update("test3@gmail.com", {"name": "Test 2"})
+        rows = ledger.transfer_rows("test1@gmail.com", "Test 1", "test2@gmail.com", "Test 2", 1,
+                                    dt.datetime(2022, 6, 1, 9))
+        ledger.get_ledger().append_many(rows)
+        self.write({"type": "new_recipient", "amount": 1000})
+        with self.assertRaisesRegex(member_factory.BankError, "someone new"):
+            self.user.send(1001, 1000000003)
+        self.user.send(1001, 1000000002)
+        self.user.send(500, 1000000003)
+        self.user.send(1001, 1000000003)
+        recipients = fraud.get_rules().accounts["test1@gmail.com"].recipients
+        self.assertEqual(recipients, {"test2@gmail.com", "test3@gmail.com"})
+
+    def test_amounts_must_be_above_zero(self):
+        """Tests that a negative amount is refused before it can lower the totals the rules check"""
+        for rules in ([], [{"type": "daily", "operations": ["withdraw"], "amount": 3000}]):
+            self.write(*rules)
+            for operation, amount in [("withdraw", -5000), ("deposit", 0), ("deposit", -1)]:
+                with self.assertRaisesRegex(member_factory.BankError, "invalid amount"):
+                    self.user.post(operation, amount)
+            with self.assertRaisesRegex(member_factory.BankError, "invalid amount"):
+                self.user.send(-5000, 1000000002)
+            with self.assertRaisesRegex(member_factory.BankError, "invalid amount"):
+                fraud.get_rules().reserve("test1@gmail.com", "withdraw", -5000)
+        with self.assertRaises(member_factory.BankError):
+            self.user.post("withdraw", 3001)
+        self.assertEqual(storage.get_storage().get("test1@gmail.com")["balance"], 10_000)
+
+    def test_rules_are_reloaded(self):
+        """Tests that a changed rules file is used without a restart, and a broken one keeps the old rules"""
+        self.write({"type": "daily", "amount": 100})
+        with self.assertRaises(member_factory.BankError):
+            self.user.post("deposit", 101)
+        self.write({"type": "daily", "amount": 1000000})
+        self.user.post("deposit", 101)
+        with open(self.path, "w") as file:
+            file.write('{"rules": [{"type": "daily"}]}')
+        with contextlib.redirect_stderr(io.StringIO()) as errors:
+            self.user.post("deposit", 101)
+        self.assertIn("could not be read", errors.getvalue())
+        os.remove(self.path)
+        self.user.post("deposit", 10 ** 6 - 1)
+
+    @mock.patch("utilities.input", create=True)
+    def test_refused_deposit_is_not_recorded(self, mocked_input):
+        """Tests that the menu does not write a deposit the rules refused to the ledger"""
+        utilities.logout()
+        self.addCleanup(utilities.logout)
+        self.write({"type": "daily", "operations": ["deposit"], "amount": 100})
+        mocked_input.side_effect = ["test1@gmail.com", "ass", "500"]
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertFalse(utilities.deposit())
+        self.assertIn("in a day", output.getvalue())
+        self.assertEqual(ledger.get_ledger().rows_for("test1@gmail.com"), [])
+
+
+class TestSnapshot(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.records = os.path.join(self.directory, "records.csv")
+        self.addCleanup(lambda: ledger._ledgers.pop(self.records).close())
+
+    def open(self, database):
+        database = os.path.join(self.directory, database)
+        self.addCleanup(lambda: storage._engines.pop(database).close())
+        engine = storage.get_storage(database)
+        engine.insert({
+            "id": "1", "name": "Test One", "email": "test1@gmail.com", "password": "ass", "role": "customer",
+            "account type": "current", "account number": 1000000000, "balance": 100,
+        })
+        ledger.get_ledger(self.records).append(ledger.new_row("test1@gmail.com", "deposit", 100))
+        return engine, snapshot.Snapshot(engine, ledger.get_ledger(self.records), 60)
+
+    def test_views_do_not_change_until_refreshed(self):
+        """Tests that a view keeps the balances and ledger rows of the moment it was taken"""
+        for database in ("database.json", "database.sqlite3"):
+            engine, copy = self.open(database)
+            view = copy.current()
+            engine.commit({"test1@gmail.com": 50})
+            ledger.get_ledger(self.records).append(ledger.new_row("test1@gmail.com", "deposit", 50))
+            self.assertIs(copy.current(), view)
+            self.assertEqual(view.get("test1@gmail.com")["balance"], 100)
+            self.assertEqual([row["amount"] for row in view.rows_for("test1@gmail.com")], [100])
+            self.assertEqual([row["amount"] for row in view.rows()], [100])
+            view = copy.refresh()
+            self.assertEqual(view.get("test1@gmail.com")["balance"], 150)
+            self.assertEqual(len(view.rows_for("test1@gmail.com")), 2)
+            os.remove(self.records)
+
+    def test_copies_do_not_wait_for_writers(self):
+        """Tests that the SQLite engine is copied without the lock its writes take"""
+        engine, copy = self.open("database.sqlite3")
+        with engine.engine.lock:
+            view = copy.refresh()
+        self.assertEqual(list(view.all()), ["test1@gmail.com"])
+
+    def test_old_copies_are_replaced_in_the_background(self):
+        """Tests that a view older than the interval is still read while a new one is taken"""
+        engine, copy = self.open("database.json")
+        view = copy.current()
+        engine.commit({"test1@gmail.com": 1})
+        with mock.patch("time.monotonic", return_value=view.taken + 61):
+            self.assertIs(copy.current(), view)
+            for _ in range(100):
+                if copy.view is not view:
+                    break
+                time.sleep(0.01)
+        self.assertEqual(copy.current().get("test1@gmail.com")["balance"], 101)
+
+    def test_new_members_are_found(self):
+        """Tests that a member opened since the copy was taken brings a new copy forward"""
+        engine, copy = self.open("database.json")
+        copy.current()
+        engine.insert({"id": "2", "name": "Test Two", "email": "test2@gmail.com", "password": "ass", "role": "official"})
+        self.assertEqual(copy.current("test2@gmail.com").get("test2@gmail.com")["name"], "Test Two")
+        self.assertIsNone(copy.current("nobody@gmail.com").get("nobody@gmail.com"))
+
+
+class TestServer(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        database = os.path.join(directory.name, "database.json")
+        records = os.path.join(directory.name, "records.csv")
+        for name, value in [("DATABASE", database), ("RECORDS", records)]:
+            patcher = mock.patch.object(settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: storage._engines.pop(database).close())
+        self.addCleanup(lambda: ledger._ledgers.pop(records).close())
+        for number in (1, 2):
+            storage.get_storage().insert({
+                "id": str(number),
+                "name": f"Test {number}",
+                "email": f"test{number}@gmail.com",
+                "password": "ass",
+                "role": "customer",
+                "account type": "current",
+                "account number": 1000000000 + number,
+                "balance": 1000,
+            })
+        storage.get_storage().insert(
+            {"id": "3", "name": "Test Official", "email": "official@bank.com", "password": "1234", "role": "official"}
+        )
+
+        loop = asyncio.new_event_loop()
+        portal = loop.run_until_complete(server.start("127.0.0.1", 0, workers=4))
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            portal.close()
+            loop.run_until_complete(portal.wait_closed())
+            loop.close()
+
+        self.addCleanup(stop)
+        self.connection = http.client.HTTPConnection("127.0.0.1", portal.sockets[0].getsockname()[1], timeout=10)
+        self.addCleanup(self.connection.close)
+
+    def request(self, method, path, payload=None, login=("test1@gmail.com", "ass")):
+        headers = {"Content-Type": "application/json"}
+        if isinstance(login, str):
+            headers["Authorization"] = f"Bearer {login}"
+        elif login:
+            headers["Authorization"] = "Basic " + base64.b64encode(":".join(login).encode()).decode()
+        body = json.dumps(payload) if payload is not None else None
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        return response.status, json.loads(response.read())
+
+    def test_customer_operations(self):
+        """Tests that a customer can deposit, withdraw, transfer and read their statement over one connection"""
+        self.assertEqual(self.request("POST", "/login")[1]["account number"], 1000000001)
+        self.assertEqual(self.request("POST", "/deposit", {"amount": 500}), (200, {"balance": 1500}))
+        self.assertEqual(self.request("POST", "/withdraw", {"amount": 200}), (200, {"balance": 1300}))
+        status, payload = self.request("POST", "/transfer", {"amount": 300, "account_number": 1000000002})
+        self.assertEqual((status, payload), (200, {"balance": 1000, "recipient": "Test 2"}))
+        self.assertEqual(self.request("GET", "/balance", login=("test2@gmail.com", "ass")), (200, {"balance": 1300}))
+        status, payload = self.request("GET", "/statement?transaction=deposit&transaction=transfer")
+        self.assertEqual([row["transaction"] for row in payload["rows"]], ["deposit", "transfer"])
+        status, payload = self.request("GET", "/statement?size=1")
+        self.assertEqual([row["transaction"] for row in payload["rows"]], ["deposit"])
+        status, payload = self.request("GET", f"/statement?size=2&cursor={payload['next']}")
+        self.assertEqual(([row["transaction"] for row in payload["rows"]], payload["next"]), (["withdrawal", "transfer"], None))
+        self.assertEqual(self.request("GET", "/statement?size=0")[0], 400)
+
+    def test_session_token(self):
+        """Tests that the token given at login authorizes requests until logout"""
+        status, payload = self.request("POST", "/login")
+        token = payload["token"]
+        self.assertEqual(self.request("GET", "/balance", login=token), (200, {"balance": 1000}))
+        self.assertEqual(self.request("POST", "/logout", login=token)[0], 200)
+        self.assertEqual(self.request("GET", "/balance", login=token)[0], 401)
+
+    def test_group_commit(self):
+        """Tests that the API answers the same with group commit on"""
+        with mock.patch.object(settings, "GROUP_COMMIT_SIZE", 8):
+            self.assertEqual(self.request("POST", "/deposit", {"amount": 500}), (200, {"balance": 1500}))
+            status, payload = self.request("POST", "/transfer", {"amount": 300, "account_number": 1000000002})
+            self.assertEqual((status, payload), (200, {"balance": 1200, "recipient": "Test 2"}))
+            self.assertEqual(self.request("POST", "/withdraw", {"amount": 5000})[0], 400)
+        self.assertEqual(len(ledger.get_ledger().rows_for("test1@gmail.com")), 2)
+
+    def test_metrics(self):
+        """Tests that requests are counted and served in the Prometheus text format and as JSON"""
+        metrics.enable()
+        self.addCleanup(metrics.reset)
+        self.addCleanup(metrics.enable, False)
+        self.request("POST", "/deposit", {"amount": 500})
+        self.connection.request("GET", "/metrics")
+        response = self.connection.getresponse()
+        text = response.read().decode()
+        self.assertTrue(response.getheader("Content-Type").startswith("text/plain"))
+        self.assertIn('bank_portal_requests_total{route="deposit",status="200"} 1\n', text)
+        self.assertIn('bank_portal_operation_seconds_count{operation="transact"} 1\n', text)
+        status, payload = self.request("GET", "/metrics?format=json", login=None)
+        self.assertIn("bank_portal_ledger_bytes_written_total", [counter["name"] for counter in payload["counters"]])
+
+    def test_business_rules_are_enforced(self):
+        """Tests that the API answers broken rules with the portal's messages"""
+        status, payload = self.request("POST", "/withdraw", {"amount": 5000})
+        self.assertEqual((status, payload["error"]), (400, "Sorry, insufficient funds.😡🤬"))
+        self.assertEqual(self.request("POST", "/deposit", {"amount": 1_000_000})[0], 400)
+        self.assertEqual(self.request("POST", "/deposit", {"amount": -5})[0], 400)
+        self.assertEqual(self.request("POST", "/transfer", {"amount": 5, "account_number": 42})[0], 400)
+        self.assertEqual(self.request("GET", "/balance", login=("test1@gmail.com", "wrong"))[0], 401)
+        self.assertEqual(self.request("GET", "/balance", login=None)[0], 401)
+        self.assertEqual(self.request("GET", "/admin/customers/test2@gmail.com")[0], 403)
+        self.assertEqual(self.request("GET", "/nowhere")[0], 404)
+        self.assertEqual(storage.get_storage().get("test1@gmail.com")["balance"], 1000)
+
+    def test_admin_operations(self):
+        """Tests that an official can open accounts and see and edit customer details"""
+        official = ("official@bank.com", "1234")
+        status, payload = self.request(
+            "POST", "/accounts", {"name": "john doe", "email": "John@gmail.com", "password": "pass", "account_type": "savings"}
+        )
+        self.assertEqual((status, payload["email"]), (201, "john@gmail.com"))
+        self.assertEqual(self.request("POST", "/admin/officials", {"name": "Jane", "password": "pw"}, official)[0], 201)
+        status, payload = self.request("PATCH", "/admin/customers/test2@gmail.com", {"account_type": "savings"}, official)
+        self.assertEqual((status, payload["account type"]), (200, "savings"))
+        status, payload = self.request("PATCH", "/admin/customers/test2@gmail.com", {"account_number": 1000000001}, official)
+        self.assertEqual((status, payload["error"]), (400, "Sorry, this account number already exists.😡🤬"))
+        status, payload = self.request("GET", "/admin/customers/test2@gmail.com", login=official)
+        self.assertEqual((status, payload["detail"]["account type"], payload["rows"]), (200, "savings", []))
+        self.assertNotIn("password", payload["detail"])
+        members = [{"name": "amy", "email": "amy@gmail.com", "password": "pw", "account_type": "current"}, {"name": "bo"}]
+        status, payload = self.request("POST", "/admin/customers", {"members": members}, official)
+        self.assertEqual((status, payload["rejected"]), (201, [{"row": 2, "reason": "invalid inputs"}]))
+        self.assertEqual([account["email"] for account in payload["accounts"]], ["amy@gmail.com"])
+        self.assertEqual(self.request("POST", "/admin/customers", {"members": members})[0], 403)
+        # the email is saved as edit_customer normalizes it, whatever JSON type it was sent as
+        status, payload = self.request("PATCH", "/admin/customers/test2@gmail.com", {"email": 5}, official)
+        self.assertEqual((status, payload["email"]), (200, "5"))
+        status, payload = self.request("PATCH", "/admin/customers/5", {"email": "Two@Gmail.com"}, official)
+        self.assertEqual((status, payload["email"]), (200, "two@gmail.com"))
+
+
+def random_transfers(path, emails, count, seed, results):
+    """Does random transfers between some accounts from a separate process and reports what moved"""
+    settings.DATABASE = path
+    storage._engines.clear()
+    rng = random.Random(seed)
+    customers = [Customer.from_storage(storage.get_storage().get(email)) for email in emails]
+    accounts = {customer.email: customer.account_number for customer in customers}
+    moved = dict.fromkeys(emails, 0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(count):
+            sender, recipient = rng.sample(customers, 2)
+            amount = rng.randint(1, 100)
+            if sender.transfer(amount, accounts[recipient.email]):
+                moved[sender.email] -= amount
+                moved[recipient.email] += amount
+    results.put(moved)
+
+
+class TestConcurrency(TestCase):
+    def test_concurrent_transfers_conserve_money(self):
+        """Tests that random transfers from several processes neither lose updates nor overdraw money"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "database.json")
+            engine = storage.JSONStorage(path)
+            emails = [f"stress{number}@gmail.com" for number in range(4)]
+            for number, email in enumerate(emails):
+                engine.insert({
+                    "id": str(number),
+                    "name": "Stress Test",
+                    "email": email,
+                    "password": "pass123",
+                    "role": "customer",
+                    "account type": "current",
+                    "account number": 1000000000 + number,
+                    "balance": 100,
+                })
+            engine.close()
+
+            context = multiprocessing.get_context("fork")
+            results = context.Queue()
+            processes = [
+                context.Process(target=random_transfers, args=(path, emails, 100, seed, results))
+                for seed in range(4)
+            ]
+            for process in processes:
+                process.start()
+            expected = dict.fromkeys(emails, 100)
+            for _ in processes:
+                for email, amount in results.get(timeout=60).items():
+                    expected[email] += amount
+            for process in processes:
+                process.join()
+                self.assertEqual(process.exitcode, 0)
+
+            engine = storage.JSONStorage(path)
+            balances = {email: detail["balance"] for email, detail in engine.all().items()}
+            engine.close()
+            self.assertEqual(balances, expected)
+            self.assertEqual(sum(balances.values()), 400)
+            self.assertTrue(all(balance >= 0 for balance in balances.values()))
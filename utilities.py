@@ -1,50 +1,86 @@
 """This module contains useful functions used in the program."""
-import json
-import pandas
-import datetime as dt
-import csv
-import os.path
-import re
-from member_factory import Customer, Official
+import metrics
+import settings
+from ledger import get_ledger, new_row, transfer_rows
+from member_factory import (
+    BankError,
+    INVALID_INPUTS,
+    authenticate,
+    edit_customer,
+    open_customer_account,
+    open_official_account,
+    validate_customer,
+)
+from reports import format_detail
+from sessions import get_sessions
+from snapshot import get_snapshot
+from statements import print_statement, statement
+from storage import get_storage
+
+# The session of whoever is using the menu, so they log in once until they say they are done
+session_token = None
+
+# What a member is told when they log in to something their role can't do
+DENIED = {
+    "customer": "Sorry, only customers can do this transaction!😡",
+    "official": "Sorry, you don't have access to this portal!😡🤬",
+}
 
 
 def start():
-    transaction = input(
-        "\nWhat would you like to do?\n\n"
-        "1. Open an account.\n"
-        "2. Do giveaway a.k.a. Transfer money.\n"
-        "3. Deposit money.\n"
-        "4. Withdraw money.\n"
-        "5. Check balance.\n"
-        "6. Account statement.\n"
-        "7. Change password.\n"
-        "8. Admin transactions.\n\n"
-        "Reply with a number to begin transaction: "
-    )
+    """Runs the menu until the member is done. Ends quietly when the answers run out, e.g. at the end of a script."""
+    try:
+        while True:
+            transaction = input(
+                "\nWhat would you like to do?\n\n"
+                "1. Open an account.\n"
+                "2. Do giveaway a.k.a. Transfer money.\n"
+                "3. Deposit money.\n"
+                "4. Withdraw money.\n"
+                "5. Check balance.\n"
+                "6. Account statement.\n"
+                "7. Change password.\n"
+                "8. Admin transactions.\n\n"
+                "Reply with a number to begin transaction: "
+            )
+
+            match transaction:
+                case "1":
+                    open_account()
+                case "2":
+                    transfer()
+                case "3":
+                    deposit()
+                case "4":
+                    withdraw()
+                case "5":
+                    check_balance()
+                case "6":
+                    get_account_statement()
+                case "7":
+                    change_password()
+                case "8":
+                    admin_start()
+                case _:
+                    print("\n\nSorry, invalid input!!🤬😡")
+
+            if not again():
+                return
+    except EOFError:
+        logout()
+        print("\n\nThank you and have a nice day.🙂")
 
-    match transaction:
-        case "1":
-            open_account()
-        case "2":
-            transfer()
-        case "3":
-            deposit()
-        case "4":
-            withdraw()
-        case "5":
-            check_balance()
-        case "6":
-            get_account_statement()
-        case "7":
-            change_password()
-        case "8":
-            admin_start()
-        case default:
-            print("\n\nSorry, invalid input!!🤬😡")
-            again()
 
+def login(role=None):
+    """Returns the member using the menu, asking them to log in unless they have a session for role."""
+    global session_token
+    user = get_sessions().get(session_token) if session_token else None
+    if user is not None:
+        if role is None or user.role == role:
+            print(f"\nLogged in as {user.email}.🙂")
+            return user
+        print(f"\nLogged in as {user.email}, which is not a {role} account.")
 
-def login():
     print("\nPlease login to authorize transaction.")
     email = input("\nYour email: ").lower()
     password = input("Your password: ")
@@ -53,52 +89,29 @@ def login():
         print("\nSorry, invalid input!🤬😡")
         return None
     try:
-        database = pandas.read_json("database.json")
-    except ValueError:
-        print("\nSorry, email and password not found. No database!😓")
+        user = authenticate(email, password)
+    except BankError as error:
+        print(f"\n{error}")
         return None
-    else:
-        if email in database:
-            if database[email]["password"] == password:
-                print("\nLogin Successful!🙂")
-                if database[email]["role"] == "customer":
-                    return Customer(
-                        database[email]["name"],
-                        email,
-                        database[email]["password"], database[email]["account type"],
-                        database[email]["balance"]
-                    )
-                else:
-                    return Official(database[email]["name"], database[email]["email"], database[email]["password"])
-            else:
-                print("\nSorry, password incorrect!!😓")
-                return None
-        else:
-            print("\nSorry, email not found!!😪")
-            return None
+    if role is not None and user.role != role:
+        print(f"\n{DENIED[role]}")
+        return None
+    logout()
+    session_token = get_sessions().open(user)
+    print("\nLogin Successful!🙂")
+    return user
+
 
+def logout():
+    global session_token
+    if session_token:
+        get_sessions().close(session_token)
+        session_token = None
 
+
+@metrics.timed("operation_seconds", operation="record")
 def record(user_email, transaction, amount, name=None):
-    now = dt.datetime.now()
-    data = {
-        "user": user_email,
-        "time": f"{now.hour}:{now.minute}",
-        "date": f"{now.date()}",
-        "transaction": transaction,
-        "amount": amount,
-        "account": name
-    }
-    fields = ["user", "time", "date", "transaction", "amount", "account"]
-    if os.path.exists("./records.csv"):
-        with open("records.csv", "a", newline="") as file:
-            output_writer = csv.DictWriter(file, fieldnames=fields)
-            output_writer.writerow(data)
-    else:
-        with open("records.csv", "w", newline="") as file:
-            output_writer = csv.DictWriter(file, fieldnames=fields)
-            output_writer.writeheader()
-            output_writer.writerow(data)
-    return data
+    return get_ledger().append(new_row(user_email, transaction, amount, name))
 
 
 def open_account():
@@ -111,37 +124,25 @@ def open_account():
     ).lower()
     password1 = input("Type a password to secure your account: ")
     password2 = input("Please confirm password: ")
-    re_pattern = '^.+[A-Za-z]$'
+    account_type = {"s": "savings", "c": "current"}.get(account_type)
 
-    if not re.match(re_pattern, name) or not email or not password1 or not password2 or account_type not in ["s", "c"]:
-        print("\nSorry, invalid inputs!! Make sure to fill all fields correctly!!🤬😡")
-        again()
-        return
-
-    if password1 != password2:
-        print("\nSorry, passwords do not match!!😡")
-        again()
-        return
     try:
-        database = pandas.read_json("database.json")
-    except ValueError:
-        pass
-    else:
-        if email in database.columns:
-            print("\nSorry, this email already exists in our database. Please use another email.🙁")
-            again()
-            return
-    account_type = "savings" if account_type == "s" else "current"
-    new_customer = Customer(name, email, password1, account_type)
+        validate_customer(name, email, password1, account_type)
+        if not password2:
+            raise BankError(INVALID_INPUTS)
+        if password1 != password2:
+            raise BankError("Sorry, passwords do not match!!😡")
+        new_customer = open_customer_account(name, email, password1, account_type)
+    except BankError as error:
+        print(f"\n{error}")
+        return
 
     print(f"\nSuccess!! Account has been created. The account number is: {new_customer.account_number}.🙂")
-    again()
 
 
 def transfer():
-    user = login()
+    user = login("customer")
     if user is None:
-        again()
         return
     else:
         try:
@@ -149,102 +150,78 @@ def transfer():
             account_number = int(input("\nWhich account number would you like to transfer to? "))
         except ValueError:
             print("\nInvalid input!!😡")
-            again()
             return
 
         person = user.transfer(amount, account_number)
         if person:
-            record(user.email, "transfer", amount, person)
-            again()
+            get_ledger().append_many(transfer_rows(user.email, user.name, person["email"], person["name"], amount))
             return True
         else:
-            again()
             return False
 
 
 def deposit():
-    user = login()
+    user = login("customer")
     if user is None:
-        again()
         return
     else:
         try:
             amount = int(input("\nHow much would you like to deposit? "))
         except ValueError:
             print("\nInvalid input!!😡")
-            again()
             return
-        if amount > 999_999:
+        if amount > settings.MAX_DEPOSIT:
             print("\n Are you a ritualist?🤨")
             print("\n Sorry, you can't transfer more than N999,999 at a time.❌")
-            again()
             return
 
-        user.transact("deposit", amount)
+        if not user.transact("deposit", amount):
+            return False
         record(user.email, "deposit", amount)
-        again()
         return True
 
 
 def withdraw():
-    user = login()
+    user = login("customer")
     if user is None:
-        again()
         return
     else:
         try:
             amount = int(input("\nHow much would you like to withdraw? "))
         except ValueError:
             print("\nInvalid input!!😡")
-            again()
             return
 
         status = user.transact("withdraw", amount)
 
         if status:
             record(user.email, "withdrawal", amount)
-            again()
             return True
         else:
-            again()
             return False
 
 
 def check_balance():
-    user = login()
-    if user is None:
-        again()
-    else:
+    user = login("customer")
+    if user is not None:
         user.check_balance()
-        again()
 
 
 def get_account_statement():
-    user = login()
-    if user is None:
-        again()
-    else:
+    user = login("customer")
+    if user is not None:
         user.get_account_statement()
-        again()
 
 
 def change_password():
     user = login()
-    if user is None:
-        again()
-    else:
+    if user is not None:
         user.change_password()
-        again()
 
 
 def admin_start():
-    user = login()
+    user = login("official")
     if user is None:
-        again()
-        return False
-    elif user.role != "official":
-        print("\nSorry, you don't have access to this portal!😡🤬")
-        again()
         return False
     else:
         transaction = input(
@@ -266,69 +243,52 @@ def admin_start():
                 get_customer_details()
             case "4":
                 user.change_password()
-                again()
-            case default:
+            case _:
                 print("\n\nSorry, invalid input!!🤬😡")
-                again()
 
 
 def admin_open_account():
-    new_user_role = input(
-        "\nWhat type of account would you like to create?"
-        "\nType 'A' for an official account and 'B' for a customer account. "
-    ).lower()
-
-    if new_user_role == "a":
-        print("Opening account...")
-        name = input("What is the name for the account? ").title()
-        password1 = input("Type a password to secure your account: ")
-        password2 = input("Please confirm password: ")
-
-        if not name or not password1 or not password2:
-            print("\nSorry, invalid inputs!! Make sure to fill all fields correctly!!🤬😡")
-            admin_open_account()
+    # ask again until the account is opened
+    while True:
+        new_user_role = input(
+            "\nWhat type of account would you like to create?"
+            "\nType 'A' for an official account and 'B' for a customer account. "
+        ).lower()
+
+        if new_user_role == "a":
+            print("Opening account...")
+            name = input("What is the name for the account? ").title()
+            password1 = input("Type a password to secure your account: ")
+            password2 = input("Please confirm password: ")
+
+            try:
+                if not password2:
+                    raise BankError(INVALID_INPUTS)
+                if password1 and password1 != password2:
+                    raise BankError("Sorry, passwords do not match!!😡")
+                new_user = open_official_account(name, password1)
+            except BankError as error:
+                print(f"\n{error}")
+                continue
+
+            print(f"\nSuccess!! Account has been created. Email is {new_user.email}.🙂")
             return
-
-        if password1 != password2:
-            print("\nSorry, passwords do not match!!😡")
-            admin_open_account()
+        elif new_user_role == "b":
+            open_account()
             return
-        email = None
-        try:
-            database = pandas.read_json("database.json")
-        except ValueError:
-            pass
         else:
-            # if email already exists in the company
-            if f"{name.lower()}@bank.com" in database.columns:
-                email = f"{name.lower()}{dt.datetime.now().second}@bank.com"
-
-        new_user = Official(name, email=email, password=password1)
-        print(f"\nSuccess!! Account has been created. Email is {new_user.email}.🙂")
-        again()
-        return
-    elif new_user_role == "b":
-        open_account()
-        return
-    else:
-        print("\n\nSorry, invalid input!!🤬😡")
-        admin_open_account()
-        return
+            print("\n\nSorry, invalid input!!🤬😡")
 
 
 def edit_customer_details():
-    customer = input("\nEmail of user account you wish to edit: ").lower()
-    try:
-        database = pandas.read_json("database.json")
-    except ValueError:
-        print("\nSorry, email not found!!😓")
-        edit_customer_details()
-        return
-    else:
-        if customer not in database:
+    storage = get_storage()
+    # ask again until a detail is changed
+    while True:
+        customer = input("\nEmail of user account you wish to edit: ").lower()
+        if not storage.contains(customer):
             print("\nSorry, email not found!!😓")
-            edit_customer_details()
-            return
+            continue
+
         detail = input(
             "\nWhat detail would you like to change?\n\n"
             "1. Account number.\n"
@@ -340,94 +300,70 @@ def edit_customer_details():
             "Reply with a number to proceed."
         )
 
-        with open("database.json", "w") as file:
-            database = database.to_dict()
-
-            if detail == "1":
-                new_account_number = input("\nInput new account number: ")
-                database[customer]["account number"] = new_account_number
-            elif detail == "2":
-                new_account_type = input(
-                    "\nInput new account type. Type 's' for savings and 'c' for current."
-                ).lower()
-                if new_account_type not in ["s", "c"]:
-                    print("\nSorry, invalid account type.😡🤬")
-                    edit_customer_details()
-                    return
-                database[customer]["account type"] = "savings" if new_account_type == "s" else "current"
-            elif detail == "3":
-                new_role = input(
-                    "\nInput new user role. Type 'a' for official and 'b' for customer."
-                )
-                if new_role not in ["a", "b"]:
-                    print("\nSorry, invalid user role.😡🤬")
-                    edit_customer_details()
-                    return
-                database[customer]["role"] = "official" if new_role == "a" else "customer"
-            elif detail == "4":
-                new_account_balance = input("\nInput new account balance: ")
-                try:
-                    new_account_balance = int(new_account_balance)
-                except ValueError:
-                    print("\nSorry, invalid input.😡🤬")
-                    edit_customer_details()
-                    return
-                database[customer]["balance"] = new_account_balance
-            elif detail == "5":
-                new_account_name = input("\nInput new account name: ")
-                database[customer]["name"] = new_account_name
-            elif detail == "6":
-                new_account_email = input("\nInput new account email: ")
-                database[customer]["email"] = new_account_email
-            else:
-                print("\n\nSorry, invalid input!!🤬😡")
-                edit_customer_details()
-                return
+        if detail == "1":
+            changes = {"account number": input("\nInput new account number: ")}
+        elif detail == "2":
+            new_account_type = input(
+                "\nInput new account type. Type 's' for savings and 'c' for current."
+            ).lower()
+            changes = {"account type": {"s": "savings", "c": "current"}.get(new_account_type)}
+        elif detail == "3":
+            new_role = input(
+                "\nInput new user role. Type 'a' for official and 'b' for customer."
+            )
+            changes = {"role": {"a": "official", "b": "customer"}.get(new_role)}
+        elif detail == "4":
+            changes = {"balance": input("\nInput new account balance: ")}
+        elif detail == "5":
+            changes = {"name": input("\nInput new account name: ")}
+        elif detail == "6":
+            changes = {"email": input("\nInput new account email: ")}
+        else:
+            print("\n\nSorry, invalid input!!🤬😡")
+            continue
 
-            json.dump(database, file, indent=4)
-            print("\nDetail changed successfully!🙂")
-        again()
+        try:
+            edit_customer(customer, changes)
+        except BankError as error:
+            print(f"\n{error}")
+            continue
+        print("\nDetail changed successfully!🙂")
         return
 
 
 def get_customer_details():
-    customer = input("\nEmail of customer you wish to see: ").lower()
-    try:
-        database = pandas.read_json("database.json")
-    except ValueError:
+    # ask again until a customer is found
+    while True:
+        customer = input("\nEmail of customer you wish to see: ").lower()
+        view = get_snapshot().current(customer)
+        detail = view.get(customer)
+        if detail is not None:
+            break
         print("\nSorry, email not found!!😓")
-        get_customer_details()
-        return
-    else:
-        if customer not in database:
-            print("\nSorry, email not found!!😓")
-            get_customer_details()
-            return
-        print("\n-------------Account Details------------------")
-        print(f"\n{database[customer]}")
-        try:
-            records = pandas.read_csv("records.csv")
-        except FileNotFoundError:
-            print("\nSorry, customer has not made any transactions.😑")
-            again()
-            return
-        else:
-            print("\n-------------Account Statement------------------\n")
-            print(records[records.user == customer])
-            again()
 
+    print("\n-------------Account Details------------------")
+    print(f"\n{format_detail(detail)}")
+    print(f"\nAs of {view.taken_at:%Y-%m-%d %H:%M:%S}.")
+    print_statement(
+        statement(customer, source=view), "\nSorry, customer has not made any transactions.😑",
+        "\n-------------Account Statement------------------\n",
+    )
 
-def again():
-    another = input(
-        "\nWould you like to perform another transaction? "
-        "Type 'y' for yes or 'n' for no. "
-    ).lower()
 
-    match another:
-        case "y":
-            start()
-        case "n":
-            print("\nThank you and have a nice day.🙂")
-        case default:
-            print("\nSorry, invalid input!🤬😡")
-            again()
+def again():
+    """Asks whether the member wants another transaction. Returns False, and logs them out, if not."""
+    while True:
+        another = input(
+            "\nWould you like to perform another transaction? "
+            "Type 'y' for yes or 'n' for no. "
+        ).lower()
+
+        match another:
+            case "y":
+                return True
+            case "n":
+                logout()
+                print("\nThank you and have a nice day.🙂")
+                return False
+            case _:
+                print("\nSorry, invalid input!🤬😡")